@@ -0,0 +1,321 @@
+"""
+BM25 Index - Persistent pre-tokenized corpus
+This module builds a compact on-disk BM25 index (vocabulary file plus memory-mapped
+term frequency arrays) so that serving processes start without downloading tokenizer
+data or re-tokenizing the corpus. The tokenizer an index was built with is recorded in
+its metadata, so queries are always tokenized the same way as its documents.
+"""
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+import nltk
+from collections import Counter
+from rank_bm25 import BM25Okapi
+from typing import Dict, List, Optional, Sequence
+
+INDEX_META_FILE = "meta.json"
+INDEX_VOCAB_FILE = "vocab.json"
+INDEX_ARRAYS = ("doc_indptr", "term_ids", "term_freqs", "doc_lens")
+
+# NLTK word_tokenize, or words and punctuation marks split by a regex when the punkt data is unavailable
+PUNKT_TOKENIZER = "punkt"
+REGEX_TOKENIZER = "regex"
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# None until the punkt data is looked up, then whether it is available
+_punkt_available = None
+
+
+def punkt_available() -> bool:
+    """
+    Check that the NLTK punkt data is installed. Nothing is downloaded, so that loading an
+    index never needs the network; install it with nltk.download("punkt_tab") beforehand.
+
+    Returns:
+        bool: Whether nltk.word_tokenize can be used
+    """
+    global _punkt_available
+    if _punkt_available is not None:
+        return _punkt_available
+    try:
+        nltk.data.find("tokenizers/punkt_tab")
+        _punkt_available = True
+    except LookupError:
+        print("NLTK punkt_tab data not installed, falling back to the regex tokenizer")
+        _punkt_available = False
+    return _punkt_available
+
+
+def default_tokenizer() -> str:
+    return PUNKT_TOKENIZER if punkt_available() else REGEX_TOKENIZER
+
+
+def tokenize(text: str, tokenizer: Optional[str] = None) -> List[str]:
+    """
+    Tokenize a text the same way for documents and queries.
+
+    Args:
+        text: Raw text
+        tokenizer: PUNKT_TOKENIZER or REGEX_TOKENIZER, punkt when its data is available by
+            default. Queries of an index must use the tokenizer of the index
+
+    Returns:
+        List of lowercased word tokens
+    """
+    tokenizer = tokenizer or default_tokenizer()
+    if tokenizer == REGEX_TOKENIZER:
+        return _WORD_PATTERN.findall(text.lower())
+    if not punkt_available():
+        raise LookupError("NLTK punkt_tab data is unavailable, rebuild the index with the regex tokenizer")
+    return nltk.word_tokenize(text.lower())
+
+
+def files_fingerprint(file_paths: Sequence[str]) -> str:
+    """
+    Fingerprint a set of source files from their names, sizes and modification times.
+
+    Args:
+        file_paths: Paths of the source files
+
+    Returns:
+        str: Hex digest that changes whenever a file is added, removed or modified
+    """
+    digest = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        stat = os.stat(file_path)
+        digest.update(f"{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def replace_dir(src_dir: str, dst_dir: str) -> None:
+    """
+    Replace a directory by another one of the same filesystem.
+
+    The old directory is renamed aside then removed, so dst_dir is missing only between two
+    renames. Open files and memory maps of the old directory stay valid.
+
+    Args:
+        src_dir: Directory holding the new content
+        dst_dir: Directory to replace
+    """
+    old_dir = None
+    if os.path.exists(dst_dir):
+        old_dir = f"{dst_dir}.old-{os.getpid()}"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(dst_dir, old_dir)
+    os.replace(src_dir, dst_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class BM25Index:
+    """
+    Pre-tokenized corpus stored as a document-major CSR matrix of term frequencies.
+
+    Row i of the matrix spans term_ids[doc_indptr[i]:doc_indptr[i + 1]] and the
+    matching term_freqs; doc_lens holds the token count of each document.
+    """
+    def __init__(self, names: List[str], vocab: List[str], doc_indptr: np.ndarray, term_ids: np.ndarray,
+                 term_freqs: np.ndarray, doc_lens: np.ndarray, fingerprint: Optional[str] = None,
+                 tokenizer: str = PUNKT_TOKENIZER):
+        self.names = names
+        self.vocab = vocab
+        self.doc_indptr = doc_indptr
+        self.term_ids = term_ids
+        self.term_freqs = term_freqs
+        self.doc_lens = doc_lens
+        self.fingerprint = fingerprint
+        self.tokenizer = tokenizer
+        self._term_to_id = None
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.names)
+
+    @property
+    def usable(self) -> bool:
+        # An index built with punkt cannot be queried where its data is missing
+        return self.tokenizer != PUNKT_TOKENIZER or punkt_available()
+
+    def tokenize(self, text: str) -> List[str]:
+        return tokenize(text, self.tokenizer)
+
+    @property
+    def term_to_id(self) -> Dict[str, int]:
+        if self._term_to_id is None:
+            self._term_to_id = {term: idx for idx, term in enumerate(self.vocab)}
+        return self._term_to_id
+
+    @classmethod
+    def from_tokenized(cls, names: List[str], tokenized_docs: List[List[str]],
+                       fingerprint: Optional[str] = None, tokenizer: str = PUNKT_TOKENIZER) -> "BM25Index":
+        """
+        Build the index from already tokenized documents.
+
+        Args:
+            names: Identifier of each document (file name or chunk id)
+            tokenized_docs: Tokens of each document
+            fingerprint: Fingerprint of the sources the documents were read from
+            tokenizer: Tokenizer the documents were tokenized with
+
+        Returns:
+            BM25Index: The built index
+        """
+        term_to_id = {}
+        doc_indptr = np.zeros(len(tokenized_docs) + 1, dtype=np.int64)
+        term_ids, term_freqs = [], []
+        for i, tokens in enumerate(tokenized_docs):
+            counts = Counter(tokens)
+            for term, freq in counts.items():
+                term_ids.append(term_to_id.setdefault(term, len(term_to_id)))
+                term_freqs.append(freq)
+            doc_indptr[i + 1] = len(term_ids)
+
+        return cls(
+            names=list(names),
+            vocab=list(term_to_id),
+            doc_indptr=doc_indptr,
+            term_ids=np.asarray(term_ids, dtype=np.int32),
+            term_freqs=np.asarray(term_freqs, dtype=np.int32),
+            doc_lens=np.asarray([len(tokens) for tokens in tokenized_docs], dtype=np.int32),
+            fingerprint=fingerprint,
+            tokenizer=tokenizer,
+        )
+
+    @classmethod
+    def from_texts(cls, names: List[str], texts: List[str], fingerprint: Optional[str] = None,
+                   tokenizer: Optional[str] = None) -> "BM25Index":
+        """
+        Tokenize raw texts and build the index.
+
+        Args:
+            names: Identifier of each document
+            texts: Raw text of each document
+            fingerprint: Fingerprint of the sources the texts were read from
+            tokenizer: Tokenizer of the documents and the queries, see tokenize
+
+        Returns:
+            BM25Index: The built index
+        """
+        tokenizer = tokenizer or default_tokenizer()
+        return cls.from_tokenized(names, [tokenize(text, tokenizer) for text in texts], fingerprint=fingerprint,
+                                  tokenizer=tokenizer)
+
+    def save(self, index_dir: str) -> None:
+        """
+        Write the index to a directory as .npy arrays plus JSON vocabulary and metadata.
+
+        Args:
+            index_dir: Destination directory
+        """
+        index_dir = os.path.normpath(index_dir)
+        os.makedirs(os.path.dirname(os.path.abspath(index_dir)), exist_ok=True)
+        # Written to a sibling directory then swapped in, the files of an index memory-mapped
+        # by a running process are never rewritten in place
+        tmp_dir = f"{index_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, INDEX_VOCAB_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, INDEX_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"names": self.names, "fingerprint": self.fingerprint, "tokenizer": self.tokenizer},
+                      f, ensure_ascii=False)
+        replace_dir(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True) -> "BM25Index":
+        """
+        Load an index previously written with save().
+
+        Args:
+            index_dir: Directory containing the index
+            mmap: Memory-map the arrays instead of reading them in memory
+
+        Returns:
+            BM25Index: The loaded index
+        """
+        meta_path = os.path.join(index_dir, INDEX_META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"BM25 index not found: {index_dir}")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(index_dir, INDEX_VOCAB_FILE), "r", encoding="utf-8") as f:
+            vocab = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in INDEX_ARRAYS
+        }
+        # Indexes written before the tokenizer was recorded were tokenized with punkt
+        return cls(names=meta["names"], vocab=vocab, fingerprint=meta["fingerprint"],
+                   tokenizer=meta.get("tokenizer", PUNKT_TOKENIZER), **arrays)
+
+    def to_bm25okapi(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25) -> BM25Okapi:
+        """
+        Create a rank_bm25 BM25Okapi scorer from the stored statistics, without tokenizing.
+
+        Args:
+            k1: BM25 term frequency saturation
+            b: BM25 length normalization
+            epsilon: Floor applied to negative idf values
+
+        Returns:
+            BM25Okapi: Scorer equivalent to BM25Okapi(tokenized_corpus)
+        """
+        bm25 = BM25Okapi.__new__(BM25Okapi)
+        bm25.k1, bm25.b, bm25.epsilon = k1, b, epsilon
+        bm25.tokenizer = None
+        bm25.corpus_size = self.num_docs
+        bm25.doc_len = self.doc_lens.tolist()
+        bm25.avgdl = float(np.sum(self.doc_lens)) / self.num_docs
+
+        vocab = self.vocab
+        term_ids = self.term_ids.tolist()
+        term_freqs = self.term_freqs.tolist()
+        indptr = self.doc_indptr.tolist()
+        bm25.doc_freqs = [
+            {vocab[t]: f for t, f in zip(term_ids[indptr[i]:indptr[i + 1]], term_freqs[indptr[i]:indptr[i + 1]])}
+            for i in range(self.num_docs)
+        ]
+
+        document_frequencies = np.bincount(self.term_ids, minlength=len(vocab))
+        bm25.idf = {}
+        bm25._calc_idf(dict(zip(vocab, document_frequencies.tolist())))
+        return bm25
+
+
+def load_or_build_bm25_index(input_dir: str, index_dir: str, pattern: str = "*.md") -> BM25Index:
+    """
+    Load the BM25 index of a folder of documents, rebuilding it only when the sources changed.
+
+    Args:
+        input_dir: Directory containing the source documents
+        index_dir: Directory where the index is persisted
+        pattern: Glob pattern selecting the source documents
+
+    Returns:
+        BM25Index: Index whose document names are the source file names
+    """
+    file_paths = sorted(glob.glob(os.path.join(input_dir, pattern)))
+    fingerprint = files_fingerprint(file_paths)
+
+    try:
+        index = BM25Index.load(index_dir)
+        if index.fingerprint == fingerprint and index.usable:
+            return index
+    except FileNotFoundError:
+        pass
+
+    print(f"Building BM25 index for {len(file_paths)} documents in {input_dir}")
+    texts = []
+    for file_path in file_paths:
+        with open(file_path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    index = BM25Index.from_texts([os.path.basename(p) for p in file_paths], texts, fingerprint=fingerprint)
+    index.save(index_dir)
+    return index
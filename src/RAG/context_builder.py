@@ -0,0 +1,227 @@
+"""
+Context Builder - Token-budgeted context for the policy RAG prompt
+This module splits the retrieved chunks into paragraph-level passages, drops the
+passages repeated by the overlap between consecutive chunks, and packs the passages
+most relevant to the question under a token budget. Every retrieved document keeps at
+least its best passage when the budget allows, so citations are preserved.
+"""
+import re
+import math
+from collections import Counter
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from bm25_index import tokenize
+
+# Word pieces of at most 6 characters and punctuation marks, close to a BPE token count
+_TOKEN_PATTERN = re.compile(r"\w{1,6}|[^\w\s]")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+")
+# Marks the passages skipped between two kept passages of a document
+_PASSAGE_SEPARATOR = "\n\n[...]\n\n"
+# Paragraphs shorter than this are only deduplicated on exact matches
+_MIN_CONTAINED_CHARS = 80
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of LLM tokens of a text without a tokenizer
+
+    Args:
+        text: Text to measure
+
+    Returns:
+        Approximate number of tokens
+    """
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def document_header(payload: Dict[str, Any]) -> str:
+    return f"Nom du document :{payload['file_name']}. Date du document :{payload['date']}.\nContenu du document :\n"
+
+
+class ContextBuilder:
+    """
+    Assemble the policy prompt context from retrieved chunks under a token budget.
+    """
+    def __init__(self, token_budget: int = 1500, min_passage_chars: int = 200, max_passage_chars: int = 1200,
+                 rank_weight: float = 0.5, token_counter: Callable[[str], int] = estimate_tokens):
+        """
+        Args:
+            token_budget: Maximum number of tokens of the assembled context
+            min_passage_chars: Shorter paragraphs (titles, list headers) are merged with the next one
+            max_passage_chars: Longer paragraphs are split on sentence boundaries
+            rank_weight: Weight of the chunk's retrieval rank in the passage score
+            token_counter: Function counting the tokens of a text
+        """
+        self.token_budget = token_budget
+        self.min_passage_chars = min_passage_chars
+        self.max_passage_chars = max_passage_chars
+        self.rank_weight = rank_weight
+        self.token_counter = token_counter
+        self.calls = 0
+        self.tokens_full = 0
+        self.tokens_used = 0
+
+    def split_passages(self, text: str) -> List[str]:
+        """
+        Split a chunk into paragraph-level passages
+
+        Args:
+            text: Chunk text
+
+        Returns:
+            Passages in reading order
+        """
+        return self._merge_paragraphs([p.strip() for p in _PARAGRAPH_BREAK.split(text) if p.strip()])
+
+    def _merge_paragraphs(self, paragraphs: List[str]) -> List[str]:
+        passages, pending = [], ""
+        for paragraph in paragraphs:
+            pending = f"{pending}\n\n{paragraph}" if pending else paragraph
+            if len(pending) < self.min_passage_chars:
+                continue
+            if len(pending) <= self.max_passage_chars:
+                passages.append(pending)
+            else:
+                current = ""
+                for sentence in _SENTENCE_END.split(pending):
+                    if current and len(current) + len(sentence) + 1 > self.max_passage_chars:
+                        passages.append(current)
+                        current = sentence
+                    else:
+                        current = f"{current} {sentence}" if current else sentence
+                if current:
+                    passages.append(current)
+            pending = ""
+        if pending:
+            passages.append(pending)
+        return passages
+
+    @staticmethod
+    def _dedupe_paragraphs(points: Sequence[Any]) -> Tuple[List[List[str]], int]:
+        # Consecutive chunks of a document overlap, and the overlap cuts a paragraph at the end
+        # of one chunk and at the start of the next: a paragraph is dropped when it is contained
+        # in a kept paragraph of its document, and replaces the kept paragraphs it contains
+        kept: Dict[str, List[Dict[str, Any]]] = {}
+        paragraphs_of_points: List[List[Dict[str, Any]]] = []
+        duplicates = 0
+        for point in points:
+            document = kept.setdefault(point.payload['file_name'], [])
+            paragraphs = []
+            for text in _PARAGRAPH_BREAK.split(point.payload['text']):
+                text = text.strip()
+                if not text:
+                    continue
+                normalized = _normalize(text)
+                # Short paragraphs (titles, list items) only match exactly, a containment test
+                # would drop them whenever their words appear in a longer paragraph
+                contained = (lambda short, long: short == long) if len(normalized) < _MIN_CONTAINED_CHARS \
+                    else (lambda short, long: short in long)
+                if any(contained(normalized, other["normalized"]) for other in document if not other["removed"]):
+                    duplicates += 1
+                    continue
+                for other in document:
+                    if not other["removed"] and len(other["normalized"]) >= _MIN_CONTAINED_CHARS \
+                            and other["normalized"] in normalized:
+                        other["removed"] = True
+                        duplicates += 1
+                paragraph = {"text": text, "normalized": normalized, "removed": False}
+                document.append(paragraph)
+                paragraphs.append(paragraph)
+            paragraphs_of_points.append(paragraphs)
+        return [[p["text"] for p in paragraphs if not p["removed"]] for paragraphs in paragraphs_of_points], duplicates
+
+    def _score(self, query_terms: Counter, passages: List[Dict[str, Any]]) -> None:
+        # Lexical relevance with an idf computed over the candidate passages, plus a retrieval rank prior
+        terms = [Counter(tokenize(passage["text"])) for passage in passages]
+        document_frequency = Counter(term for passage_terms in terms for term in passage_terms)
+        n = len(passages)
+        for passage, passage_terms in zip(passages, terms):
+            lexical = sum(
+                math.log(1 + n / document_frequency[term]) * passage_terms[term] / (passage_terms[term] + 1.0)
+                for term in query_terms if term in passage_terms
+            )
+            passage["score"] = lexical + self.rank_weight / (passage["rank"] + 1)
+
+    def build(self, query: str, points: Sequence[Any]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Build the context of a question from its retrieved chunks
+
+        Args:
+            query: User question
+            points: Retrieved points, best first, with text, file_name and date in their payload
+
+        Returns:
+            Tuple containing the context text and a report with the documents cited, the
+            tokens of the full chunks, the tokens used and saved, and the passage counts
+        """
+        full_text = "\n\n".join(document_header(point.payload) + point.payload['text'] for point in points)
+        tokens_full = self.token_counter(full_text)
+
+        # Paragraphs repeated by the chunk overlap are dropped before merging them into passages
+        paragraphs_of_points, duplicates = self._dedupe_paragraphs(points)
+        passages: List[Dict[str, Any]] = []
+        for rank, (point, paragraphs) in enumerate(zip(points, paragraphs_of_points)):
+            for position, text in enumerate(self._merge_paragraphs(paragraphs)):
+                passages.append({"text": text, "rank": rank, "position": position, "point": point})
+
+        self._score(Counter(tokenize(query)), passages)
+
+        # Best passage of each document first so that no citation is lost, then the best of the rest
+        ordered = sorted(passages, key=lambda passage: -passage["score"])
+        first_of_document, rest, documents = [], [], set()
+        for passage in ordered:
+            file_name = passage["point"].payload['file_name']
+            (rest if file_name in documents else first_of_document).append(passage)
+            documents.add(file_name)
+
+        selected, used_tokens = [], 0
+        headers = {}
+        for passage in first_of_document + rest:
+            file_name = passage["point"].payload['file_name']
+            cost = self.token_counter(passage["text"])
+            if file_name not in headers:
+                cost += self.token_counter(document_header(passage["point"].payload))
+            else:
+                cost += self.token_counter(_PASSAGE_SEPARATOR)
+            if used_tokens + cost > self.token_budget:
+                continue
+            headers.setdefault(file_name, passage["point"].payload)
+            selected.append(passage)
+            used_tokens += cost
+
+        # Passages are given in reading order, grouped by document in retrieval order
+        selected.sort(key=lambda passage: (passage["rank"], passage["position"]))
+        sections: Dict[str, List[str]] = {}
+        for passage in selected:
+            sections.setdefault(passage["point"].payload['file_name'], []).append(passage["text"])
+        context = "\n\n".join(
+            document_header(headers[file_name]) + _PASSAGE_SEPARATOR.join(texts) for file_name, texts in sections.items()
+        )
+
+        tokens_used = self.token_counter(context)
+        self.calls += 1
+        self.tokens_full += tokens_full
+        self.tokens_used += tokens_used
+        return context, {
+            "documents": list(sections),
+            "tokens_full": tokens_full,
+            "tokens_used": tokens_used,
+            # The section headers and separators may outweigh the dropped text of a tiny context
+            "tokens_saved": max(0, tokens_full - tokens_used),
+            "passages_total": len(passages),
+            "passages_used": len(selected),
+            "duplicates_removed": duplicates,
+        }
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dictionary with the number of contexts built and the tokens used and saved overall
+        """
+        return {"calls": self.calls, "tokens_full": self.tokens_full, "tokens_used": self.tokens_used,
+                "tokens_saved": max(0, self.tokens_full - self.tokens_used)}
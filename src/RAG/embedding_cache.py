@@ -0,0 +1,227 @@
+"""
+Embedding Cache - Query embeddings without repeated API calls
+This module caches embeddings keyed on the normalized text and the model name, in a
+bounded in-memory LRU backed by an optional SQLite store that survives restarts. Expired
+rows are deleted from the store when it is opened and then once per TTL period.
+Misses of a batch lookup are sent to the embedding endpoint in a single request.
+"""
+import re
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from tracing import count
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a query so that trivially different phrasings share a cache entry.
+
+    Args:
+        text: Raw query text
+
+    Returns:
+        Lowercased text with collapsed whitespace
+    """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class EmbeddingCache:
+    """
+    LRU/TTL cache in front of client.embeddings.create.
+    """
+    def __init__(self, client: Any, model: str = "mistral-embed", max_entries: int = 4096,
+                 ttl: Optional[float] = None, db_path: Optional[str] = None, max_batch_size: int = 64):
+        """
+        Args:
+            client: Mistral client used on cache misses
+            model: Embedding model name, part of the cache key
+            max_entries: Maximum number of embeddings kept in memory
+            ttl: Time to live of an entry in seconds, None to never expire
+            db_path: Path of the SQLite store, None to keep the cache in memory only
+            max_batch_size: Maximum number of texts sent per embedding request
+        """
+        self.client = client
+        self.model = model
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_batch_size = max_batch_size
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._last_prune = 0.0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, created REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+            self._db.commit()
+            self.prune()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _get(self, key: str) -> Optional[np.ndarray]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            vector, created = entry
+            if not self._expired(created):
+                self._entries.move_to_end(key)
+                return vector
+            del self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute("SELECT vector, created FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is not None and not self._expired(row[1]):
+                vector = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(key, vector, row[1])
+                return vector
+        return None
+
+    def _remember(self, key: str, vector: np.ndarray, created: float) -> None:
+        self._entries[key] = (vector, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, keys: Sequence[str], texts: Sequence[str]) -> Tuple[Dict[str, np.ndarray], Dict[str, str]]:
+        vectors: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in vectors or key in missing:
+                    continue
+                vector = self._get(key)
+                if vector is None:
+                    missing[key] = text
+                else:
+                    vectors[key] = vector
+            # Repeats of a missed text are embedded with it, they are neither hits nor extra misses
+            hits = sum(key in vectors for key in keys)
+            self.hits += hits
+            self.misses += len(missing)
+        count("embedding_cache.hits", hits)
+        count("embedding_cache.misses", len(missing))
+        return vectors, missing
+
+    def _store(self, batch_keys: Sequence[str], response: Any, vectors: Dict[str, np.ndarray]) -> None:
+        created = time.time()
+        batch_vectors = [np.asarray(item.embedding, dtype=np.float32) for item in response.data]
+        count("api_calls.embeddings")
+        with self._lock:
+            self.api_calls += 1
+            for key, vector in zip(batch_keys, batch_vectors):
+                vectors[key] = vector
+                self._remember(key, vector, created)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created) VALUES (?, ?, ?)",
+                    [(key, vector.tobytes(), created) for key, vector in zip(batch_keys, batch_vectors)],
+                )
+                self._db.commit()
+        # Rows expire one TTL after being written, so pruning once per TTL bounds the store
+        if self._db is not None and self.ttl is not None and created - self._last_prune > self.ttl:
+            self.prune()
+
+    def prune(self) -> int:
+        """
+        Delete the expired rows of the SQLite store.
+
+        Returns:
+            Number of rows deleted
+        """
+        if self._db is None or self.ttl is None:
+            return 0
+        with self._lock:
+            self._last_prune = time.time()
+            deleted = self._db.execute("DELETE FROM embeddings WHERE created < ?", (self._last_prune - self.ttl,)).rowcount
+            self._db.commit()
+        return deleted
+
+    def _batches(self, missing: Dict[str, str]) -> List[List[str]]:
+        missing_keys = list(missing)
+        return [missing_keys[start:start + self.max_batch_size]
+                for start in range(0, len(missing_keys), self.max_batch_size)]
+
+    def embed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed several texts, calling the API once per max_batch_size distinct misses.
+
+        Args:
+            texts: Texts to embed
+
+        Returns:
+            Array of shape (len(texts), dim) of float32 embeddings
+        """
+        keys = [self._key(text) for text in texts]
+        vectors, missing = self._lookup(keys, texts)
+        for batch_keys in self._batches(missing):
+            response = self.client.embeddings.create(
+                model=self.model,
+                inputs=[missing[key] for key in batch_keys],
+            )
+            self._store(batch_keys, response, vectors)
+        return np.stack([vectors[key] for key in keys])
+
+    async def _off_loop(self, function: Any, *args: Any) -> Any:
+        # SQLite reads and writes block, they run in a worker thread when there is a store
+        if self._db is None:
+            return function(*args)
+        return await asyncio.to_thread(function, *args)
+
+    async def aembed_batch(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Asyncio equivalent of embed_batch, the API requests of the misses run concurrently.
+        """
+        keys = [self._key(text) for text in texts]
+        vectors, missing = await self._off_loop(self._lookup, keys, texts)
+        batches = self._batches(missing)
+        responses = await asyncio.gather(*(
+            self.client.embeddings.create_async(model=self.model, inputs=[missing[key] for key in batch_keys])
+            for batch_keys in batches
+        ))
+        for batch_keys, response in zip(batches, responses):
+            await self._off_loop(self._store, batch_keys, response, vectors)
+        return np.stack([vectors[key] for key in keys])
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        Embed a single text.
+
+        Args:
+            text: Text to embed
+
+        Returns:
+            float32 embedding vector
+        """
+        return self.embed_batch([text])[0]
+
+    async def aembed(self, text: str) -> np.ndarray:
+        """
+        Asyncio equivalent of embed.
+        """
+        return (await self.aembed_batch([text]))[0]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dictionary with hit, miss and API call counters and the in-memory size
+        """
+        return {"hits": self.hits, "misses": self.misses, "api_calls": self.api_calls, "size": len(self._entries)}
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,220 @@
+"""
+Embedding Store - Columnar, memory-mapped document embeddings
+This module stores the document embeddings as one contiguous float32 (or float16) .npy
+block plus an uncompressed Arrow file holding the point ids and payload columns (text,
+file_name, date). Both files are memory-mapped on load, so worker processes on one node
+share a single page-cached copy instead of each unpickling its own DataFrame.
+"""
+import os
+import json
+import pickle
+import shutil
+import argparse
+import numpy as np
+import pyarrow as pa
+from typing import Any, Dict, List, Optional, Sequence
+
+from bm25_index import files_fingerprint, replace_dir
+
+STORE_META_FILE = "meta.json"
+STORE_VECTORS_FILE = "vectors.npy"
+STORE_PAYLOADS_FILE = "payloads.arrow"
+STORE_DTYPES = ("float32", "float16")
+
+
+class EmbeddingStore:
+    """
+    Point ids, a (n, dim) vector block and payload columns, row i of each describing one chunk.
+    """
+    def __init__(self, vectors: np.ndarray, table: pa.Table, fingerprint: Optional[str] = None):
+        """
+        Args:
+            vectors: (n, dim) float32 or float16 vectors
+            table: Arrow table with an id column followed by one column per payload field
+            fingerprint: Fingerprint of the source the store was built from
+        """
+        self.vectors = vectors
+        self.table = table
+        self.fingerprint = fingerprint
+        self._payloads: Optional[List[Dict[str, Any]]] = None
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def ids(self) -> List[str]:
+        return self.table.column("id").to_pylist()
+
+    @property
+    def payload_columns(self) -> List[str]:
+        return [name for name in self.table.column_names if name != "id"]
+
+    def column(self, name: str) -> List[Any]:
+        """
+        Read one payload column, e.g. the chunk texts, without building the payload dicts
+        """
+        return self.table.column(name).to_pylist()
+
+    @property
+    def payloads(self) -> List[Dict[str, Any]]:
+        if self._payloads is None:
+            self._payloads = self.table.select(self.payload_columns).to_pylist()
+        return self._payloads
+
+    def matrix(self) -> np.ndarray:
+        """
+        Returns:
+            The vectors as float32, without copy when they are stored as float32
+        """
+        return self.vectors if self.vectors.dtype == np.float32 else self.vectors.astype(np.float32)
+
+    @classmethod
+    def from_arrays(cls, ids: Sequence[str], vectors: np.ndarray, payloads: Sequence[Dict[str, Any]],
+                    dtype: str = "float32", fingerprint: Optional[str] = None) -> "EmbeddingStore":
+        """
+        Build a store from point ids, a vector matrix and payload dicts.
+
+        Args:
+            ids: Point ids
+            vectors: (n, dim) vectors
+            payloads: Payload of each point
+            dtype: Storage type of the vectors, float32 or float16
+            fingerprint: Fingerprint of the source
+
+        Returns:
+            EmbeddingStore: The store
+        """
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype}, expected one of {STORE_DTYPES}")
+        columns = list(dict.fromkeys(key for payload in payloads for key in payload))
+        table = pa.table({
+            "id": pa.array([str(point_id) for point_id in ids], type=pa.string()),
+            **{name: pa.array([payload.get(name) for payload in payloads]) for name in columns},
+        })
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=dtype))
+        return cls(vectors, table, fingerprint=fingerprint)
+
+    @classmethod
+    def from_dataframe(cls, document_embeddings: Any, dtype: str = "float32",
+                       fingerprint: Optional[str] = None) -> "EmbeddingStore":
+        """
+        Build a store from the id / vector / payload DataFrame of document_embeddings.pkl.
+        """
+        return cls.from_arrays(
+            document_embeddings["id"].tolist(),
+            np.asarray(document_embeddings["vector"].tolist(), dtype=np.float32),
+            document_embeddings["payload"].tolist(),
+            dtype=dtype,
+            fingerprint=fingerprint,
+        )
+
+    def save(self, store_dir: str) -> None:
+        """
+        Write the store to a directory as a .npy vector block and an Arrow payload file.
+
+        Args:
+            store_dir: Destination directory
+        """
+        store_dir = os.path.normpath(store_dir)
+        os.makedirs(os.path.dirname(os.path.abspath(store_dir)), exist_ok=True)
+        # Written to a sibling directory then swapped in, a store memory-mapped by a running
+        # process is never rewritten in place
+        tmp_dir = f"{store_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, STORE_VECTORS_FILE), self.vectors)
+        # Uncompressed so that the columns can be memory-mapped without decoding
+        with pa.OSFile(os.path.join(tmp_dir, STORE_PAYLOADS_FILE), "wb") as sink:
+            with pa.ipc.new_file(sink, self.table.schema) as writer:
+                writer.write_table(self.table)
+        with open(os.path.join(tmp_dir, STORE_META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"count": len(self), "dim": self.dim, "dtype": str(self.vectors.dtype),
+                       "fingerprint": self.fingerprint}, f)
+        replace_dir(tmp_dir, store_dir)
+
+    @classmethod
+    def load(cls, store_dir: str, mmap: bool = True) -> "EmbeddingStore":
+        """
+        Load a store previously written with save().
+
+        Args:
+            store_dir: Directory containing the store
+            mmap: Memory-map the vectors and payloads instead of reading them in memory
+
+        Returns:
+            EmbeddingStore: The loaded store
+        """
+        meta_path = os.path.join(store_dir, STORE_META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"Embedding store not found: {store_dir}")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        vectors = np.load(os.path.join(store_dir, STORE_VECTORS_FILE), mmap_mode="r" if mmap else None)
+        payloads_path = os.path.join(store_dir, STORE_PAYLOADS_FILE)
+        source = pa.memory_map(payloads_path, "r") if mmap else pa.OSFile(payloads_path, "rb")
+        table = pa.ipc.open_file(source).read_all()
+        return cls(vectors, table, fingerprint=meta["fingerprint"])
+
+
+def convert_pickle(embeddings_file: str, store_dir: str, dtype: str = "float32") -> EmbeddingStore:
+    """
+    Convert a pickled id / vector / payload DataFrame into an embedding store
+
+    Args:
+        embeddings_file: Path to the pickled document embeddings
+        store_dir: Directory the store is written to
+        dtype: Storage type of the vectors, float32 or float16
+
+    Returns:
+        EmbeddingStore: The converted store
+    """
+    with open(embeddings_file, "rb") as f:
+        document_embeddings = pickle.load(f)
+    store = EmbeddingStore.from_dataframe(document_embeddings, dtype=dtype,
+                                          fingerprint=files_fingerprint([embeddings_file]))
+    store.save(store_dir)
+    print(f"Converted {len(store)} embeddings of {embeddings_file} to {store_dir}")
+    return store
+
+
+def load_embedding_store(embeddings_file: str, store_dir: Optional[str] = None, dtype: Optional[str] = None,
+                         mmap: bool = True) -> EmbeddingStore:
+    """
+    Open the embeddings as a store, converting the pickle once when it is new or changed
+
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings
+        store_dir: Directory of the store converted from the pickle, under the indexes folder
+            next to it by default
+        dtype: Storage type of the vectors, a converted store of another type is converted
+            again. None reuses the converted store whatever its type, float32 when converting
+        mmap: Memory-map the store
+
+    Returns:
+        EmbeddingStore: The store
+    """
+    if os.path.isdir(embeddings_file):
+        return EmbeddingStore.load(embeddings_file, mmap=mmap)
+    store_dir = store_dir or os.path.join(os.path.dirname(embeddings_file), "indexes",
+                                          os.path.splitext(os.path.basename(embeddings_file))[0])
+    try:
+        store = EmbeddingStore.load(store_dir, mmap=mmap)
+        if store.fingerprint == files_fingerprint([embeddings_file]) and dtype in (None, str(store.vectors.dtype)):
+            return store
+    except FileNotFoundError:
+        pass
+    convert_pickle(embeddings_file, store_dir, dtype=dtype or "float32")
+    return EmbeddingStore.load(store_dir, mmap=mmap)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert document_embeddings.pkl to an embedding store")
+    parser.add_argument("embeddings_file", nargs="?", default="document_embeddings.pkl")
+    parser.add_argument("store_dir", nargs="?", default=os.path.join("indexes", "document_embeddings"))
+    parser.add_argument("--dtype", choices=STORE_DTYPES, default="float32")
+    args = parser.parse_args()
+    convert_pickle(args.embeddings_file, args.store_dir, dtype=args.dtype)
@@ -0,0 +1,449 @@
+"""
+Ingestion Pipeline - Incremental OCR, chunking and embedding of the report corpus
+This module turns the PDF reports into markdown with Mistral OCR, splits the markdown
+into overlapping chunks and embeds them with batched requests. A manifest records the
+content hash of every PDF and markdown document, so a run only processes the new or
+changed documents and resumes where an interrupted run stopped. The vectors of each
+document are written to their own shard, named after its markdown path, so adding
+documents never rewrites the others.
+"""
+import os
+import glob
+import json
+import uuid
+import asyncio
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from mistralai import DocumentURLChunk
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from utils import get_combined_markdown, remove_images_from_md
+from embedding_store import EmbeddingStore
+from scheduler import RateLimitedScheduler
+
+DEFAULT_SOURCES = [
+    {"collection": "technical_reports", "pdf_dir": os.path.join("..", "..", "data", "pdf", "technical_reports"),
+     "md_dir": os.path.join("..", "..", "data", "md", "technical_reports"), "prefix": "technical_report-"},
+    {"collection": "market_reports", "pdf_dir": os.path.join("..", "..", "data", "pdf", "market_reports"),
+     "md_dir": os.path.join("..", "..", "data", "md", "market_reports"), "prefix": "market_report-"},
+]
+DEFAULT_STORE_DIR = os.path.join("indexes", "ingestion")
+MANIFEST_FILE = "manifest.json"
+
+# Published as a placeholder by the ministry, there is nothing to index in it
+PLACEHOLDER_MESSAGE = "Ce document est en cours d'élaboration. Il sera mis en ligne prochainement."
+
+# Point ids derive from the document path, so re-ingesting a document keeps its ids
+POINT_ID_NAMESPACE = uuid.UUID("9b1c6f5e-3d0a-4c52-8f3e-5a7d2b6c1e40")
+
+
+def chunk_text(text: str, chunk_size: int = 8000, overlap: int = 1000) -> List[str]:
+    """
+    Split a text into chunks of chunk_size characters overlapping by overlap characters
+
+    Args:
+        text: Text to split
+        chunk_size: Number of characters per chunk
+        overlap: Number of characters shared by two consecutive chunks
+
+    Returns:
+        List of chunks
+    """
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        chunks.append(text[start:end])
+        if end == len(text):
+            break
+        start += chunk_size - overlap
+    return chunks
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def point_id(collection: str, md_path: str, chunk_index: int) -> str:
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, f"{collection}/{os.path.basename(md_path)}:{chunk_index}"))
+
+
+class IngestionPipeline:
+    """
+    Resumable PDF -> markdown -> chunks -> embeddings pipeline driven by a content-hash manifest.
+    """
+    def __init__(self, client: Any, sources: Sequence[Dict[str, str]] = DEFAULT_SOURCES,
+                 store_dir: str = DEFAULT_STORE_DIR, ocr_model: str = "mistral-ocr-latest",
+                 embedding_model: str = "mistral-embed", scheduler: Optional[RateLimitedScheduler] = None,
+                 batch_size: int = 32, max_batch_chars: int = 64000, chunk_size: int = 8000, overlap: int = 1000):
+        """
+        Args:
+            client: Mistral client
+            sources: Folders to ingest, each with a collection name, a PDF folder, a markdown
+                folder and the prefix of the uploaded file names
+            store_dir: Directory holding the manifest and the vector shards
+            ocr_model: Mistral OCR model
+            embedding_model: Mistral embedding model
+            scheduler: Scheduler pacing and retrying the OCR and embedding requests, a new one
+                with at most 4 requests in flight by default
+            batch_size: Maximum number of chunks per embedding request
+            max_batch_chars: Maximum number of characters per embedding request
+            chunk_size: Number of characters per chunk
+            overlap: Number of characters shared by two consecutive chunks
+        """
+        self.client = client
+        self.sources = list(sources)
+        self.store_dir = store_dir
+        self.ocr_model = ocr_model
+        self.embedding_model = embedding_model
+        self.scheduler = scheduler or RateLimitedScheduler(rate=5, max_concurrency=4)
+        self.batch_size = batch_size
+        self.max_batch_chars = max_batch_chars
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.manifest = self._load_manifest()
+
+    @property
+    def _settings(self) -> Dict[str, Any]:
+        return {"embedding_model": self.embedding_model, "chunk_size": self.chunk_size, "overlap": self.overlap}
+
+    def _load_manifest(self) -> Dict[str, Any]:
+        manifest_path = os.path.join(self.store_dir, MANIFEST_FILE)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        # Vectors computed with another model or chunking cannot be mixed with new ones
+        if manifest.get("settings") != self._settings:
+            manifest["documents"] = {}
+        manifest.setdefault("pdf", {})
+        manifest.setdefault("documents", {})
+        manifest["settings"] = self._settings
+        return manifest
+
+    def _save_manifest(self) -> None:
+        os.makedirs(self.store_dir, exist_ok=True)
+        manifest_path = os.path.join(self.store_dir, MANIFEST_FILE)
+        # Write then rename, so an interrupted run never leaves a truncated manifest
+        with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    @staticmethod
+    def _shard_name(collection: str, md_path: str) -> str:
+        # Documents with identical content keep their own shard, dropping one never deletes the other
+        name = os.path.splitext(os.path.basename(md_path))[0]
+        return os.path.join("shards", collection, f"{name}-{content_hash(md_path.encode('utf-8'))[:8]}")
+
+    def _shard_path(self, entry: Dict[str, Any]) -> str:
+        # Manifests written before shards were named after their document use the content hash
+        return os.path.join(self.store_dir, entry.get("shard") or os.path.join("shards", entry["collection"], entry["sha256"]))
+
+    async def _upload(self, pdf_path: str, prefix: str) -> Any:
+        # Read when the scheduler lets the request go, so waiting documents hold no PDF in memory
+        with open(pdf_path, "rb") as f:
+            content = f.read()
+        return await self.client.files.upload_async(
+            file={"file_name": f"{prefix}{os.path.basename(pdf_path)}", "content": content},
+            purpose="ocr"
+        )
+
+    async def _ocr_document(self, pdf_path: str, md_path: str, prefix: str, pdf_hash: str) -> None:
+        uploaded = await self.scheduler.acall(self._upload, pdf_path, prefix)
+        signed_url = await self.scheduler.acall(self.client.files.get_signed_url_async, file_id=uploaded.id, expiry=1)
+        ocr_result = await self.scheduler.acall(
+            self.client.ocr.process_async,
+            document=DocumentURLChunk(document_url=signed_url.url),
+            model=self.ocr_model,
+            include_image_base64=True
+        )
+        markdown = get_combined_markdown(ocr_result)
+        if markdown.strip() == PLACEHOLDER_MESSAGE:
+            # A report withdrawn to a placeholder must not keep its previous markdown
+            if os.path.exists(md_path):
+                os.remove(md_path)
+            md_path = None
+        else:
+            with open(md_path, "w", encoding="utf-8") as f:
+                f.write(markdown)
+        self.manifest["pdf"][pdf_path] = {"sha256": pdf_hash, "markdown": md_path}
+        self._save_manifest()
+
+    async def aocr(self) -> Dict[str, int]:
+        """
+        Convert the new and changed PDFs to markdown
+
+        Returns:
+            Dictionary with the number of PDFs converted, skipped and failed
+        """
+        tasks, paths, skipped = [], [], 0
+        for source in self.sources:
+            if not os.path.isdir(source["pdf_dir"]):
+                continue
+            os.makedirs(source["md_dir"], exist_ok=True)
+            for pdf_path in sorted(glob.glob(os.path.join(source["pdf_dir"], "*.pdf"))):
+                md_path = os.path.join(source["md_dir"], os.path.basename(pdf_path)[:-len(".pdf")] + ".md")
+                with open(pdf_path, "rb") as f:
+                    pdf_hash = content_hash(f.read())
+                entry = self.manifest["pdf"].get(pdf_path)
+                if entry is None and os.path.exists(md_path):
+                    # Converted before the manifest existed, adopt the markdown as is
+                    self.manifest["pdf"][pdf_path] = {"sha256": pdf_hash, "markdown": md_path}
+                    skipped += 1
+                    continue
+                if entry is not None and entry["sha256"] == pdf_hash:
+                    skipped += 1
+                    continue
+                paths.append(pdf_path)
+                tasks.append(self._ocr_document(pdf_path, md_path, source["prefix"], pdf_hash))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        errors = [f"{path}: {result}" for path, result in zip(paths, results) if isinstance(result, Exception)]
+        self._save_manifest()
+        if errors:
+            print(f"OCR errors: {errors}")
+        return {"converted": len(tasks) - len(errors), "skipped": skipped, "failed": len(errors)}
+
+    def _pending_documents(self) -> Tuple[List[Dict[str, Any]], int, int]:
+        """
+        Compare the markdown folders with the manifest
+
+        Returns:
+            Tuple containing the documents to embed, the number of unchanged documents and
+            the number of removed documents
+        """
+        pending, seen, unchanged = [], set(), 0
+        for source in self.sources:
+            for md_path in sorted(glob.glob(os.path.join(source["md_dir"], "*.md"))):
+                seen.add(md_path)
+                with open(md_path, "rb") as f:
+                    raw = f.read()
+                document_hash = content_hash(raw)
+                entry = self.manifest["documents"].get(md_path)
+                # Documents of a content-hash shard are embedded again under their own shard
+                if entry is not None and entry["sha256"] == document_hash and "shard" in entry \
+                        and os.path.exists(self._shard_path(entry) + ".npy"):
+                    unchanged += 1
+                    continue
+                text = remove_images_from_md(raw.decode("utf-8"))
+                if not text.strip() or text.strip() == PLACEHOLDER_MESSAGE:
+                    # Emptied documents leave the index like deleted ones
+                    seen.discard(md_path)
+                    continue
+                file_name = os.path.basename(md_path)
+                pending.append({
+                    "md_path": md_path,
+                    "collection": source["collection"],
+                    "sha256": document_hash,
+                    "chunks": chunk_text(text, chunk_size=self.chunk_size, overlap=self.overlap),
+                    "payload": {"file_name": file_name, "date": file_name.split("_")[0]},
+                })
+
+        removed = [md_path for md_path in self.manifest["documents"] if md_path not in seen]
+        for md_path in removed:
+            self._drop_document(md_path)
+        return pending, unchanged, len(removed)
+
+    def _drop_document(self, md_path: str) -> None:
+        entry = self.manifest["documents"].pop(md_path, None)
+        if entry is None:
+            return
+        shard_path = self._shard_path(entry)
+        if any(self._shard_path(other) == shard_path for other in self.manifest["documents"].values()):
+            # Content-hash shard still used by a document with the same content
+            return
+        for extension in (".npy", ".json"):
+            shard_file = shard_path + extension
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
+
+    def _batches(self, pending: List[Dict[str, Any]]) -> List[List[Tuple[int, int]]]:
+        # (document, chunk) pairs packed by count and by characters, across documents
+        batches, batch, batch_chars = [], [], 0
+        for document_index, document in enumerate(pending):
+            for chunk_index, chunk in enumerate(document["chunks"]):
+                if batch and (len(batch) >= self.batch_size or batch_chars + len(chunk) > self.max_batch_chars):
+                    batches.append(batch)
+                    batch, batch_chars = [], 0
+                batch.append((document_index, chunk_index))
+                batch_chars += len(chunk)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _write_document(self, document: Dict[str, Any]) -> None:
+        md_path = document["md_path"]
+        shard_name = self._shard_name(document["collection"], md_path)
+        shard_path = os.path.join(self.store_dir, shard_name)
+        # A shard of a previous layout or collection is removed, the new one replaces it
+        previous = self.manifest["documents"].get(md_path)
+        if previous is not None and self._shard_path(previous) != shard_path:
+            self._drop_document(md_path)
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        points = [
+            {"id": point_id(document["collection"], md_path, chunk_index), "payload": {"text": chunk, **document["payload"]}}
+            for chunk_index, chunk in enumerate(document["chunks"])
+        ]
+        # Write then rename, a changed document overwrites its shard
+        np.save(shard_path + ".tmp.npy", np.asarray(document["vectors"], dtype=np.float32))
+        with open(shard_path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(points, f, ensure_ascii=False)
+        os.replace(shard_path + ".tmp.npy", shard_path + ".npy")
+        os.replace(shard_path + ".json.tmp", shard_path + ".json")
+        self.manifest["documents"][md_path] = {
+            "sha256": document["sha256"],
+            "collection": document["collection"],
+            "chunks": len(document["chunks"]),
+            "shard": shard_name,
+        }
+        self._save_manifest()
+
+    async def _embed_batch(self, pending: List[Dict[str, Any]], batch: List[Tuple[int, int]]) -> None:
+        response = await self.scheduler.acall(
+            self.client.embeddings.create_async,
+            model=self.embedding_model,
+            inputs=[pending[document_index]["chunks"][chunk_index] for document_index, chunk_index in batch]
+        )
+        for (document_index, chunk_index), item in zip(batch, response.data):
+            document = pending[document_index]
+            document["vectors"][chunk_index] = item.embedding
+            document["remaining"] -= 1
+            # A document is persisted as soon as its last chunk is embedded
+            if document["remaining"] == 0:
+                self._write_document(document)
+
+    async def aembed(self) -> Dict[str, int]:
+        """
+        Embed the chunks of the new and changed markdown documents
+
+        Returns:
+            Dictionary with the number of documents embedded, unchanged, removed and failed,
+            and the number of chunks and embedding requests
+        """
+        pending, unchanged, removed = self._pending_documents()
+        for document in pending:
+            document["vectors"] = [None] * len(document["chunks"])
+            document["remaining"] = len(document["chunks"])
+
+        # The scheduler caps the requests in flight and slows down on 429 responses
+        batches = self._batches(pending)
+        results = await asyncio.gather(*(self._embed_batch(pending, batch) for batch in batches),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print(f"Embedding errors: {[str(error) for error in errors]}")
+        self._save_manifest()
+
+        failed = sum(1 for document in pending if document["remaining"] > 0)
+        return {
+            "embedded": len(pending) - failed,
+            "unchanged": unchanged,
+            "removed": removed,
+            "failed": failed,
+            "chunks": sum(len(document["chunks"]) for document in pending),
+            "requests": len(batches),
+        }
+
+    async def arun(self) -> Dict[str, Dict[str, int]]:
+        """
+        Run the OCR then the embedding stage
+
+        Returns:
+            Dictionary with the statistics of both stages
+        """
+        ocr_stats = await self.aocr()
+        embedding_stats = await self.aembed()
+        print(f"OCR: {ocr_stats}")
+        print(f"Embeddings: {embedding_stats}")
+        print(f"Requests: {self.scheduler.stats()}")
+        return {"ocr": ocr_stats, "embeddings": embedding_stats}
+
+    def run(self) -> Dict[str, Dict[str, int]]:
+        """
+        Blocking equivalent of arun, for scripts without a running event loop.
+        """
+        return asyncio.run(self.arun())
+
+    def load(self, collections: Optional[Sequence[str]] = None) -> Tuple[List[str], np.ndarray, List[dict]]:
+        """
+        Read the vectors of the ingested documents
+
+        Args:
+            collections: Collections to read, all of them by default
+
+        Returns:
+            Tuple containing the point ids, a (n, dim) float32 matrix and the payloads
+        """
+        ids, matrices, payloads = [], [], []
+        for md_path, entry in sorted(self.manifest["documents"].items()):
+            if collections is not None and entry["collection"] not in collections:
+                continue
+            shard_path = self._shard_path(entry)
+            with open(shard_path + ".json", "r", encoding="utf-8") as f:
+                points = json.load(f)
+            matrices.append(np.load(shard_path + ".npy"))
+            ids.extend(point["id"] for point in points)
+            payloads.extend(point["payload"] for point in points)
+        vectors = np.concatenate(matrices) if matrices else np.zeros((0, 0), dtype=np.float32)
+        return ids, vectors, payloads
+
+    def export_embeddings(self, output_file: str = "document_embeddings.pkl",
+                          collections: Optional[Sequence[str]] = ("technical_reports",)) -> int:
+        """
+        Write the ingested vectors in the id / vector / payload format of document_embeddings.pkl
+
+        Args:
+            output_file: Path of the pickled DataFrame
+            collections: Collections to export
+
+        Returns:
+            Number of points written
+        """
+        ids, vectors, payloads = self.load(collections)
+        document_embeddings = pd.DataFrame({"id": ids, "vector": list(vectors.tolist()), "payload": payloads})
+        document_embeddings.to_pickle(output_file)
+        return len(ids)
+
+    def export_store(self, store_dir: str = os.path.join("indexes", "document_embeddings"),
+                     collections: Optional[Sequence[str]] = ("technical_reports",), dtype: str = "float32") -> int:
+        """
+        Write the ingested vectors as a memory-mapped embedding store, see embedding_store
+
+        Args:
+            store_dir: Directory the store is written to
+            collections: Collections to export
+            dtype: Storage type of the vectors, float32 or float16
+
+        Returns:
+            Number of points written
+        """
+        ids, vectors, payloads = self.load(collections)
+        # The store changes exactly when one of its documents does
+        document_hashes = sorted(entry["sha256"] for entry in self.manifest["documents"].values()
+                                 if collections is None or entry["collection"] in collections)
+        fingerprint = content_hash("\n".join(document_hashes).encode("utf-8"))
+        EmbeddingStore.from_arrays(ids, vectors, payloads, dtype=dtype, fingerprint=fingerprint).save(store_dir)
+        return len(ids)
+
+
+if __name__ == "__main__":
+    import mistralai
+
+    parser = argparse.ArgumentParser(description="Ingest the new and changed reports")
+    parser.add_argument("--store-dir", default=DEFAULT_STORE_DIR)
+    parser.add_argument("--skip-ocr", action="store_true", help="Only embed the markdown folders")
+    parser.add_argument("--export", default=None, help="Write the technical reports to this embeddings file")
+    parser.add_argument("--export-store", default=None, help="Write the technical reports to this embedding store")
+    args = parser.parse_args()
+
+    pipeline = IngestionPipeline(mistralai.Mistral(api_key=os.getenv("MISTRAL_API_KEY")), store_dir=args.store_dir)
+    if args.skip_ocr:
+        print(f"Embeddings: {asyncio.run(pipeline.aembed())}")
+    else:
+        pipeline.run()
+    if args.export:
+        print(f"Exported {pipeline.export_embeddings(args.export)} points to {args.export}")
+    if args.export_store:
+        print(f"Exported {pipeline.export_store(args.export_store)} points to {args.export_store}")
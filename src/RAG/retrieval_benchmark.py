@@ -0,0 +1,385 @@
+"""
+Retrieval Benchmark - Offline recall, MRR and latency of the retrieval paths
+This module replays the questions of qa_rag_eval_full.csv through the BM25, vector and
+fusion paths of HybridRetriever, over the local embedding stores and chunk BM25 indexes.
+Query embeddings are recorded once in question_embeddings.pkl, so a run needs no network.
+For every path it reports recall@k and MRR of the expected document per folder_name, and
+the throughput and p50/p99 latency. The results are written to a JSON file that can be
+compared with the file of a previous run after every index or scorer change.
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from embedding_cache import EmbeddingCache, normalize_text
+from embedding_store import load_embedding_store
+from retriever import HybridRetriever, load_or_build_chunk_bm25
+from vector_index import LocalVectorIndex
+
+DEFAULT_QUESTIONS_FILE = "qa_rag_eval_full.csv"
+DEFAULT_QUERY_EMBEDDINGS_FILE = "question_embeddings.pkl"
+# Embeddings file or store of each folder_name, other folders are reported as skipped
+DEFAULT_STORES = {"technical_reports": "document_embeddings.pkl"}
+DEFAULT_BM25_DIR = os.path.join("indexes", "bm25")
+DEFAULT_RESULTS_DIR = os.path.join("indexes", "benchmarks")
+METHODS = ("bm25", "vector", "fusion")
+DEFAULT_KS = (1, 3, 5, 10)
+
+
+def load_questions(questions_file: str = DEFAULT_QUESTIONS_FILE, sample: Optional[int] = None,
+                   seed: int = 0) -> pd.DataFrame:
+    """
+    Load the evaluation questions
+
+    Args:
+        questions_file: CSV with question, answer, file_name, folder_name and date columns
+        sample: Number of questions drawn at random, all of them by default
+        seed: Seed of the sample
+
+    Returns:
+        DataFrame of the questions
+    """
+    questions = pd.read_csv(questions_file)
+    if sample is not None and sample < len(questions):
+        questions = questions.sample(n=sample, random_state=seed).sort_index()
+    return questions.reset_index(drop=True)
+
+
+def questions_fingerprint(questions: pd.DataFrame) -> str:
+    """
+    Fingerprint the question set, two results are only comparable when it matches
+    """
+    digest = hashlib.sha256()
+    for question, file_name in zip(questions["question"], questions["file_name"]):
+        digest.update(f"{question}\0{file_name}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_query_embeddings(embeddings_file: str = DEFAULT_QUERY_EMBEDDINGS_FILE) -> Dict[str, np.ndarray]:
+    """
+    Load the recorded question embeddings
+
+    Args:
+        embeddings_file: Pickled DataFrame with question and embedding columns
+
+    Returns:
+        Dictionary mapping each normalized question to its float32 embedding
+    """
+    if not os.path.exists(embeddings_file):
+        print(f"No recorded query embeddings at {embeddings_file}, only BM25 is evaluated")
+        return {}
+    recorded = pd.read_pickle(embeddings_file)
+    return {normalize_text(question): np.asarray(embedding, dtype=np.float32)
+            for question, embedding in zip(recorded["question"], recorded["embedding"])}
+
+
+def record_query_embeddings(client: Any, questions: pd.DataFrame,
+                            embeddings_file: str = DEFAULT_QUERY_EMBEDDINGS_FILE,
+                            model: str = "mistral-embed") -> int:
+    """
+    Embed the questions that have no recorded embedding yet, once, so later runs stay offline
+
+    Args:
+        client: Mistral client
+        questions: Evaluation questions
+        embeddings_file: Pickled DataFrame the embeddings are added to
+        model: Embedding model of the document collections
+
+    Returns:
+        Number of questions embedded
+    """
+    recorded = load_query_embeddings(embeddings_file) if os.path.exists(embeddings_file) else {}
+    missing = questions[[normalize_text(question) not in recorded for question in questions["question"]]]
+    missing = missing.drop_duplicates("question")
+    if missing.empty:
+        return 0
+    # Distinct questions are sent in batches of 64
+    embeddings = EmbeddingCache(client, model=model, max_entries=len(missing)).embed_batch(missing["question"].tolist())
+    rows = pd.DataFrame({
+        "question": missing["question"].tolist(),
+        "document_name": missing["file_name"].tolist(),
+        "embedding": list(embeddings),
+        "folder_name": missing["folder_name"].tolist(),
+        "date": missing["date"].tolist(),
+    })
+    if os.path.exists(embeddings_file):
+        rows = pd.concat([pd.read_pickle(embeddings_file), rows], ignore_index=True)
+    rows.to_pickle(embeddings_file)
+    return len(missing)
+
+
+def document_ranking(point_ids: Sequence[Any], file_names: Dict[str, str]) -> List[str]:
+    """
+    Turn a ranking of chunks into a ranking of their documents, best first and without repeats
+    """
+    return list(dict.fromkeys(file_names[str(point_id)] for point_id in point_ids))
+
+
+def rank_metrics(expected: Sequence[str], rankings: Sequence[Sequence[str]],
+                 ks: Sequence[int] = DEFAULT_KS) -> Dict[str, float]:
+    """
+    Compute recall@k and MRR of the expected document of each question
+
+    Args:
+        expected: Expected file name of each question
+        rankings: Documents returned for each question, best first
+        ks: Cut-offs of the recall
+
+    Returns:
+        Dictionary with the number of questions, recall@k for every k and the MRR
+    """
+    # 1-based rank of the expected document, 0 when it was not returned
+    ranks = np.array([ranking.index(name) + 1 if name in ranking else 0
+                      for name, ranking in zip(expected, rankings)], dtype=np.int64)
+    found = ranks > 0
+    metrics: Dict[str, float] = {"questions": int(len(ranks))}
+    for k in ks:
+        metrics[f"recall@{k}"] = float(np.mean(found & (ranks <= k))) if len(ranks) else 0.0
+    metrics["mrr"] = float(np.mean(np.where(found, 1.0 / np.maximum(ranks, 1), 0.0))) if len(ranks) else 0.0
+    return metrics
+
+
+def latency_metrics(latencies: Sequence[float], elapsed: float) -> Dict[str, float]:
+    """
+    Summarize per-question latencies given in seconds
+
+    Args:
+        latencies: Search latency of each question
+        elapsed: Wall clock duration of the whole replay in seconds
+
+    Returns:
+        Dictionary with the throughput in questions per second and the mean, p50 and p99 in ms
+    """
+    latencies_ms = 1000 * np.asarray(latencies)
+    return {
+        "throughput_qps": float(len(latencies_ms) / elapsed),
+        "mean_ms": float(latencies_ms.mean()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+class RetrievalBenchmark:
+    """
+    Replay evaluation questions through the retrieval paths of one HybridRetriever per folder.
+    """
+    def __init__(self, stores: Dict[str, str] = DEFAULT_STORES, bm25_dir: str = DEFAULT_BM25_DIR,
+                 candidates: int = 30, rrf_k: int = 60, ks: Sequence[int] = DEFAULT_KS,
+                 vector_mode: str = "auto"):
+        """
+        Args:
+            stores: Embeddings file or embedding store of each folder_name
+            bm25_dir: Directory holding the chunk BM25 index of each folder
+            candidates: Number of chunks retrieved by each path, as in HybridRetriever
+            rrf_k: Constant of the reciprocal-rank fusion
+            ks: Cut-offs of the recall
+            vector_mode: Search mode of the local vector index, auto, exact or ivf
+        """
+        self.stores = dict(stores)
+        self.bm25_dir = bm25_dir
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.ks = tuple(ks)
+        self.vector_mode = vector_mode
+        self.retrievers: Dict[str, HybridRetriever] = {}
+        self.file_names: Dict[str, Dict[str, str]] = {}
+        self.indexes: Dict[str, Dict[str, Any]] = {}
+
+    def _retriever(self, folder: str) -> HybridRetriever:
+        if folder not in self.retrievers:
+            embeddings_file = self.stores[folder]
+            store = load_embedding_store(embeddings_file)
+            bm25 = load_or_build_chunk_bm25(embeddings_file, os.path.join(self.bm25_dir, f"{folder}_chunks"))
+            index = LocalVectorIndex.from_store(store, collection_name=folder, mode=self.vector_mode)
+            # No client, every query embedding comes from the recording
+            self.retrievers[folder] = HybridRetriever(None, index, bm25, collection_name=folder,
+                                                      candidates=self.candidates, rrf_k=self.rrf_k)
+            self.file_names[folder] = dict(zip(store.ids, store.column("file_name")))
+            self.indexes[folder] = {"source": embeddings_file, "chunks": len(store),
+                                    "fingerprint": store.fingerprint, "vector_mode": index.collections[folder].mode}
+        return self.retrievers[folder]
+
+    def _search_fn(self, method: str, retriever: HybridRetriever) -> Callable[[str, Optional[np.ndarray]], List[Any]]:
+        if method == "bm25":
+            return lambda question, embedding: retriever._sparse_candidates(question)
+        if method == "vector":
+            return lambda question, embedding: [point.id for point in retriever._dense_candidates(embedding)]
+        if method == "fusion":
+            return lambda question, embedding: [point.id for point in retriever.retrieve(
+                question, top_k=self.candidates, query_embedding=embedding)]
+        raise ValueError(f"Unknown retrieval method {method}, expected one of {METHODS}")
+
+    def run(self, questions: pd.DataFrame, query_embeddings: Dict[str, np.ndarray],
+            methods: Sequence[str] = METHODS) -> Dict[str, Any]:
+        """
+        Replay the questions through every method
+
+        Args:
+            questions: Evaluation questions, see load_questions
+            query_embeddings: Recorded embeddings, see load_query_embeddings
+            methods: Retrieval paths evaluated among bm25, vector and fusion
+
+        Returns:
+            Results with the configuration, the indexes used and, per method, the metrics of
+            every folder and of all folders together plus the latency summary. Methods that
+            could not evaluate any question are listed in skipped_methods instead
+        """
+        folders = [folder for folder in questions["folder_name"].unique() if folder in self.stores]
+        skipped = {folder: int(count) for folder, count in questions["folder_name"].value_counts().items()
+                   if folder not in self.stores}
+        if skipped:
+            print(f"No index for {skipped} questions, skipped")
+
+        # Indexes are loaded before the replay so that their loading time is not measured
+        for folder in folders:
+            self._retriever(folder)
+
+        results: Dict[str, Any] = {}
+        skipped_methods: Dict[str, str] = {}
+        for method in methods:
+            expected, rankings, folder_of, latencies = [], [], [], []
+            missing_embeddings = 0
+            replay_start = time.perf_counter()
+            for folder in folders:
+                search = self._search_fn(method, self._retriever(folder))
+                file_names = self.file_names[folder]
+                rows = questions[questions["folder_name"] == folder]
+                for question, file_name in zip(rows["question"], rows["file_name"]):
+                    embedding = query_embeddings.get(normalize_text(question))
+                    if embedding is None and method != "bm25":
+                        missing_embeddings += 1
+                        continue
+                    start = time.perf_counter()
+                    point_ids = search(question, embedding)
+                    latencies.append(time.perf_counter() - start)
+                    expected.append(file_name)
+                    rankings.append(document_ranking(point_ids, file_names))
+                    folder_of.append(folder)
+            elapsed = time.perf_counter() - replay_start
+
+            # Zero metrics would read as a regression against a run that evaluated the method
+            if not expected:
+                skipped_methods[method] = f"no question evaluated, {missing_embeddings} without a recorded embedding"
+                print(f"{method}: skipped, {skipped_methods[method]}")
+                continue
+            folder_of = np.asarray(folder_of, dtype=object)
+            per_folder = {}
+            for folder in folders:
+                positions = np.flatnonzero(folder_of == folder)
+                if len(positions):
+                    per_folder[folder] = rank_metrics([expected[i] for i in positions],
+                                                      [rankings[i] for i in positions], self.ks)
+            results[method] = {
+                "folders": per_folder,
+                "all": rank_metrics(expected, rankings, self.ks),
+                "latency": latency_metrics(latencies, elapsed),
+                "missing_embeddings": missing_embeddings,
+            }
+            print(f"{method}: {results[method]['all']} {results[method]['latency']}")
+
+        return {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "config": {"candidates": self.candidates, "rrf_k": self.rrf_k, "ks": list(self.ks),
+                       "vector_mode": self.vector_mode, "questions": len(questions),
+                       "questions_fingerprint": questions_fingerprint(questions)},
+            "indexes": self.indexes,
+            "skipped_folders": skipped,
+            "skipped_methods": skipped_methods,
+            "results": results,
+        }
+
+
+def save_results(results: Dict[str, Any], output_file: Optional[str] = None) -> str:
+    """
+    Write benchmark results as JSON
+
+    Args:
+        results: Output of RetrievalBenchmark.run
+        output_file: Destination, a timestamped file of the benchmarks folder by default
+
+    Returns:
+        Path of the written file
+    """
+    if output_file is None:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output_file = os.path.join(DEFAULT_RESULTS_DIR, f"retrieval_{stamp}.json")
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    return output_file
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """
+    Describe the quality and speed changes between two benchmark results
+
+    Args:
+        baseline: Results of the reference run
+        current: Results of the new run
+
+    Returns:
+        One line per method and folder with the current value and the change of each metric
+    """
+    lines = []
+    if baseline["config"].get("questions_fingerprint") != current["config"].get("questions_fingerprint"):
+        lines.append("Warning: the question sets differ, quality changes are not comparable")
+    changed = {name: (baseline["config"].get(name), value) for name, value in current["config"].items()
+               if name != "questions_fingerprint" and baseline["config"].get(name) != value}
+    if changed:
+        lines.append("Configuration changes: " + ", ".join(f"{name} {old} -> {new}" for name, (old, new) in changed.items()))
+    for method, reason in current.get("skipped_methods", {}).items():
+        lines.append(f"{method}: not evaluated ({reason})")
+    for method, result in current["results"].items():
+        reference = baseline["results"].get(method)
+        # Runs that evaluated no question of a method have nothing to compare with
+        if reference is None or not reference["all"]["questions"]:
+            continue
+        for folder, metrics in {**result["folders"], "all": result["all"]}.items():
+            reference_metrics = reference["all"] if folder == "all" else reference["folders"].get(folder)
+            if reference_metrics is None or not reference_metrics["questions"]:
+                continue
+            changes = [f"{name} {value:.3f} ({value - reference_metrics[name]:+.3f})"
+                       for name, value in metrics.items() if name != "questions" and name in reference_metrics]
+            lines.append(f"{method} / {folder}: " + ", ".join(changes))
+        changes = [f"{name} {value:.2f} ({value - reference['latency'][name]:+.2f})"
+                   for name, value in result["latency"].items()]
+        lines.append(f"{method} / latency: " + ", ".join(changes))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline retrieval benchmark on qa_rag_eval_full.csv")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_FILE)
+    parser.add_argument("--query-embeddings", default=DEFAULT_QUERY_EMBEDDINGS_FILE)
+    parser.add_argument("--store", action="append", default=[], metavar="FOLDER=PATH",
+                        help="Embeddings file or store of a folder_name, technical_reports by default")
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=list(METHODS))
+    parser.add_argument("-k", type=int, nargs="+", default=list(DEFAULT_KS))
+    parser.add_argument("--candidates", type=int, default=30)
+    parser.add_argument("--vector-mode", choices=("auto", "exact", "ivf"), default="auto")
+    parser.add_argument("--sample", type=int, default=None, help="Number of questions drawn at random")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None, help="Results file of a previous run to compare with")
+    parser.add_argument("--record", action="store_true",
+                        help="Embed the questions missing from the recording first, needs MISTRAL_API_KEY")
+    args = parser.parse_args()
+
+    stores = dict(store.split("=", 1) for store in args.store) if args.store else DEFAULT_STORES
+    questions = load_questions(args.questions, sample=args.sample)
+    if args.record:
+        import mistralai
+        client = mistralai.Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
+        print(f"Recorded {record_query_embeddings(client, questions, args.query_embeddings)} query embeddings")
+
+    benchmark = RetrievalBenchmark(stores, candidates=args.candidates, ks=args.k, vector_mode=args.vector_mode)
+    results = benchmark.run(questions, load_query_embeddings(args.query_embeddings), methods=args.methods)
+    print(f"Results written to {save_results(results, args.output)}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            print("\n".join(compare_results(json.load(f), results)))
@@ -0,0 +1,205 @@
+"""
+Hybrid Retriever - Chunk-level BM25 + dense retrieval
+This module retrieves policy passages in a single pass: the query is embedded once,
+BM25 and vector search both run over the same chunks, and the two rankings are
+merged with reciprocal-rank fusion. The asyncio variant scores BM25 while the query
+embedding request is in flight.
+"""
+import asyncio
+import numpy as np
+from qdrant_client import QdrantClient
+from qdrant_client.models import ScoredPoint
+from typing import Any, Dict, List, Optional, Sequence
+
+from bm25_index import BM25Index
+from sparse_bm25 import SparseBM25
+from embedding_cache import EmbeddingCache
+from embedding_store import load_embedding_store
+from tracing import count, span
+
+
+def load_or_build_chunk_bm25(embeddings_file: str, index_dir: str, store_dir: Optional[str] = None) -> SparseBM25:
+    """
+    Load the BM25 index of the embedded chunks, rebuilding it when the embeddings changed.
+
+    Documents of the index are the chunk texts stored in the embeddings payloads and
+    their names are the point ids, so BM25 and vector hits refer to the same chunks.
+
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings (id, vector, payload)
+        index_dir: Directory where the chunk index is persisted
+        store_dir: Directory of the store converted from a pickled embeddings file
+
+    Returns:
+        SparseBM25: Scorer whose names are the chunk point ids
+    """
+    store = load_embedding_store(embeddings_file, store_dir)
+    fingerprint = store.fingerprint
+    try:
+        index = BM25Index.load(index_dir)
+        if index.fingerprint == fingerprint and index.usable:
+            return SparseBM25(index)
+    except FileNotFoundError:
+        pass
+
+    # Only the id and text columns are read, the vectors stay on disk
+    ids = store.ids
+    texts = store.column("text")
+
+    print(f"Building chunk BM25 index for {len(ids)} chunks of {embeddings_file}")
+    index = BM25Index.from_texts(ids, texts, fingerprint=fingerprint)
+    index.save(index_dir)
+    return SparseBM25(index)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = 60) -> Dict[str, float]:
+    """
+    Fuse several rankings with reciprocal-rank fusion, score(d) = sum(1 / (k + rank(d))).
+
+    Args:
+        rankings: Lists of ids, best first
+        k: RRF smoothing constant
+
+    Returns:
+        Dictionary mapping each id to its fused score, best first
+    """
+    rankings = [ranking for ranking in rankings if len(ranking)]
+    if not rankings:
+        return {}
+    ids = np.concatenate([np.asarray(ranking, dtype=str) for ranking in rankings])
+    ranks = np.concatenate([np.arange(1, len(ranking) + 1) for ranking in rankings])
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    fused = np.bincount(inverse, weights=1.0 / (k + ranks))
+    order = np.argsort(-fused, kind="stable")
+    return {str(unique_ids[i]): float(fused[i]) for i in order}
+
+
+class HybridRetriever:
+    """
+    Retrieve passages from a Qdrant collection fused with a chunk-level BM25 index.
+    """
+    def __init__(self, client: Any, qdrant_client: QdrantClient, bm25: SparseBM25,
+                 collection_name: str = "technical_reports", embedding_model: str = "mistral-embed",
+                 candidates: int = 30, rrf_k: int = 60, embedding_cache: Optional[EmbeddingCache] = None):
+        """
+        Args:
+            client: Mistral client used to embed queries
+            qdrant_client: Qdrant client holding the chunk embeddings, or a LocalVectorIndex
+            bm25: Chunk-level BM25 scorer whose names are the Qdrant point ids
+            collection_name: Qdrant collection to search
+            embedding_model: Embedding model used for the collection
+            candidates: Number of hits kept from each retriever before fusion
+            rrf_k: Reciprocal-rank fusion constant
+            embedding_cache: Cache used to embed queries instead of calling the client directly
+        """
+        self.client = client
+        self.qdrant_client = qdrant_client
+        self.bm25 = bm25
+        self.collection_name = collection_name
+        self.embedding_model = embedding_model
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.embedding_cache = embedding_cache
+
+    def embed_query(self, query: str) -> List[float]:
+        with span("embed_query"):
+            if self.embedding_cache is not None:
+                return self.embedding_cache.embed(query).tolist()
+            count("api_calls.embeddings")
+            return self.client.embeddings.create(
+                model=self.embedding_model,
+                inputs=[query],
+            ).data[0].embedding
+
+    async def aembed_query(self, query: str) -> List[float]:
+        with span("embed_query"):
+            if self.embedding_cache is not None:
+                return (await self.embedding_cache.aembed(query)).tolist()
+            count("api_calls.embeddings")
+            response = await self.client.embeddings.create_async(
+                model=self.embedding_model,
+                inputs=[query],
+            )
+            return response.data[0].embedding
+
+    def _dense_candidates(self, query_embedding: List[float]) -> List[ScoredPoint]:
+        with span("vector_search"):
+            return self.qdrant_client.query_points(
+                collection_name=self.collection_name,
+                query=query_embedding,
+                limit=self.candidates,
+                with_payload=True,
+            ).points
+
+    def _sparse_candidates(self, query: str) -> List[str]:
+        with span("bm25"):
+            sparse_indices, _ = self.bm25.top_k(self.bm25.tokenize(query), self.candidates)
+            return [self.bm25.names[i] for i in sparse_indices]
+
+    def _fuse(self, dense_points: List[ScoredPoint], sparse_ids: List[str], top_k: int) -> List[ScoredPoint]:
+        fused = reciprocal_rank_fusion(
+            [[str(point.id) for point in dense_points], sparse_ids],
+            k=self.rrf_k,
+        )
+        best_ids = list(fused)[:top_k]
+
+        # Only BM25-only hits need their payload fetched
+        payloads = {str(point.id): point.payload for point in dense_points}
+        missing_ids = [point_id for point_id in best_ids if point_id not in payloads]
+        if missing_ids:
+            for record in self.qdrant_client.retrieve(
+                collection_name=self.collection_name, ids=missing_ids, with_payload=True
+            ):
+                payloads[str(record.id)] = record.payload
+
+        return [
+            ScoredPoint(id=point_id, version=0, score=fused[point_id], payload=payloads.get(point_id))
+            for point_id in best_ids
+        ]
+
+    def retrieve(self, query: str, top_k: int = 2,
+                 query_embedding: Optional[List[float]] = None) -> List[ScoredPoint]:
+        """
+        Retrieve the best passages for a query.
+
+        Args:
+            query: User question
+            top_k: Number of passages to return
+            query_embedding: Precomputed query embedding, skips the embedding call
+
+        Returns:
+            List of points with their payload (text, file_name, date) and fused score, best first
+        """
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        dense_points = self._dense_candidates(query_embedding)
+        return self._fuse(dense_points, self._sparse_candidates(query), top_k)
+
+    def start_sparse_search(self, query: str) -> "asyncio.Task[List[str]]":
+        """
+        Start the BM25 search of a query in a worker thread, to overlap it with the embedding
+        call of the caller. The task can be given to aretrieve.
+        """
+        return asyncio.create_task(asyncio.to_thread(self._sparse_candidates, query))
+
+    async def aretrieve(self, query: str, top_k: int = 2,
+                        query_embedding: Optional[List[float]] = None,
+                        sparse_task: Optional["asyncio.Task[List[str]]"] = None) -> List[ScoredPoint]:
+        """
+        Asyncio equivalent of retrieve. BM25 runs in a worker thread while the query is
+        embedded, and the local Qdrant search runs off the event loop.
+
+        Args:
+            sparse_task: BM25 search already started by start_sparse_search
+        """
+        if sparse_task is None:
+            sparse_task = self.start_sparse_search(query)
+        try:
+            if query_embedding is None:
+                query_embedding = await self.aembed_query(query)
+            dense_points = await asyncio.to_thread(self._dense_candidates, query_embedding)
+        except BaseException:
+            sparse_task.cancel()
+            raise
+        sparse_ids = await sparse_task
+        return await asyncio.to_thread(self._fuse, dense_points, sparse_ids, top_k)
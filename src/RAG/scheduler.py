@@ -0,0 +1,309 @@
+"""
+Scheduler - Adaptive rate-limited execution of bulk API jobs
+This module runs many asyncio jobs (question generation, QA synthesis, embeddings,
+evaluation) against a rate-limited API at the highest sustainable rate. Requests are paced
+by a token bucket and capped in concurrency. The rate is halved when 429 responses come
+back, with the Retry-After header honoured, and grows back step by step while requests succeed.
+Failed requests are retried with exponential backoff. Completed job results are appended
+to a JSONL checkpoint, so an interrupted run resumes where it stopped.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+# HTTP statuses worth retrying, 429 additionally slows the request rate down
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _response(error: BaseException) -> Any:
+    # A requests.Response of an error status is falsy, so compare with None
+    response = getattr(error, "response", None)
+    return response if response is not None else getattr(error, "raw_response", None)
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """
+    HTTP status of an API error, from the Mistral SDK, httpx or requests
+
+    Returns:
+        The status code, None when the error carries no HTTP response
+    """
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(_response(error), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    Delay in seconds requested by the Retry-After header of an API error, if any
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(_response(error), "headers", None)
+    if not headers:
+        return None
+    try:
+        return max(0.0, float(headers.get("retry-after") or headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether a failed request may succeed when sent again: rate limits, server errors, timeouts
+    """
+    code = status_code(error)
+    if code is not None:
+        return code in RETRY_STATUSES
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError, TimeoutError)) \
+        or type(error).__name__ in ("TimeoutException", "ConnectTimeout", "ReadTimeout", "ConnectError",
+                                    "RemoteProtocolError")
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at an adjustable rate, one token per request.
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens, i.e. the largest burst, one second of rate by default
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float) -> None:
+        self._refill()
+        self.rate = rate
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hand out no token for a while, e.g. the Retry-After delay of a 429 response
+        """
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimitedScheduler:
+    """
+    Run an async function over many items under a rate limit that adapts to 429 responses.
+    """
+    def __init__(self, rate: float = 5.0, max_concurrency: int = 8, max_retries: int = 5,
+                 min_rate: float = 0.2, max_rate: Optional[float] = None, backoff_factor: float = 0.5,
+                 rate_step: Optional[float] = None, base_delay: float = 1.0, max_delay: float = 60.0,
+                 checkpoint_path: Optional[str] = None, burst: Optional[float] = None):
+        """
+        Args:
+            rate: Initial number of requests started per second
+            max_concurrency: Maximum number of requests in flight
+            max_retries: Number of times a failed job is sent again before giving up
+            min_rate: Rate below which 429 responses no longer slow the requests down
+            max_rate: Rate the scheduler may grow to, four times the initial rate by default
+            backoff_factor: Multiplier of the rate on a 429 response
+            rate_step: Rate added per second of successful requests, a tenth of the initial rate
+                by default
+            base_delay: Delay in seconds before the first retry, doubled on each further retry
+            max_delay: Maximum delay in seconds between two attempts of a job
+            checkpoint_path: JSONL file of the completed results, None to keep them in memory only
+            burst: Largest number of requests started at once, one second of rate by default
+        """
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else 4 * rate
+        self.backoff_factor = backoff_factor
+        self.rate_step = rate_step if rate_step is not None else rate / 10
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.checkpoint_path = checkpoint_path
+        self.burst = burst
+        self.rate = rate
+        self.results: Dict[str, Any] = self._load_checkpoint()
+        self.errors: Dict[str, str] = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._bucket: Optional[TokenBucket] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._last_backoff = 0.0
+        self._file_lock = threading.Lock()
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        results = {}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a run interrupted while writing
+                        continue
+                    results[record["key"]] = record["result"]
+        return results
+
+    def _checkpoint(self, key: str, result: Any) -> None:
+        self.results[key] = result
+        if self.checkpoint_path:
+            with self._file_lock:
+                with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "result": result}, ensure_ascii=False, default=str) + "\n")
+
+    def _on_success(self) -> None:
+        # About rate successes arrive per second, so the rate grows by rate_step per second
+        self.rate = min(self.max_rate, self.rate + self.rate_step / self.rate)
+        self._bucket.set_rate(self.rate)
+
+    def _on_rate_limited(self, error: BaseException) -> None:
+        self.rate_limited += 1
+        # The requests in flight when the limit was hit fail together, slow down once for all of them
+        now = time.monotonic()
+        if now - self._last_backoff > max(1.0, 1.0 / self.rate):
+            self._last_backoff = now
+            self.rate = max(self.min_rate, self.rate * self.backoff_factor)
+            self._bucket.set_rate(self.rate)
+        self._bucket.pause(retry_after(error) or 1.0 / self.rate)
+
+    def _limiters(self) -> Tuple[TokenBucket, asyncio.Semaphore]:
+        # asyncio primitives belong to one event loop, a new asyncio.run gets new ones
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._bucket = TokenBucket(self.rate, self.burst)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._bucket, self._semaphore
+
+    async def acall(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Send one request under the rate limit and concurrency cap, retrying it on failure
+
+        Args:
+            fn: Coroutine function sending the request, e.g. client.chat.parse_async
+            *args, **kwargs: Arguments of fn
+
+        Returns:
+            The result of fn
+
+        Raises:
+            The error of the last attempt once the retries are exhausted or the error is final
+        """
+        bucket, semaphore = self._limiters()
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            self.requests += 1
+            try:
+                async with semaphore:
+                    result = await fn(*args, **kwargs)
+            except Exception as e:
+                if status_code(e) == 429:
+                    self._on_rate_limited(e)
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                self.retries += 1
+                if status_code(e) != 429:
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                continue
+            self._on_success()
+            return result
+
+    async def arun(self, fn: Callable[[Any], Awaitable[Any]], items: Sequence[Any],
+                   key: Optional[Callable[[Any], Hashable]] = None, desc: Optional[str] = None,
+                   paced: bool = True) -> List[Any]:
+        """
+        Apply an async function to every item, skipping the items already in the checkpoint
+
+        Args:
+            fn: Coroutine function processing an item
+            items: Items to process
+            key: Function giving the checkpoint key of an item, the item itself (JSON encoded
+                unless a string) by default. Keys must be unique and stable across runs
+            desc: Description of a tqdm progress bar, None for no progress bar
+            paced: fn sends one request and is called through acall. Set to False when fn
+                sends several requests itself, each through acall
+
+        Returns:
+            Result of every item in the order of items, None for the items that failed
+        """
+        key = key or (lambda item: item)
+        keys = [value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, sort_keys=True, default=str)
+                for value in map(key, items)]
+        pending = [(item, item_key) for item, item_key in zip(items, keys) if item_key not in self.results]
+        skipped = len(items) - len(pending)
+        if skipped:
+            print(f"{skipped} of {len(items)} jobs already completed")
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in pending:
+            self.errors.pop(job[1], None)
+            queue.put_nowait(job)
+        progress = None
+        if desc is not None:
+            from tqdm.auto import tqdm
+            progress = tqdm(total=len(pending), desc=desc)
+
+        async def worker() -> None:
+            while not queue.empty():
+                item, item_key = queue.get_nowait()
+                try:
+                    result = await (self.acall(fn, item) if paced else fn(item))
+                except Exception as e:
+                    self.errors[item_key] = f"{type(e).__name__}: {e}"
+                    print(f"Job {item_key[:80]} failed: {e}")
+                else:
+                    self._checkpoint(item_key, result)
+                if progress is not None:
+                    progress.update(1)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.max_concurrency, len(pending)))))
+        finally:
+            if progress is not None:
+                progress.close()
+        return [self.results.get(item_key) for item_key in keys]
+
+    def run(self, fn: Callable[[Any], Awaitable[Any]], items: Sequence[Any],
+            key: Optional[Callable[[Any], Hashable]] = None, desc: Optional[str] = None,
+            paced: bool = True) -> List[Any]:
+        """
+        Blocking equivalent of arun, for scripts without a running event loop.
+        """
+        return asyncio.run(self.arun(fn, items, key=key, desc=desc, paced=paced))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dictionary with the requests sent, 429 responses, retries, completed and failed
+            jobs, and the current rate in requests per second
+        """
+        return {"requests": self.requests, "rate_limited": self.rate_limited, "retries": self.retries,
+                "completed": len(self.results), "failed": len(self.errors), "rate": round(self.rate, 3)}
@@ -0,0 +1,226 @@
+"""
+Sparse BM25 - Inverted-index BM25 scorer
+This module provides a BM25Okapi-compatible scorer backed by a CSR inverted index
+(postings stored as NumPy arrays) with vectorized accumulation and an exact
+block-max MaxScore top-k search that only touches the postings it needs.
+"""
+import numpy as np
+from collections import Counter
+from typing import Any, List, Sequence, Tuple
+
+from bm25_index import BM25Index, tokenize
+
+
+class SparseBM25:
+    """
+    BM25 scorer over a term-major inverted index.
+
+    Postings of term t span post_docs[term_indptr[t]:term_indptr[t + 1]], sorted by
+    document, and impacts holds the precomputed BM25 contribution of each posting.
+    Each posting list is cut in blocks of block_size postings whose maximum impact
+    and last document are kept to bound scores during top-k search.
+    """
+    def __init__(self, index: BM25Index, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                 block_size: int = 64):
+        self.names = index.names
+        self.term_to_id = index.term_to_id
+        self.tokenizer = index.tokenizer
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        self.block_size = block_size
+
+        num_docs = index.num_docs
+        num_terms = len(index.vocab)
+        doc_lens = np.asarray(index.doc_lens, dtype=np.float64)
+        term_ids = np.asarray(index.term_ids)
+        self.corpus_size = num_docs
+        self.doc_len = doc_lens
+        self.avgdl = float(doc_lens.sum()) / num_docs
+
+        # Transpose the document-major index; the stable sort keeps documents ascending in each posting list
+        doc_of_posting = np.repeat(np.arange(num_docs, dtype=np.int32), np.diff(index.doc_indptr))
+        order = np.argsort(term_ids, kind="stable")
+        self.post_docs = doc_of_posting[order]
+        term_freqs = np.asarray(index.term_freqs, dtype=np.float64)[order]
+        posting_terms = term_ids[order]
+
+        document_frequencies = np.bincount(term_ids, minlength=num_terms)
+        self.term_indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(document_frequencies, out=self.term_indptr[1:])
+
+        # Same idf as rank_bm25: negative values are floored to epsilon * average idf
+        idf = np.log(num_docs - document_frequencies + 0.5) - np.log(document_frequencies + 0.5)
+        average_idf = idf.sum() / num_terms if num_terms else 0.0
+        idf[idf < 0] = epsilon * average_idf
+        self.idf = idf
+
+        length_norm = k1 * (1 - b + b * doc_lens / self.avgdl)
+        self.impacts = idf[posting_terms] * (term_freqs * (k1 + 1) / (term_freqs + length_norm[self.post_docs]))
+        self._pruning_safe = bool(len(self.impacts) == 0 or self.impacts.min() >= 0)
+
+        # Block-max metadata
+        blocks_per_term = -(-document_frequencies // block_size)
+        self.block_indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(blocks_per_term, out=self.block_indptr[1:])
+        block_rank = np.arange(self.block_indptr[-1]) - np.repeat(self.block_indptr[:-1], blocks_per_term)
+        block_starts = np.repeat(self.term_indptr[:-1], blocks_per_term) + block_rank * block_size
+        block_ends = np.minimum(block_starts + block_size, np.repeat(self.term_indptr[1:], blocks_per_term))
+        if len(block_starts):
+            self.block_max = np.maximum.reduceat(self.impacts, block_starts)
+            self.term_max = np.maximum.reduceat(self.block_max, self.block_indptr[:-1])
+        else:
+            self.block_max = np.empty(0)
+            self.term_max = np.empty(0)
+        self.block_last_doc = self.post_docs[block_ends - 1]
+
+    def _query_terms(self, query: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        counts = Counter(token for token in query if token in self.term_to_id)
+        term_ids = np.fromiter((self.term_to_id[token] for token in counts), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        return term_ids, weights
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.term_indptr[term_id], self.term_indptr[term_id + 1]
+        return self.post_docs[start:end], self.impacts[start:end]
+
+    def tokenize(self, text: str) -> List[str]:
+        """
+        Tokenize a query with the tokenizer of the index.
+        """
+        return tokenize(text, self.tokenizer)
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        """
+        Score every document for a tokenized query, like BM25Okapi.get_scores.
+
+        Args:
+            query: Query tokens
+
+        Returns:
+            Array of scores indexed by document
+        """
+        term_ids, weights = self._query_terms(query)
+        if not len(term_ids):
+            return np.zeros(self.corpus_size)
+        postings = [self._postings(term_id) for term_id in term_ids]
+        docs = np.concatenate([p_docs for p_docs, _ in postings])
+        values = np.concatenate([p_impacts * weight for (_, p_impacts), weight in zip(postings, weights)])
+        return np.bincount(docs, weights=values, minlength=self.corpus_size)
+
+    def get_batch_scores(self, query: Sequence[str], doc_ids: Sequence[int]) -> List[float]:
+        """
+        Score a subset of documents, like BM25Okapi.get_batch_scores.
+
+        Args:
+            query: Query tokens
+            doc_ids: Indices of the documents to score
+
+        Returns:
+            List of scores in the order of doc_ids
+        """
+        return self._lookup_scores(query, np.asarray(doc_ids, dtype=np.int32)).tolist()
+
+    def _lookup_scores(self, query: Sequence[str], doc_ids: np.ndarray) -> np.ndarray:
+        scores = np.zeros(len(doc_ids))
+        term_ids, weights = self._query_terms(query)
+        for term_id, weight in zip(term_ids, weights):
+            p_docs, p_impacts = self._postings(term_id)
+            scores += weight * self._lookup(p_docs, p_impacts, doc_ids)
+        return scores
+
+    @staticmethod
+    def _lookup(p_docs: np.ndarray, p_impacts: np.ndarray, doc_ids: np.ndarray) -> np.ndarray:
+        positions = np.searchsorted(p_docs, doc_ids)
+        positions_clipped = np.minimum(positions, len(p_docs) - 1)
+        found = (positions < len(p_docs)) & (p_docs[positions_clipped] == doc_ids)
+        return np.where(found, p_impacts[positions_clipped], 0.0)
+
+    def _block_bounds(self, term_id: int, doc_ids: np.ndarray) -> np.ndarray:
+        block_start, block_end = self.block_indptr[term_id], self.block_indptr[term_id + 1]
+        blocks = np.searchsorted(self.block_last_doc[block_start:block_end], doc_ids)
+        inside = blocks < block_end - block_start
+        return np.where(inside, self.block_max[block_start + np.minimum(blocks, block_end - block_start - 1)], 0.0)
+
+    def top_k(self, query: Sequence[str], k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the k best documents for a tokenized query without scoring the whole corpus.
+
+        Terms are processed by decreasing score upper bound. Their posting lists are merged
+        until documents absent from the candidates can no longer reach the top k; the
+        remaining terms are then only looked up for candidates whose block-max bound can
+        still beat the current k-th score. Only documents matching at least one query
+        term are returned.
+
+        Args:
+            query: Query tokens
+            k: Number of documents to return
+
+        Returns:
+            Tuple containing document indices and their scores, best first
+        """
+        term_ids, weights = self._query_terms(query)
+        if not len(term_ids) or k <= 0:
+            return np.empty(0, dtype=np.int32), np.empty(0)
+        if not self._pruning_safe:
+            scores = self.get_scores(query)
+            return self._select(np.flatnonzero(scores), scores[scores != 0], k)
+
+        upper_bounds = weights * self.term_max[term_ids]
+        order = np.argsort(-upper_bounds)
+        term_ids, weights, upper_bounds = term_ids[order], weights[order], upper_bounds[order]
+        remaining_bounds = np.append(np.cumsum(upper_bounds[::-1])[::-1], 0.0)
+
+        cand_docs = np.empty(0, dtype=np.int32)
+        cand_scores = np.empty(0)
+        i = 0
+        while i < len(term_ids):
+            if len(cand_docs) >= k and remaining_bounds[i] <= self._kth_score(cand_scores, k):
+                break
+            p_docs, p_impacts = self._postings(term_ids[i])
+            cand_docs, inverse = np.unique(np.concatenate([cand_docs, p_docs]), return_inverse=True)
+            cand_scores = np.bincount(inverse, weights=np.concatenate([cand_scores, p_impacts * weights[i]]))
+            i += 1
+
+        if i < len(term_ids):
+            bounds = np.stack([
+                weight * self._block_bounds(term_id, cand_docs)
+                for term_id, weight in zip(term_ids[i:], weights[i:])
+            ])
+            bound_left = bounds.sum(axis=0)
+            for row, (term_id, weight) in enumerate(zip(term_ids[i:], weights[i:])):
+                keep = cand_scores + bound_left >= self._kth_score(cand_scores, k)
+                cand_docs, cand_scores = cand_docs[keep], cand_scores[keep]
+                bounds, bound_left = bounds[:, keep], bound_left[keep]
+                p_docs, p_impacts = self._postings(term_id)
+                cand_scores = cand_scores + weight * self._lookup(p_docs, p_impacts, cand_docs)
+                bound_left = bound_left - bounds[row]
+
+        return self._select(cand_docs, cand_scores, k)
+
+    @staticmethod
+    def _kth_score(scores: np.ndarray, k: int) -> float:
+        if len(scores) < k:
+            return -np.inf
+        return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+    @staticmethod
+    def _select(doc_ids: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            doc_ids, scores = doc_ids[best], scores[best]
+        order = np.argsort(-scores, kind="stable")
+        return doc_ids[order], scores[order]
+
+    def get_top_n(self, query: Sequence[str], documents: Sequence[Any], n: int = 5) -> List[Any]:
+        """
+        Return the n best documents, like BM25Okapi.get_top_n.
+
+        Args:
+            query: Query tokens
+            documents: Documents aligned with the index
+            n: Number of documents to return
+
+        Returns:
+            List of the best documents
+        """
+        doc_ids, _ = self.top_k(query, n)
+        return [documents[i] for i in doc_ids]
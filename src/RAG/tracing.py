@@ -0,0 +1,359 @@
+"""
+Tracing - Per-stage latency spans and counters for the chat pipeline
+This module records one span per pipeline stage (intent detection, query embedding,
+vector search, BM25, completion, tool calls, image diagnosis) tagged with the id of the
+request it belongs to, together with counters such as API calls and cache hits. Span
+durations feed per-stage histograms exported in the Prometheus text format, and spans can
+be appended to a JSONL file by a background thread that writes them in batches. When
+tracing is disabled a span is a shared no-op object, so instrumented code pays a single
+attribute check.
+
+Tracing is enabled with get_tracer().enable() or the AGROFLOW_TRACING=1 environment variable.
+"""
+import os
+import json
+import time
+import uuid
+import atexit
+import bisect
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_request_id: contextvars.ContextVar = contextvars.ContextVar("agroflow_request_id", default=None)
+_tracer = None
+
+
+class _NullSpan:
+    """
+    Span returned while tracing is disabled.
+    """
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+    def set(self, **attributes) -> None:
+        return None
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Timed stage of a request, recorded by its tracer when it ends.
+    """
+    __slots__ = ("tracer", "stage", "attributes", "request_id", "start", "_start_counter")
+
+    def __init__(self, tracer: "Tracer", stage: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.stage = stage
+        self.attributes = attributes
+        self.request_id = _request_id.get()
+
+    def __enter__(self) -> "Span":
+        self.start = time.time()
+        self._start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        duration = time.perf_counter() - self._start_counter
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer._record(self, duration)
+
+    def set(self, **attributes) -> None:
+        """
+        Add attributes known only once the stage ran, e.g. the source of an intent.
+        """
+        self.attributes.update(attributes)
+
+
+class Histogram:
+    """
+    Cumulative latency histogram of one stage.
+    """
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate the q quantile by linear interpolation inside its bucket, as Prometheus does
+        """
+        if self.count == 0:
+            return 0.0
+        rank, cumulative, lower = q * self.count, 0, 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        # Beyond the last bucket the largest finite bound is the best estimate
+        return self.buckets[-1]
+
+
+class Tracer:
+    """
+    Collector of spans, per-stage histograms and counters.
+    """
+    def __init__(self, enabled: bool = False, jsonl_path: Optional[str] = None, max_spans: int = 10000,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, flush_interval: float = 1.0, flush_size: int = 256):
+        """
+        Args:
+            enabled: Record spans and counters
+            jsonl_path: File every finished span is appended to, None to keep them in memory only
+            max_spans: Number of recent spans kept in memory
+            buckets: Upper bounds in seconds of the histogram buckets
+            flush_interval: Seconds between two writes of the finished spans to jsonl_path
+            flush_size: Number of unwritten spans that triggers a write before the interval ends
+        """
+        self.enabled = enabled
+        self.jsonl_path = jsonl_path
+        self.buckets = tuple(buckets)
+        self.spans = deque(maxlen=max_spans)
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self._stats_sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # Spans waiting to be appended to jsonl_path by the flush thread
+        self._unwritten: List[Dict[str, Any]] = []
+        self._flush_requested = threading.Event()
+        self._file_lock = threading.Lock()
+        self._flush_thread: Optional[threading.Thread] = None
+
+    def enable(self, jsonl_path: Optional[str] = None) -> None:
+        self.enabled = True
+        if jsonl_path is not None:
+            self.jsonl_path = jsonl_path
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def span(self, stage: str, **attributes) -> Any:
+        """
+        Time a stage of the current request
+
+        Args:
+            stage: Stage name, e.g. "vector_search"
+            **attributes: Attributes recorded with the span
+
+        Returns:
+            Context manager whose set(**attributes) adds attributes while the stage runs
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, stage, attributes)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Increment a counter, e.g. "api_calls.chat_completion"
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def register_stats(self, prefix: str, stats_fn: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Export the numeric values of a component's stats() with the metrics, e.g. cache hits
+
+        Args:
+            prefix: Metric name prefix, e.g. "embedding_cache"
+            stats_fn: Function returning the component statistics
+        """
+        self._stats_sources[prefix] = stats_fn
+
+    @contextmanager
+    def request(self, request_id: Optional[str] = None) -> Iterator[str]:
+        """
+        Tag the spans of a block, and of the tasks and threads it starts, with a request id
+
+        Args:
+            request_id: Id of the request, a new one by default
+
+        Yields:
+            The request id
+        """
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = _request_id.set(request_id)
+        try:
+            yield request_id
+        finally:
+            try:
+                _request_id.reset(token)
+            except ValueError:
+                # An async generator resumed in another context cannot reset the token
+                _request_id.set(None)
+
+    def _record(self, span: Span, duration: float) -> None:
+        record = {"request_id": span.request_id, "stage": span.stage, "start": span.start,
+                  "duration_ms": round(1000 * duration, 3), **span.attributes}
+        with self._lock:
+            histogram = self.histograms.get(span.stage)
+            if histogram is None:
+                histogram = self.histograms[span.stage] = Histogram(self.buckets)
+            histogram.observe(duration)
+            self.spans.append(record)
+            if self.jsonl_path is None:
+                return
+            self._unwritten.append(record)
+            if len(self._unwritten) >= self.flush_size:
+                self._flush_requested.set()
+            if self._flush_thread is None:
+                self._flush_thread = threading.Thread(target=self._flush_loop, name="tracing-flush", daemon=True)
+                self._flush_thread.start()
+                # The daemon thread dies with the interpreter, the last spans are written at exit
+                atexit.register(self.flush)
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Could not write the spans to {self.jsonl_path}: {e}")
+
+    def flush(self) -> int:
+        """
+        Append the spans not written yet to jsonl_path, done by a background thread every
+        flush_interval seconds
+
+        Returns:
+            Number of spans written
+        """
+        with self._file_lock:
+            with self._lock:
+                records, self._unwritten = self._unwritten, []
+                jsonl_path = self.jsonl_path
+            if not records or jsonl_path is None:
+                return 0
+            with open(jsonl_path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records))
+        return len(records)
+
+    def _component_stats(self) -> Dict[str, float]:
+        values = {}
+        for prefix, stats_fn in self._stats_sources.items():
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                print(f"Could not read the {prefix} statistics: {e}")
+                continue
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{prefix}_{key}"] = value
+        return values
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dictionary with, per stage, the number of spans, mean and estimated p50/p95/p99
+            in ms, and the counters and component statistics
+        """
+        with self._lock:
+            stages = {
+                stage: {
+                    "count": histogram.count,
+                    "mean_ms": 1000 * histogram.sum / histogram.count if histogram.count else 0.0,
+                    **{f"p{int(q * 100)}_ms": 1000 * histogram.quantile(q) for q in (0.5, 0.95, 0.99)},
+                }
+                for stage, histogram in self.histograms.items()
+            }
+            counters = dict(self.counters)
+        return {"stages": stages, "counters": counters, "components": self._component_stats()}
+
+    def prometheus(self, namespace: str = "agroflow") -> str:
+        """
+        Render the histograms, counters and component statistics in the Prometheus text format
+
+        Args:
+            namespace: Prefix of every metric name
+
+        Returns:
+            Exposition text, e.g. served on a /metrics endpoint
+        """
+        metric = lambda name: f"{namespace}_" + "".join(c if c.isalnum() else "_" for c in name)
+        lines = [f"# TYPE {namespace}_stage_duration_seconds histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{namespace}_stage_duration_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{namespace}_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{namespace}_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'{namespace}_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+            counters = dict(self.counters)
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {metric(name)}_total counter")
+            lines.append(f"{metric(name)}_total {value:g}")
+        for name, value in sorted(self._component_stats().items()):
+            lines.append(f"# TYPE {metric(name)} gauge")
+            lines.append(f"{metric(name)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def export_jsonl(self, file_path: str) -> int:
+        """
+        Write the spans kept in memory to a JSONL file
+
+        Returns:
+            Number of spans written
+        """
+        with self._lock:
+            spans = list(self.spans)
+        with open(file_path, "w", encoding="utf-8") as f:
+            for record in spans:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        return len(spans)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans.clear()
+            self.histograms.clear()
+            self.counters.clear()
+
+
+def get_tracer() -> Tracer:
+    """
+    Get the tracer shared by every instrumented module
+
+    Returns:
+        Tracer, enabled when the AGROFLOW_TRACING environment variable is 1
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(enabled=os.getenv("AGROFLOW_TRACING") == "1", jsonl_path=os.getenv("AGROFLOW_TRACING_FILE"))
+    return _tracer
+
+
+def span(stage: str, **attributes) -> Any:
+    """
+    Time a stage with the shared tracer, see Tracer.span
+    """
+    return get_tracer().span(stage, **attributes)
+
+
+def count(name: str, value: float = 1) -> None:
+    """
+    Increment a counter of the shared tracer, see Tracer.count
+    """
+    get_tracer().count(name, value)
+
@@ -0,0 +1,369 @@
+"""
+Vector Index - In-process exact and IVF vector search
+This module answers the query_points / query_batch_points / retrieve calls the retrieval
+code makes to Qdrant, directly over the document embeddings in NumPy. Small collections
+are searched exactly with one matrix product; large ones use an inverted file (IVF) of
+k-means clusters of which only the closest lists are scanned. Keyword payload fields such
+as file_name get precomputed bitmaps, so a MatchAny filter becomes a boolean mask.
+"""
+import time
+import argparse
+import numpy as np
+from qdrant_client.http.models import (
+    FieldCondition, Filter, MatchAny, MatchValue, QueryRequest, QueryResponse, Record, ScoredPoint
+)
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Below this many vectors an exact search is as fast as probing clusters
+IVF_MIN_VECTORS = 20000
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    # Indices of the k best scores of each row, best first
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+class VectorCollection:
+    """
+    Cosine similarity search over one collection, exact or through an inverted file.
+    """
+    def __init__(self, ids: Sequence[str], vectors: np.ndarray, payloads: Sequence[Dict[str, Any]],
+                 mode: str = "auto", nlist: Optional[int] = None, nprobe: int = 32,
+                 indexed_fields: Sequence[str] = ("file_name",), seed: int = 0):
+        """
+        Args:
+            ids: Point ids
+            vectors: (n, dim) vectors, used without copy when they are float32 and unit norm
+            payloads: Payload of each point
+            mode: "exact", "ivf", or "auto" to use IVF from IVF_MIN_VECTORS vectors on
+            nlist: Number of IVF clusters, about 2 * sqrt(n) by default
+            nprobe: Number of clusters scanned per query in IVF mode
+            indexed_fields: Payload fields whose value bitmaps are precomputed
+            seed: Seed of the k-means initialization
+        """
+        if mode not in ("auto", "exact", "ivf"):
+            raise ValueError(f"Unknown search mode {mode}, expected auto, exact or ivf")
+        self.ids = [str(point_id) for point_id in ids]
+        self.payloads = list(payloads)
+        self.id_to_row = {point_id: row for row, point_id in enumerate(self.ids)}
+        vectors = np.asarray(vectors)
+        norms = np.linalg.norm(vectors[:min(len(vectors), 1024)].astype(np.float32), axis=1)
+        # Mistral embeddings are already unit norm, a memory-mapped store is then searched in place
+        if vectors.dtype == np.float32 and np.allclose(norms, 1.0, atol=1e-3):
+            self.vectors = vectors
+        else:
+            self.vectors = np.ascontiguousarray(_normalize_rows(vectors.astype(np.float32)))
+        self.nprobe = nprobe
+        self.mode = mode if mode != "auto" else ("ivf" if len(self.ids) >= IVF_MIN_VECTORS else "exact")
+        self._bitmaps: Dict[str, Dict[Any, np.ndarray]] = {}
+        for field in indexed_fields:
+            self._bitmap_index(field)
+        self.centroids: Optional[np.ndarray] = None
+        if self.mode == "ivf":
+            self._train_ivf(nlist or max(1, int(2 * np.sqrt(len(self.ids)))), seed)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _bitmap_index(self, field: str) -> Dict[Any, np.ndarray]:
+        bitmaps = self._bitmaps.get(field)
+        if bitmaps is None:
+            values = [payload.get(field) for payload in self.payloads]
+            bitmaps = {}
+            for row, value in enumerate(values):
+                if value is not None:
+                    bitmaps.setdefault(value, np.zeros(len(values), dtype=bool))[row] = True
+            self._bitmaps[field] = bitmaps
+        return bitmaps
+
+    def _train_ivf(self, nlist: int, seed: int, iterations: int = 8, sample_size: int = 16384) -> None:
+        # Spherical k-means on a sample, then every vector is assigned to its closest centroid
+        rng = np.random.default_rng(seed)
+        nlist = min(nlist, len(self.ids))
+        sample = self.vectors[np.sort(rng.choice(len(self.ids), min(sample_size, len(self.ids)), replace=False))]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].astype(np.float32)
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            # Cluster sums as one-hot matrix products, a block of the sample at a time
+            sums = np.zeros_like(centroids)
+            for start in range(0, len(sample), 8192):
+                block = assignment[start:start + 8192]
+                one_hot = np.zeros((nlist, len(block)), dtype=np.float32)
+                one_hot[block, np.arange(len(block))] = 1.0
+                sums += one_hot @ sample[start:start + 8192]
+            # Empty clusters keep their previous centroid
+            empty = np.bincount(assignment, minlength=nlist) == 0
+            sums[empty] = centroids[empty]
+            centroids = _normalize_rows(sums)
+        self.centroids = np.ascontiguousarray(centroids)
+
+        assignment = np.concatenate([
+            np.argmax(self.vectors[start:start + sample_size] @ self.centroids.T, axis=1)
+            for start in range(0, len(self.ids), sample_size)
+        ])
+        # Rows grouped by cluster, list c being order[offsets[c]:offsets[c + 1]]
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+
+    def _condition_mask(self, condition: Any) -> np.ndarray:
+        if isinstance(condition, Filter):
+            return self.filter_mask(condition)
+        if not isinstance(condition, FieldCondition):
+            raise ValueError(f"Unsupported filter condition {type(condition).__name__}")
+        bitmaps = self._bitmap_index(condition.key)
+        if isinstance(condition.match, MatchAny):
+            values = condition.match.any
+        elif isinstance(condition.match, MatchValue):
+            values = [condition.match.value]
+        else:
+            raise ValueError(f"Unsupported match {type(condition.match).__name__} on {condition.key}")
+        mask = np.zeros(len(self.ids), dtype=bool)
+        for value in values:
+            bitmap = bitmaps.get(value)
+            if bitmap is not None:
+                mask |= bitmap
+        return mask
+
+    def filter_mask(self, query_filter: Optional[Filter]) -> Optional[np.ndarray]:
+        """
+        Turn a Qdrant filter on keyword fields into a boolean mask over the rows
+
+        Args:
+            query_filter: Filter with must, should and must_not field conditions, or None
+
+        Returns:
+            Boolean array of the rows matching the filter, None without filter
+        """
+        if query_filter is None:
+            return None
+        mask = np.ones(len(self.ids), dtype=bool)
+        as_list = lambda conditions: conditions if isinstance(conditions, list) else [conditions]
+        for condition in as_list(query_filter.must or []):
+            mask &= self._condition_mask(condition)
+        if query_filter.should:
+            should = np.zeros(len(self.ids), dtype=bool)
+            for condition in as_list(query_filter.should):
+                should |= self._condition_mask(condition)
+            mask &= should
+        for condition in as_list(query_filter.must_not or []):
+            mask &= ~self._condition_mask(condition)
+        return mask
+
+    def _exact(self, queries: np.ndarray, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        scores = queries @ vectors.T
+        top = _top_k(scores, k)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        return (top if rows is None else rows[top]), top_scores
+
+    def _ivf(self, query: np.ndarray, k: int, mask: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        lists = _top_k((query @ self.centroids.T)[None, :], self.nprobe)[0]
+        rows = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+        if mask is not None:
+            rows = rows[mask[rows]]
+        top, scores = self._exact(query[None, :], k, rows)
+        return top[0], scores[0]
+
+    def search(self, queries: np.ndarray, k: int = 10,
+               mask: Optional[np.ndarray] = None) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        Find the k nearest rows of several queries
+
+        Args:
+            queries: (q, dim) query vectors
+            k: Number of neighbours per query
+            mask: Boolean array of the rows allowed, see filter_mask
+
+        Returns:
+            Tuple containing, per query, the row indices and cosine similarities, best first
+        """
+        queries = _normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        rows = None if mask is None else np.flatnonzero(mask)
+        # A selective filter leaves fewer rows than the probed clusters would hold
+        selective = rows is not None and len(rows) <= self.nprobe * len(self.ids) / max(1, len(self.offsets) - 1) \
+            if self.mode == "ivf" else True
+        if self.mode == "exact" or selective:
+            top, scores = self._exact(queries, k, rows)
+            return list(top), list(scores)
+        results = [self._ivf(query, k, mask) for query in queries]
+        return [top for top, _ in results], [scores for _, scores in results]
+
+    def points(self, rows: np.ndarray, scores: np.ndarray, with_payload: bool = True) -> List[ScoredPoint]:
+        return [
+            ScoredPoint(id=self.ids[row], version=0, score=float(score),
+                        payload=self.payloads[row] if with_payload else None)
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+
+
+class LocalVectorIndex:
+    """
+    Drop-in for the QdrantClient calls of the retrieval code, over in-process collections.
+    """
+    def __init__(self, collections: Optional[Dict[str, VectorCollection]] = None):
+        self.collections: Dict[str, VectorCollection] = dict(collections or {})
+
+    @classmethod
+    def from_store(cls, store: Any, collection_name: str = "technical_reports", **kwargs) -> "LocalVectorIndex":
+        """
+        Build an index over an EmbeddingStore, see embedding_store
+
+        Args:
+            store: Embedding store
+            collection_name: Name under which the collection is queried
+            **kwargs: Options of VectorCollection (mode, nlist, nprobe, indexed_fields)
+
+        Returns:
+            LocalVectorIndex: Index with one collection
+        """
+        return cls({collection_name: VectorCollection(store.ids, store.vectors, store.payloads, **kwargs)})
+
+    def add_collection(self, collection_name: str, ids: Sequence[str], vectors: np.ndarray,
+                       payloads: Sequence[Dict[str, Any]], **kwargs) -> VectorCollection:
+        self.collections[collection_name] = VectorCollection(ids, vectors, payloads, **kwargs)
+        return self.collections[collection_name]
+
+    def _collection(self, collection_name: str) -> VectorCollection:
+        if collection_name not in self.collections:
+            raise ValueError(f"Collection {collection_name} not found")
+        return self.collections[collection_name]
+
+    def query_points(self, collection_name: str, query: Sequence[float], limit: int = 10,
+                     query_filter: Optional[Filter] = None, with_payload: bool = True, **kwargs) -> QueryResponse:
+        """
+        Same call as QdrantClient.query_points for a dense query vector.
+        """
+        collection = self._collection(collection_name)
+        top, scores = collection.search(np.asarray(query, dtype=np.float32), limit,
+                                        collection.filter_mask(query_filter))
+        return QueryResponse(points=collection.points(top[0], scores[0], with_payload))
+
+    def query_batch_points(self, collection_name: str, requests: Sequence[QueryRequest],
+                           **kwargs) -> List[QueryResponse]:
+        """
+        Same call as QdrantClient.query_batch_points, requests sharing a filter are scored
+        with a single matrix product.
+        """
+        collection = self._collection(collection_name)
+        responses: List[Optional[QueryResponse]] = [None] * len(requests)
+        groups: Dict[str, List[int]] = {}
+        for position, request in enumerate(requests):
+            key = request.filter.model_dump_json() if request.filter is not None else ""
+            groups.setdefault(key, []).append(position)
+        for positions in groups.values():
+            first = requests[positions[0]]
+            limit = max(requests[position].limit or 10 for position in positions)
+            queries = np.asarray([requests[position].query for position in positions], dtype=np.float32)
+            tops, scores = collection.search(queries, limit, collection.filter_mask(first.filter))
+            for position, top, score in zip(positions, tops, scores):
+                request = requests[position]
+                n = request.limit or 10
+                responses[position] = QueryResponse(
+                    points=collection.points(top[:n], score[:n], request.with_payload is not False)
+                )
+        return responses
+
+    def retrieve(self, collection_name: str, ids: Sequence[str], with_payload: bool = True, **kwargs) -> List[Record]:
+        """
+        Same call as QdrantClient.retrieve.
+        """
+        collection = self._collection(collection_name)
+        rows = [collection.id_to_row[str(point_id)] for point_id in ids if str(point_id) in collection.id_to_row]
+        return [Record(id=collection.ids[row], payload=collection.payloads[row] if with_payload else None)
+                for row in rows]
+
+    def count(self, collection_name: str, **kwargs) -> int:
+        return len(self._collection(collection_name))
+
+
+def recall_at_k(index: LocalVectorIndex, reference: Any, queries: np.ndarray, collection_name: str = "technical_reports",
+                k: int = 10, query_filter: Optional[Filter] = None) -> Dict[str, float]:
+    """
+    Compare the neighbours of the local index with those of a reference client, e.g. Qdrant
+
+    Args:
+        index: Local index
+        reference: Client with query_points holding the same collection
+        queries: (q, dim) query vectors
+        collection_name: Collection searched in both
+        k: Number of neighbours compared
+        query_filter: Filter applied in both searches
+
+    Returns:
+        Dictionary with the mean recall@k and the mean latency per query of both clients in ms
+    """
+    recalls, latencies = [], {"local": [], "reference": []}
+    for query in queries:
+        start = time.perf_counter()
+        local = index.query_points(collection_name, query.tolist(), limit=k, query_filter=query_filter).points
+        latencies["local"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        expected = reference.query_points(collection_name=collection_name, query=query.tolist(), limit=k,
+                                          query_filter=query_filter).points
+        latencies["reference"].append(time.perf_counter() - start)
+        expected_ids = {str(point.id) for point in expected}
+        if expected_ids:
+            recalls.append(len(expected_ids & {str(point.id) for point in local}) / len(expected_ids))
+    return {
+        f"recall@{k}": float(np.mean(recalls)) if recalls else 1.0,
+        "local_ms": 1000 * float(np.mean(latencies["local"])),
+        "reference_ms": 1000 * float(np.mean(latencies["reference"])),
+    }
+
+
+if __name__ == "__main__":
+    import uuid
+    from qdrant_client import QdrantClient
+    from qdrant_client.models import Batch, Distance, VectorParams
+    from embedding_store import load_embedding_store
+
+    parser = argparse.ArgumentParser(description="Benchmark the local vector index against Qdrant :memory:")
+    parser.add_argument("--embeddings-file", default="document_embeddings.pkl")
+    parser.add_argument("--synthetic", type=int, default=50000, help="Size of the synthetic corpus for IVF")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    def benchmark(name, ids, vectors, payloads, queries, query_filter=None, **kwargs):
+        qdrant = QdrantClient(":memory:")
+        qdrant.create_collection("bench", vectors_config=VectorParams(size=vectors.shape[1], distance=Distance.COSINE))
+        for start in range(0, len(ids), 1024):
+            qdrant.upsert("bench", points=Batch(ids=ids[start:start + 1024], vectors=vectors[start:start + 1024].tolist(),
+                                                 payloads=payloads[start:start + 1024]))
+        start = time.perf_counter()
+        index = LocalVectorIndex()
+        collection = index.add_collection("bench", ids, vectors, payloads, **kwargs)
+        build = time.perf_counter() - start
+        result = recall_at_k(index, qdrant, queries, "bench", k=args.k, query_filter=query_filter)
+        print(f"{name} ({collection.mode}, {len(ids)} vectors, built in {build:.2f}s): {result}")
+
+    store = load_embedding_store(args.embeddings_file)
+    vectors = store.matrix()
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    queries = queries + rng.normal(0, 0.02, queries.shape).astype(np.float32)
+    benchmark("documents", store.ids, vectors, store.payloads, queries)
+    file_names = sorted(set(store.column("file_name")))[:5]
+    benchmark("documents, file_name filter", store.ids, vectors, store.payloads, queries,
+              query_filter=Filter(must=[FieldCondition(key="file_name", match=MatchAny(any=file_names))]))
+
+    # Clustered synthetic corpus around the document vectors, large enough for IVF
+    centers = vectors[rng.integers(0, len(vectors), args.synthetic)]
+    synthetic = _normalize_rows(centers + rng.normal(0, 0.03, centers.shape).astype(np.float32))
+    synthetic_ids = [str(uuid.UUID(int=i)) for i in range(args.synthetic)]
+    synthetic_payloads = [{"file_name": f"doc-{i % 500}"} for i in range(args.synthetic)]
+    synthetic_queries = synthetic[rng.choice(args.synthetic, args.queries, replace=False)] \
+        + rng.normal(0, 0.02, (args.queries, synthetic.shape[1])).astype(np.float32)
+    benchmark("synthetic", synthetic_ids, synthetic, synthetic_payloads, synthetic_queries, mode="exact")
+    benchmark("synthetic", synthetic_ids, synthetic, synthetic_payloads, synthetic_queries, mode="ivf")
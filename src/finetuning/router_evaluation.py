@@ -0,0 +1,281 @@
+"""
+Router Evaluation - Concurrent evaluation of candidate intent router models
+This module scores router models on test.jsonl. Predictions are sent concurrently through
+the shared RateLimitedScheduler, in batches of inputs for the fine-tuned classifiers, and
+are cached per (model, question) in SQLite so that a re-run only queries new questions.
+The confusion matrix and the per-class precision, recall and F1 are computed in one
+vectorized pass.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence
+
+# The shared scheduler lives in src/RAG
+RAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RAG")
+if RAG_DIR not in sys.path:
+    sys.path.append(RAG_DIR)
+
+from scheduler import RateLimitedScheduler
+
+THEMES = ["market_question", "policy_help", "disease_diagnosis", "weather_management", "other"]
+DEFAULT_TEST_FILE = "test.jsonl"
+DEFAULT_CACHE_PATH = "router_predictions.sqlite"
+
+
+class Theme(BaseModel):
+    theme: Literal["market_question", "policy_help", "disease_diagnosis", "weather_management", "other"]
+
+
+def classification_prompt(question: str) -> str:
+    return (
+        "Classify the following question into one of the following themes: "
+        "'market_question', policy_help, disease_diagnosis, weather_management, other.\n\n"
+        f"Question: {question}\n\nTheme:"
+    )
+
+
+def load_test_set(file_path: str = DEFAULT_TEST_FILE) -> pd.DataFrame:
+    """
+    Read a classifier fine-tuning file as evaluation data
+
+    Args:
+        file_path: JSONL file with {"text": ..., "labels": {"intent": ...}} lines
+
+    Returns:
+        DataFrame with question and theme columns
+    """
+    rows = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                rows.append({"question": record["text"], "theme": record["labels"]["intent"]})
+    return pd.DataFrame(rows)
+
+
+def classification_report(y_true: Sequence[str], y_pred: Sequence[Optional[str]],
+                          labels: Sequence[str] = THEMES) -> Dict[str, Any]:
+    """
+    Compute the confusion matrix and the per-class and macro-averaged metrics
+
+    Args:
+        y_true: Expected labels
+        y_pred: Predicted labels, a prediction outside labels (or None) counts as an error
+        labels: Classes, in the order of the confusion matrix
+
+    Returns:
+        Dictionary with per_class precision, recall, f1 and support, macro_avg, accuracy, the
+        confusion matrix (rows expected, columns predicted) and the number of invalid predictions
+    """
+    index = {label: i for i, label in enumerate(labels)}
+    n = len(labels)
+    true_ids = np.array([index[label] for label in y_true], dtype=np.int64)
+    # Invalid predictions go to an extra column, so they lower the recall of their class
+    pred_ids = np.array([index.get(label, n) for label in y_pred], dtype=np.int64)
+    confusion = np.bincount(true_ids * (n + 1) + pred_ids, minlength=n * (n + 1)).reshape(n, n + 1)
+
+    tp = np.diag(confusion[:, :n]).astype(np.float64)
+    predicted = confusion[:, :n].sum(axis=0)
+    support = confusion.sum(axis=1)
+    precision = np.divide(tp, predicted, out=np.zeros(n), where=predicted > 0)
+    recall = np.divide(tp, support, out=np.zeros(n), where=support > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(n), where=precision + recall > 0)
+
+    return {
+        "per_class": {
+            label: {"precision": float(precision[i]), "recall": float(recall[i]), "f1": float(f1[i]),
+                    "support": int(support[i])}
+            for i, label in enumerate(labels)
+        },
+        "macro_avg": {"precision": float(precision.mean()), "recall": float(recall.mean()), "f1": float(f1.mean())},
+        "accuracy": float(tp.sum() / len(true_ids)) if len(true_ids) else 0.0,
+        "confusion": confusion[:, :n].tolist(),
+        "invalid_predictions": int(confusion[:, n].sum()),
+    }
+
+
+class PredictionCache:
+    """
+    SQLite store of the label predicted by each model for each question.
+    """
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS predictions (model TEXT, question TEXT, label TEXT, "
+            "PRIMARY KEY (model, question))"
+        )
+        self._db.commit()
+
+    def get_many(self, model: str, questions: Sequence[str]) -> Dict[str, str]:
+        found = {}
+        unique = list(dict.fromkeys(questions))
+        # SQLite limits the number of parameters of a query
+        for start in range(0, len(unique), 500):
+            batch = unique[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT question, label FROM predictions WHERE model = ? AND question IN ({','.join('?' * len(batch))})",
+                (model, *batch),
+            ).fetchall()
+            found.update(rows)
+        return found
+
+    def put_many(self, model: str, predictions: Dict[str, str]) -> None:
+        self._db.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                             [(model, question, label) for question, label in predictions.items()])
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class RouterEvaluator:
+    """
+    Evaluate and compare router models, remote classifiers, chat models or local functions.
+    """
+    def __init__(self, client: Any, cache_path: Optional[str] = DEFAULT_CACHE_PATH,
+                 scheduler: Optional[RateLimitedScheduler] = None, batch_size: int = 32,
+                 local_models: Optional[Dict[str, Callable[[str], str]]] = None):
+        """
+        Args:
+            client: Mistral client
+            cache_path: SQLite file of the cached predictions, None to cache in memory only
+            scheduler: Scheduler pacing the API requests, a new one by default
+            batch_size: Number of questions sent per request to fine-tuned classifiers
+            local_models: Functions returning the label of a question, by model name, e.g.
+                the local model of the intent router. Their predictions are not cached
+        """
+        self.client = client
+        self.cache = PredictionCache(cache_path or ":memory:")
+        self.scheduler = scheduler or RateLimitedScheduler(rate=5, max_concurrency=8)
+        self.batch_size = batch_size
+        self.local_models = dict(local_models or {})
+        self.cache_hits = 0
+        self.predicted = 0
+
+    async def _classify_batch(self, model: str, questions: List[str]) -> Dict[str, str]:
+        response = await self.scheduler.acall(self.client.classifiers.classify_async, model=model, inputs=questions)
+        labels = {}
+        for question, result in zip(questions, response.results):
+            scores = result['intent'].scores
+            labels[question] = max(scores, key=scores.get)
+        return labels
+
+    async def _chat_predict(self, model: str, question: str) -> Dict[str, str]:
+        response = await self.scheduler.acall(
+            self.client.chat.parse_async,
+            model=model,
+            messages=[{"role": "user", "content": classification_prompt(question)}],
+            response_format=Theme,
+        )
+        return {question: response.choices[0].message.parsed.theme}
+
+    async def _predict_and_cache(self, model: str, request: Any) -> None:
+        try:
+            predictions = await request
+        except Exception as e:
+            print(f"Prediction of {model} failed: {e}")
+            return
+        self.cache.put_many(model, predictions)
+        self.predicted += len(predictions)
+
+    async def apredict(self, model: str, questions: Sequence[str]) -> List[Optional[str]]:
+        """
+        Predict the label of every question, querying the model only for uncached questions
+
+        Args:
+            model: Model name, a fine-tuned classifier ("ft:classifier:..."), a chat model, or
+                a name of local_models
+            questions: Questions to classify
+
+        Returns:
+            Label of every question, None where the prediction failed
+        """
+        if model in self.local_models:
+            # Local models are cheap and change when retrained, they are not cached
+            predict = self.local_models[model]
+            self.predicted += len(questions)
+            return [predict(question) for question in questions]
+
+        cached = self.cache.get_many(model, questions)
+        self.cache_hits += sum(question in cached for question in questions)
+        missing = [question for question in dict.fromkeys(questions) if question not in cached]
+
+        if missing:
+            # Classifiers accept a list of inputs, chat models answer one question per request
+            if model.startswith("ft:classifier"):
+                requests = [self._classify_batch(model, missing[start:start + self.batch_size])
+                            for start in range(0, len(missing), self.batch_size)]
+            else:
+                requests = [self._chat_predict(model, question) for question in missing]
+            await asyncio.gather(*(self._predict_and_cache(model, request) for request in requests))
+
+        if missing:
+            cached = self.cache.get_many(model, questions)
+        return [cached.get(question) for question in questions]
+
+    async def aevaluate(self, model: str, test_df: pd.DataFrame, labels: Sequence[str] = THEMES) -> Dict[str, Any]:
+        """
+        Evaluate a model on a test set
+
+        Args:
+            model: Model name, see apredict
+            test_df: DataFrame with question and theme columns
+            labels: Classes of the report
+
+        Returns:
+            Dictionary with the classification_report of the model, its name and the
+            evaluation time in seconds
+        """
+        start = time.perf_counter()
+        y_pred = await self.apredict(model, test_df["question"].tolist())
+        report = classification_report(test_df["theme"].tolist(), y_pred, labels)
+        report["model"] = model
+        report["seconds"] = time.perf_counter() - start
+        return report
+
+    def evaluate(self, model: str, test_df: pd.DataFrame, labels: Sequence[str] = THEMES) -> Dict[str, Any]:
+        """
+        Blocking equivalent of aevaluate, for scripts without a running event loop.
+        """
+        return asyncio.run(self.aevaluate(model, test_df, labels))
+
+    async def acompare(self, models: Sequence[str], test_df: pd.DataFrame,
+                       labels: Sequence[str] = THEMES) -> pd.DataFrame:
+        """
+        Evaluate several models concurrently, their requests sharing the scheduler
+
+        Args:
+            models: Model names, see apredict
+            test_df: DataFrame with question and theme columns
+            labels: Classes of the reports
+
+        Returns:
+            DataFrame with one row per model: accuracy, macro precision, recall and F1, invalid
+            predictions and evaluation time, best F1 first
+        """
+        reports = await asyncio.gather(*(self.aevaluate(model, test_df, labels) for model in models))
+        return pd.DataFrame([
+            {"model": report["model"], "accuracy": report["accuracy"], **report["macro_avg"],
+             "invalid_predictions": report["invalid_predictions"], "seconds": report["seconds"]}
+            for report in reports
+        ]).sort_values("f1", ascending=False).reset_index(drop=True)
+
+    def compare(self, models: Sequence[str], test_df: pd.DataFrame, labels: Sequence[str] = THEMES) -> pd.DataFrame:
+        """
+        Blocking equivalent of acompare, for scripts without a running event loop.
+        """
+        return asyncio.run(self.acompare(models, test_df, labels))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dictionary with the cached and newly predicted questions and the scheduler statistics
+        """
+        return {"cache_hits": self.cache_hits, "predicted": self.predicted, **self.scheduler.stats()}
@@ -0,0 +1,129 @@
+"""
+Agent Registry - Reusable expert agents
+This module builds each expert ReAct agent once and leases it to one conversation at a
+time. A conversation's history is handed to the agent when the message is sent, so an
+agent never carries state from one request to the next. All agents share one LLM client
+and one set of tools.
+"""
+import threading
+from contextlib import contextmanager
+from llama_index.core.agent import ReActAgent
+from llama_index.core.llms import ChatMessage
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from prompts import weather_expert_system_prompt, web_search_system_prompt, market_expert_system_prompt
+from tools import weather_tool, web_search_tool
+
+# Intent -> (tool, system prompt) of the expert answering it, 'other' being the fallback
+EXPERTS: Dict[str, Tuple[Any, str]] = {
+    'market_question': (web_search_tool, market_expert_system_prompt),
+    'weather_management': (weather_tool, weather_expert_system_prompt),
+    'other': (web_search_tool, web_search_system_prompt),
+}
+
+
+class AgentRegistry:
+    """
+    Pool of expert agents, one idle list per intent.
+
+    Leasing an agent takes an idle one or builds a new one when all are busy, so
+    concurrent conversations never share an agent and never wait for each other.
+    """
+    def __init__(self, llm: Any, verbose: bool = True, max_idle: int = 8):
+        """
+        Args:
+            llm: llama_index LLM shared by every agent
+            verbose: Print the agents' reasoning
+            max_idle: Maximum number of idle agents kept per intent
+        """
+        self.llm = llm
+        self.verbose = verbose
+        self.max_idle = max_idle
+        self.built = 0
+        self._idle: Dict[str, List[ReActAgent]] = {intent: [] for intent in EXPERTS}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _expert_intent(intent: str) -> str:
+        return intent if intent in EXPERTS else 'other'
+
+    def _build(self, intent: str) -> ReActAgent:
+        tool, system_prompt = EXPERTS[intent]
+        with self._lock:
+            self.built += 1
+        return ReActAgent.from_tools([tool], llm=self.llm, verbose=self.verbose, context=f"{system_prompt}")
+
+    def warmup(self, intents: Optional[List[str]] = None) -> None:
+        """
+        Build one agent per intent ahead of the first request
+
+        Args:
+            intents: Intents to prepare, defaults to every expert
+        """
+        for intent in intents or list(EXPERTS):
+            intent = self._expert_intent(intent)
+            agent = self._build(intent)
+            with self._lock:
+                self._idle[intent].append(agent)
+
+    @contextmanager
+    def lease(self, intent: str) -> Iterator[ReActAgent]:
+        """
+        Borrow the expert agent of an intent for one request
+
+        Args:
+            intent: Intent of the query, unknown intents get the general web search expert
+
+        Yields:
+            An agent used by no other request until the lease ends
+        """
+        intent = self._expert_intent(intent)
+        with self._lock:
+            agent = self._idle[intent].pop() if self._idle[intent] else None
+        if agent is None:
+            agent = self._build(intent)
+        try:
+            yield agent
+        finally:
+            with self._lock:
+                if len(self._idle[intent]) < self.max_idle:
+                    self._idle[intent].append(agent)
+
+    def chat(self, intent: str, message: str, chat_history: List[ChatMessage]) -> str:
+        """
+        Answer a message with the expert of an intent
+
+        Args:
+            intent: Intent of the message
+            message: User message
+            chat_history: Previous messages of the conversation, replacing the agent's memory
+
+        Returns:
+            Answer of the expert
+        """
+        with self.lease(intent) as agent:
+            return str(agent.chat(message, chat_history=list(chat_history)))
+
+    async def achat(self, intent: str, message: str, chat_history: List[ChatMessage]) -> str:
+        """
+        Asyncio equivalent of chat.
+        """
+        with self.lease(intent) as agent:
+            return str(await agent.achat(message, chat_history=list(chat_history)))
+
+    async def astream_chat(self, intent: str, message: str, chat_history: List[ChatMessage]) -> AsyncIterator[str]:
+        """
+        Streaming equivalent of achat, the agent is leased until the answer is complete.
+        """
+        with self.lease(intent) as agent:
+            response = await agent.astream_chat(message, chat_history=list(chat_history))
+            async for token in response.async_response_gen():
+                yield token
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dictionary with the number of agents built and idle per intent
+        """
+        with self._lock:
+            return {"built": self.built, **{f"idle_{intent}": len(idle) for intent, idle in self._idle.items()}}
@@ -0,0 +1,171 @@
+"""
+Answer Cache - Semantic cache of policy and market answers
+This module returns a previous answer when a new question is a near-duplicate of an
+answered one, measured by the cosine similarity of their query embeddings. Entries live
+in a fixed-size matrix searched exactly, are evicted least recently used first, expire
+per intent, and are all dropped when the corpus version (embeddings file and reports)
+changes.
+"""
+import csv
+import time
+import threading
+import numpy as np
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Market answers depend on current prices and go stale much faster than policy answers
+DEFAULT_TTLS = {
+    'policy_help': 7 * 24 * 3600,
+    'market_question': 3600,
+}
+
+
+def threshold_from_similarities(similarities_file: str = "answer_similarities.csv", quantile: float = 1.0) -> float:
+    """
+    Derive a similarity threshold from the evaluation of generated against reference answers
+
+    Those pairs agree in substance without being paraphrases, so a threshold above most
+    of their similarities only matches questions that are much closer than that.
+
+    Args:
+        similarities_file: CSV with a similarity column, as written by the demo evaluation
+        quantile: Quantile of the similarities used as threshold (1.0 for the maximum)
+
+    Returns:
+        Cosine similarity threshold
+    """
+    with open(similarities_file, "r", encoding="utf-8") as f:
+        similarities = [float(row["similarity"]) for row in csv.DictReader(f) if row["similarity"]]
+    return float(np.quantile(similarities, quantile))
+
+
+class SemanticAnswerCache:
+    """
+    Bounded nearest-neighbour cache of answers keyed on query embeddings.
+    """
+    def __init__(self, threshold: float = 0.93, max_entries: int = 1024, ttls: Optional[Dict[str, float]] = None,
+                 version_fn: Optional[Callable[[], str]] = None, version_check_interval: float = 60):
+        """
+        Args:
+            threshold: Minimum cosine similarity between two questions to reuse an answer
+            max_entries: Maximum number of cached answers
+            ttls: Time to live in seconds per intent; only these intents are cached
+            version_fn: Function returning the current corpus version, the cache is cleared when it changes
+            version_check_interval: Minimum number of seconds between two calls of version_fn
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.version_fn = version_fn
+        self.version_check_interval = version_check_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._matrix: Optional[np.ndarray] = None
+        self._entries: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self._last_used = np.zeros(max_entries)
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._version = version_fn() if version_fn is not None else None
+        self._version_checked = time.time()
+
+    @property
+    def intents(self) -> List[str]:
+        return list(self.ttls)
+
+    def _check_version(self) -> None:
+        if self.version_fn is None or time.time() - self._version_checked < self.version_check_interval:
+            return
+        self._version_checked = time.time()
+        version = self.version_fn()
+        if version != self._version:
+            print("Corpus changed, clearing the answer cache")
+            self._version = version
+            self._valid[:] = False
+            self._entries = [None] * self.max_entries
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, embedding: Sequence[float], intent: str) -> Optional[Dict[str, Any]]:
+        """
+        Find the cached answer of the closest past question
+
+        Args:
+            embedding: Query embedding
+            intent: Intent of the query, only answers of the same intent are returned
+
+        Returns:
+            Dictionary with the past query, answer, sources and similarity, or None on a miss
+        """
+        if intent not in self.ttls:
+            return None
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            if self._matrix is None or not self._valid.any():
+                self.misses += 1
+                return None
+            similarities = self._matrix @ query
+            similarities[~self._valid] = -np.inf
+            for slot in np.argsort(-similarities):
+                if similarities[slot] < self.threshold:
+                    break
+                entry = self._entries[slot]
+                if now - entry["created"] > self.ttls[entry["intent"]]:
+                    self._valid[slot] = False
+                    continue
+                if entry["intent"] == intent:
+                    self.hits += 1
+                    self._last_used[slot] = now
+                    return {
+                        "query": entry["query"],
+                        "answer": entry["answer"],
+                        "sources": entry["sources"],
+                        "similarity": float(similarities[slot]),
+                    }
+            self.misses += 1
+            return None
+
+    def store(self, query: str, embedding: Sequence[float], intent: str, answer: str,
+              sources: Optional[List[str]] = None) -> None:
+        """
+        Cache an answer
+
+        Args:
+            query: User question
+            embedding: Query embedding
+            intent: Intent of the question
+            answer: Answer returned to the user
+            sources: Names of the documents the answer is based on
+        """
+        if intent not in self.ttls or not answer:
+            return
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            free = np.flatnonzero(~self._valid)
+            # Reuse a free slot, or evict the least recently used answer
+            slot = int(free[0]) if free.size else int(np.argmin(self._last_used))
+            self._matrix[slot] = vector
+            self._entries[slot] = {"query": query, "intent": intent, "answer": answer,
+                                   "sources": list(sources or []), "created": now}
+            self._last_used[slot] = now
+            self._valid[slot] = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._valid[:] = False
+            self._entries = [None] * self.max_entries
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dictionary with hit and miss counters and the number of cached answers
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": int(self._valid.sum())}
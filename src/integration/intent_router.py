@@ -0,0 +1,457 @@
+"""
+Intent Router - Local fast path in front of the fine-tuned intent classifier
+This module trains a hashed character n-gram linear model on the fine-tuning data
+(../finetuning/train.jsonl). Confident predictions are answered locally in well under a
+millisecond, and only ambiguous queries are sent to the remote Mistral classifier. The
+trained model is saved next to the other indexes and reloaded while the training data is
+unchanged. The router records the agreement between both models and the recent routing
+latencies.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import zlib
+import unicodedata
+import numpy as np
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_TRAIN_FILE = os.path.join("..", "finetuning", "train.jsonl")
+DEFAULT_TEST_FILE = os.path.join("..", "finetuning", "test.jsonl")
+DEFAULT_MODEL_PATH = os.path.join("..", "RAG", "indexes", "intent_model.npz")
+INTENT_CLASSIFIER_MODEL = "ft:classifier:ministral-3b-latest:82f3f89c:20250422:agro-intent-clf:a0b2cfa8"
+
+
+def load_intent_dataset(file_path: str) -> Tuple[List[str], List[str]]:
+    """
+    Read a classifier fine-tuning file
+
+    Args:
+        file_path: JSONL file with {"text": ..., "labels": {"intent": ...}} lines
+
+    Returns:
+        Tuple containing the texts and their intents
+    """
+    texts, intents = [], []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                texts.append(record["text"])
+                intents.append(record["labels"]["intent"])
+    return texts, intents
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+class HashedNgramModel:
+    """
+    Multinomial logistic regression over hashed character n-grams and words.
+    """
+    def __init__(self, labels: Sequence[str], n_features: int = 1 << 18, ngram_range: Tuple[int, int] = (2, 5),
+                 fingerprint: Optional[str] = None):
+        """
+        Args:
+            labels: Intent names, in output order
+            n_features: Size of the hashed feature space (a power of two)
+            ngram_range: Smallest and largest character n-gram length
+            fingerprint: Fingerprint of the training data and settings
+        """
+        self.labels = list(labels)
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.fingerprint = fingerprint
+        self.weights = np.zeros((n_features, len(self.labels)), dtype=np.float32)
+        self.bias = np.zeros(len(self.labels), dtype=np.float32)
+
+    def featurize(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Hash the n-grams of a text into a sparse L2-normalized vector
+
+        Args:
+            text: Raw text
+
+        Returns:
+            Tuple containing the unique feature indices and their values
+        """
+        text = _normalize(text)
+        mask = self.n_features - 1
+        counts = defaultdict(float)
+        for word in text.split():
+            counts[zlib.crc32(word.encode("utf-8")) & mask] += 1
+        padded = f" {text} ".encode("utf-8")
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(padded) - n + 1):
+                counts[zlib.crc32(padded[i:i + n], n) & mask] += 1
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+        return indices, values / np.linalg.norm(values)
+
+    def fit(self, texts: Sequence[str], intents: Sequence[str], epochs: int = 15, learning_rate: float = 0.5,
+            l2: float = 1e-5, seed: int = 0) -> "HashedNgramModel":
+        """
+        Train with stochastic gradient descent on the softmax cross-entropy
+
+        Args:
+            texts: Training texts
+            intents: Intent of each text
+            epochs: Number of passes over the data
+            learning_rate: Initial step size, decayed linearly to zero
+            l2: L2 penalty applied to the updated weights
+            seed: Seed of the shuffling
+
+        Returns:
+            The trained model
+        """
+        label_ids = {label: i for i, label in enumerate(self.labels)}
+        samples = [self.featurize(text) for text in texts]
+        targets = np.array([label_ids[intent] for intent in intents])
+        rng = np.random.default_rng(seed)
+        steps = epochs * len(samples)
+        step = 0
+        for _ in range(epochs):
+            for i in rng.permutation(len(samples)):
+                lr = learning_rate * (1 - step / steps)
+                step += 1
+                indices, values = samples[i]
+                gradient = self._softmax(values @ self.weights[indices] + self.bias)
+                gradient[targets[i]] -= 1
+                self.weights[indices] -= lr * (np.outer(values, gradient) + l2 * self.weights[indices])
+                self.bias -= lr * gradient
+        return self
+
+    def save(self, file_path: str) -> None:
+        """
+        Write the model to a .npz file, only the rows of the hashed features seen in training
+
+        Args:
+            file_path: Destination file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        rows = np.flatnonzero(np.any(self.weights != 0, axis=1))
+        # Write then rename, so an interrupted save never leaves a truncated model
+        with open(f"{file_path}.tmp", "wb") as f:
+            np.savez(f, labels=np.array(self.labels), n_features=self.n_features, ngram_range=np.array(self.ngram_range),
+                     fingerprint=np.array(self.fingerprint or ""), rows=rows, weights=self.weights[rows], bias=self.bias)
+        os.replace(f"{file_path}.tmp", file_path)
+
+    @classmethod
+    def load(cls, file_path: str) -> "HashedNgramModel":
+        """
+        Load a model written with save()
+
+        Args:
+            file_path: Model file
+
+        Returns:
+            The trained model
+        """
+        with np.load(file_path) as data:
+            model = cls(data["labels"].tolist(), int(data["n_features"]), tuple(data["ngram_range"].tolist()),
+                        fingerprint=str(data["fingerprint"]) or None)
+            model.weights[data["rows"]] = data["weights"]
+            model.bias[:] = data["bias"]
+        return model
+
+    @staticmethod
+    def _softmax(logits: np.ndarray) -> np.ndarray:
+        exp = np.exp(logits - logits.max())
+        return exp / exp.sum()
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        """
+        Args:
+            text: Raw text
+
+        Returns:
+            Probability of each label
+        """
+        indices, values = self.featurize(text)
+        return self._softmax(values @ self.weights[indices] + self.bias)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        Args:
+            text: Raw text
+
+        Returns:
+            Tuple containing the most likely intent and its probability
+        """
+        probabilities = self.predict_proba(text)
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+
+def train_intent_model(train_file: str = DEFAULT_TRAIN_FILE, **fit_kwargs) -> HashedNgramModel:
+    """
+    Train the local intent model on the fine-tuning data
+
+    Args:
+        train_file: JSONL training file
+        fit_kwargs: Forwarded to HashedNgramModel.fit
+
+    Returns:
+        Trained HashedNgramModel
+    """
+    texts, intents = load_intent_dataset(train_file)
+    return HashedNgramModel(sorted(set(intents))).fit(texts, intents, **fit_kwargs)
+
+
+def load_or_train_intent_model(train_file: str = DEFAULT_TRAIN_FILE, model_path: str = DEFAULT_MODEL_PATH,
+                               **fit_kwargs) -> HashedNgramModel:
+    """
+    Load the saved local intent model, training and saving it again only when the training
+    data or settings changed
+
+    Args:
+        train_file: JSONL training file
+        model_path: File the trained model is saved to
+        fit_kwargs: Forwarded to HashedNgramModel.fit
+
+    Returns:
+        Trained HashedNgramModel
+    """
+    with open(train_file, "rb") as f:
+        digest = hashlib.sha256(f.read())
+    digest.update(json.dumps(fit_kwargs, sort_keys=True).encode("utf-8"))
+    fingerprint = digest.hexdigest()
+
+    if os.path.exists(model_path):
+        try:
+            model = HashedNgramModel.load(model_path)
+            if model.fingerprint == fingerprint:
+                return model
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load the intent model {model_path}: {e}")
+
+    start = time.perf_counter()
+    model = train_intent_model(train_file, **fit_kwargs)
+    model.fingerprint = fingerprint
+    model.save(model_path)
+    print(f"Trained the intent model in {time.perf_counter() - start:.2f}s, saved to {model_path}")
+    return model
+
+
+def remote_intent_classifier(client: Any, model: str = INTENT_CLASSIFIER_MODEL) -> Callable[[str], str]:
+    """
+    Wrap the fine-tuned Mistral classifier as a text -> intent function
+
+    Args:
+        client: Mistral client
+        model: Fine-tuned classifier model id
+
+    Returns:
+        Function returning the predicted intent of a text
+    """
+    def classify(text: str) -> str:
+        response = client.classifiers.classify(model=model, inputs=[text])
+        scores = response.results[0]['intent'].scores
+        return max(scores, key=scores.get)
+    return classify
+
+
+def async_remote_intent_classifier(client: Any,
+                                   model: str = INTENT_CLASSIFIER_MODEL) -> Callable[[str], Awaitable[str]]:
+    """
+    Asyncio equivalent of remote_intent_classifier.
+    """
+    async def classify(text: str) -> str:
+        response = await client.classifiers.classify_async(model=model, inputs=[text])
+        scores = response.results[0]['intent'].scores
+        return max(scores, key=scores.get)
+    return classify
+
+
+def _percentiles(latencies: Sequence[float]) -> Dict[str, float]:
+    if not latencies:
+        return {}
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+class IntentRouter:
+    """
+    Route confident queries with the local model and the others to the remote classifier.
+
+    If the remote classifier fails, the local prediction is used instead so that an API
+    error never leaves a query without an intent.
+    """
+    def __init__(self, local_model: HashedNgramModel, remote_classifier: Optional[Callable[[str], str]] = None,
+                 threshold: float = 0.9,
+                 async_remote_classifier: Optional[Callable[[str], Awaitable[str]]] = None,
+                 max_latencies: int = 10000):
+        """
+        Args:
+            local_model: Trained HashedNgramModel
+            remote_classifier: Function returning the remote intent of a text, None to stay local
+            threshold: Minimum local probability to skip the remote classifier
+            async_remote_classifier: Coroutine function used by aroute, defaults to running
+                remote_classifier in a worker thread
+            max_latencies: Number of recent latencies of each path kept for the percentiles
+        """
+        self.local_model = local_model
+        self.remote_classifier = remote_classifier
+        self.async_remote_classifier = async_remote_classifier
+        self.threshold = threshold
+        self.local_latencies = deque(maxlen=max_latencies)
+        self.remote_latencies = deque(maxlen=max_latencies)
+        self.local_routes = 0
+        self.remote_routes = 0
+        self.remote_errors = 0
+        self.agreements = 0
+        self.compared = 0
+        # (model, text, prediction) of the last query, is_confident then route predict once
+        self._last_prediction = None
+
+    def route(self, text: str) -> Tuple[str, str]:
+        """
+        Predict the intent of a text
+
+        Args:
+            text: User query
+
+        Returns:
+            Tuple containing the intent and the source that decided it ('local' or 'remote')
+        """
+        start = time.perf_counter()
+        intent, confidence = self._predict(text)
+        if confidence >= self.threshold or self.remote_classifier is None:
+            return self._local(intent, start)
+
+        try:
+            remote_intent = self.remote_classifier(text)
+        except Exception as e:
+            return self._remote_failed(intent, start, e)
+        return self._remote_succeeded(intent, remote_intent, start)
+
+    async def aroute(self, text: str) -> Tuple[str, str]:
+        """
+        Asyncio equivalent of route.
+        """
+        start = time.perf_counter()
+        intent, confidence = self._predict(text)
+        if confidence >= self.threshold or (self.remote_classifier is None and self.async_remote_classifier is None):
+            return self._local(intent, start)
+
+        try:
+            if self.async_remote_classifier is not None:
+                remote_intent = await self.async_remote_classifier(text)
+            else:
+                remote_intent = await asyncio.to_thread(self.remote_classifier, text)
+        except Exception as e:
+            return self._remote_failed(intent, start, e)
+        return self._remote_succeeded(intent, remote_intent, start)
+
+    def _predict(self, text: str) -> Tuple[str, float]:
+        last = self._last_prediction
+        if last is not None and last[0] is self.local_model and last[1] == text:
+            return last[2]
+        prediction = self.local_model.predict(text)
+        self._last_prediction = (self.local_model, text, prediction)
+        return prediction
+
+    def _local(self, intent: str, start: float) -> Tuple[str, str]:
+        self.local_routes += 1
+        self.local_latencies.append(time.perf_counter() - start)
+        return intent, "local"
+
+    def _remote_failed(self, intent: str, start: float, error: Exception) -> Tuple[str, str]:
+        print(f"Remote intent classifier failed, using the local prediction: {error}")
+        self.remote_errors += 1
+        return self._local(intent, start)
+
+    def _remote_succeeded(self, intent: str, remote_intent: str, start: float) -> Tuple[str, str]:
+        self.remote_routes += 1
+        self.remote_latencies.append(time.perf_counter() - start)
+        self.compared += 1
+        self.agreements += remote_intent == intent
+        return remote_intent, "remote"
+
+    def is_confident(self, text: str) -> bool:
+        """
+        Check whether a text would be routed by the local model alone. The prediction is
+        kept, so routing the same text next does not run the local model again
+
+        Args:
+            text: User query
+
+        Returns:
+            True if the local probability reaches the threshold
+        """
+        return self._predict(text)[1] >= self.threshold
+
+    def __call__(self, text: str) -> str:
+        return self.route(text)[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns:
+            Dictionary with the number of local and remote routes, the local/remote agreement
+            on the queries sent to the remote classifier and the latency percentiles of each path
+            over the last max_latencies queries
+        """
+        total = self.local_routes + self.remote_routes
+        return {
+            "queries": total,
+            "local": self.local_routes,
+            "remote": self.remote_routes,
+            "local_share": self.local_routes / total if total else 0.0,
+            "remote_errors": self.remote_errors,
+            "agreement_on_remote": self.agreements / self.compared if self.compared else None,
+            "local_latency": _percentiles(self.local_latencies),
+            "remote_latency": _percentiles(self.remote_latencies),
+        }
+
+
+def evaluate_router(model: HashedNgramModel, test_file: str = DEFAULT_TEST_FILE,
+                    thresholds: Sequence[float] = (0.5, 0.7, 0.8, 0.85, 0.9, 0.95)) -> Dict[str, Any]:
+    """
+    Measure the local model on labelled queries and the coverage of each confidence threshold
+
+    Args:
+        model: Trained HashedNgramModel
+        test_file: JSONL test file
+        thresholds: Confidence thresholds to report
+
+    Returns:
+        Dictionary with the overall accuracy, the per-threshold share of queries answered
+        locally and their accuracy, and the local latency percentiles
+    """
+    texts, intents = load_intent_dataset(test_file)
+    predictions, latencies = [], []
+    for text in texts:
+        start = time.perf_counter()
+        predictions.append(model.predict(text))
+        latencies.append(time.perf_counter() - start)
+
+    correct = np.array([intent == expected for (intent, _), expected in zip(predictions, intents)])
+    confidences = np.array([confidence for _, confidence in predictions])
+    by_threshold = {}
+    for threshold in thresholds:
+        local = confidences >= threshold
+        by_threshold[threshold] = {
+            "local_share": float(local.mean()),
+            "local_accuracy": float(correct[local].mean()) if local.any() else None,
+        }
+    return {
+        "queries": len(texts),
+        "accuracy": float(correct.mean()),
+        "thresholds": by_threshold,
+        "latency": _percentiles(latencies),
+    }
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    intent_model = train_intent_model()
+    print(f"Trained in {time.perf_counter() - start:.2f}s")
+    print(json.dumps(evaluate_router(intent_model), indent=2))
@@ -0,0 +1,269 @@
+"""
+Chat Orchestrator - Asyncio version of the AgroFlow chat pipeline
+This module routes a farmer's message to the right expert (policy RAG, weather, market
+or general web search) on a single event loop. Mistral calls use the async client
+methods, and when the intent has to come from the remote classifier, the policy
+retrieval starts speculatively alongside it and is cancelled if the intent is not policy.
+Answers can be streamed token by token with astream_chat, and answers to near-duplicate
+policy and market questions can be served from a semantic answer cache. Policy passages
+can be packed under a token budget by a ContextBuilder before they reach the prompt.
+"""
+import time
+import asyncio
+from llama_index.core.llms import ChatMessage
+from mistralai.models import UserMessage
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from agents import AgentRegistry
+from answer_cache import SemanticAnswerCache
+from context_builder import ContextBuilder
+from intent_router import IntentRouter
+from tracing import count, get_tracer, span
+
+DIAGNOSIS_REQUEST = "Please upload an image of the plant leaf for diagnosis."
+
+# (cached answer, retrieved passages, query embedding) of a policy question
+PolicyContext = Tuple[Optional[Dict[str, Any]], Optional[List[Any]], Optional[List[float]]]
+
+
+class ChatOrchestrator:
+    """
+    Answer chat messages, many conversations sharing one event loop.
+    """
+    def __init__(self, client: Any, retriever: Any, intent_router: IntentRouter, llm: Any,
+                 model: str = "mistral-large-latest", top_k: int = 2, speculative_retrieval: bool = True,
+                 verbose: bool = True, agents: Optional[AgentRegistry] = None,
+                 answer_cache: Optional[SemanticAnswerCache] = None,
+                 context_builder: Optional[ContextBuilder] = None):
+        """
+        Args:
+            client: Mistral client
+            retriever: HybridRetriever over the policy documents
+            intent_router: Router returning the intent of a message
+            llm: llama_index LLM driving the ReAct agents
+            model: Mistral model answering policy questions
+            top_k: Number of passages given to the policy answer
+            speculative_retrieval: Start the policy retrieval while the remote classifier runs
+            verbose: Print the agents' reasoning
+            agents: Registry of the expert agents, built from llm when omitted
+            answer_cache: Cache returning past answers of near-duplicate questions
+            context_builder: Packs the most relevant passages of the retrieved chunks under a
+                token budget, the full chunks are sent when omitted
+        """
+        self.client = client
+        self.retriever = retriever
+        self.intent_router = intent_router
+        self.llm = llm
+        self.model = model
+        self.top_k = top_k
+        self.speculative_retrieval = speculative_retrieval
+        self.verbose = verbose
+        self.agents = agents or AgentRegistry(llm, verbose=verbose)
+        self.answer_cache = answer_cache
+        self.context_builder = context_builder
+
+        # Cache hits, agents built and routing decisions are exported with the traces
+        tracer = get_tracer()
+        tracer.register_stats("intent_router", intent_router.stats)
+        tracer.register_stats("agents", self.agents.stats)
+        if answer_cache is not None:
+            tracer.register_stats("answer_cache", answer_cache.stats)
+        if context_builder is not None:
+            tracer.register_stats("context_builder", context_builder.stats)
+
+    def _policy_message(self, user_query: str, context: List[Any]) -> Tuple[UserMessage, str]:
+        if self.context_builder is None:
+            context_docs = list(dict.fromkeys(doc.payload['file_name'] for doc in context))
+            context_text = "\n\n".join([f"Nom du document :{doc.payload['file_name']}. Date du document :{doc.payload['date']}.\nContenu du document :\n{doc.payload['text']}" for doc in context])
+        else:
+            with span("context_build") as build_span:
+                context_text, report = self.context_builder.build(user_query, context)
+                build_span.set(tokens_used=report["tokens_used"], tokens_saved=report["tokens_saved"])
+            context_docs = report["documents"]
+
+        message = UserMessage(
+            content=f"Context: {context_text}\n\nQuestion de l'utilisateur : {user_query}"
+        )
+        return message, f"D'après les documents {context_docs} :\n\n"
+
+    async def _policy_context(self, user_query: str) -> PolicyContext:
+        """
+        Look the question up in the answer cache, and retrieve the policy passages on a miss
+
+        Returns:
+            Tuple containing the cached answer (None on a miss), the retrieved passages (None on
+            a hit) and the query embedding (None without answer cache)
+        """
+        if self.answer_cache is None:
+            return None, await self.retriever.aretrieve(user_query, top_k=self.top_k), None
+        # BM25 overlaps the embedding call, its candidates are dropped on a cache hit
+        sparse_task = self.retriever.start_sparse_search(user_query)
+        try:
+            embedding = await self.retriever.aembed_query(user_query)
+        except BaseException:
+            sparse_task.cancel()
+            raise
+        cached = self.answer_cache.lookup(embedding, 'policy_help')
+        if cached is not None:
+            sparse_task.cancel()
+            return cached, None, embedding
+        context = await self.retriever.aretrieve(user_query, top_k=self.top_k, query_embedding=embedding,
+                                                 sparse_task=sparse_task)
+        return None, context, embedding
+
+    async def _route(self, user_query: str) -> Tuple[str, PolicyContext]:
+        """
+        Detect the intent of a query, and prepare the policy answer if it is a policy question
+
+        Returns:
+            Tuple containing the intent and, for policy questions, the output of _policy_context
+        """
+        # A confident local intent costs nothing to wait for, only speculate on a remote round trip
+        retrieval: Optional[asyncio.Task] = None
+        if self.speculative_retrieval and not self.intent_router.is_confident(user_query):
+            retrieval = asyncio.create_task(self._policy_context(user_query))
+
+        try:
+            with span("detect_intent") as intent_span:
+                intent, source = await self.intent_router.aroute(user_query)
+                intent_span.set(intent=intent, source=source)
+        except BaseException:
+            if retrieval is not None:
+                retrieval.cancel()
+            raise
+        if retrieval is not None and intent != 'policy_help':
+            retrieval.cancel()
+
+        if intent != 'policy_help':
+            return intent, (None, None, None)
+        if retrieval is None:
+            return intent, await self._policy_context(user_query)
+        return intent, await retrieval
+
+    async def _cached_expert_answer(self, intent: str, user_query: str,
+                                    chat_history: List[ChatMessage]) -> Tuple[Optional[str], Optional[List[float]]]:
+        # Expert answers only depend on the question when the conversation just started
+        if self.answer_cache is None or chat_history or intent not in self.answer_cache.intents:
+            return None, None
+        embedding = await self.retriever.aembed_query(user_query)
+        cached = self.answer_cache.lookup(embedding, intent)
+        return (cached["answer"] if cached is not None else None), embedding
+
+    def _remember(self, user_query: str, embedding: Optional[List[float]], intent: str, answer: str,
+                  context: Optional[List[Any]] = None) -> None:
+        if self.answer_cache is None or embedding is None:
+            return
+        sources = list(dict.fromkeys(doc.payload['file_name'] for doc in context or []))
+        self.answer_cache.store(user_query, embedding, intent, answer, sources)
+
+    async def achat(self, messages: List[ChatMessage]) -> str:
+        """
+        Answer the last message of a conversation
+
+        Args:
+            messages: Conversation history, the last message being the user query
+
+        Returns:
+            Answer of the expert matching the intent of the query
+        """
+        # Every span of the answer carries the id of this request
+        with get_tracer().request(), span("chat"):
+            return await self._answer(messages)
+
+    async def _answer(self, messages: List[ChatMessage]) -> str:
+        user_query = messages[-1].content
+        chat_history = messages[:-1]
+        intent, (cached, context, embedding) = await self._route(user_query)
+
+        if intent == 'policy_help':
+            if cached is not None:
+                return cached["answer"]
+            message, header = self._policy_message(user_query, context)
+            count("api_calls.chat_completion")
+            with span("completion", model=self.model):
+                response = await self.client.chat.complete_async(
+                    model=self.model,
+                    messages=[message],
+                    max_tokens=1000,
+                    temperature=0.1,
+                )
+            answer = f"{header}{response.choices[0].message.content}"
+            self._remember(user_query, embedding, intent, answer, context)
+            return answer
+
+        elif intent == 'disease_diagnosis':
+            return DIAGNOSIS_REQUEST
+
+        answer, embedding = await self._cached_expert_answer(intent, user_query, chat_history)
+        if answer is not None:
+            return answer
+        with span("agent", intent=intent):
+            answer = await self.agents.achat(intent, user_query, chat_history)
+        self._remember(user_query, embedding, intent, answer)
+        return answer
+
+    async def astream_chat(self, messages: List[ChatMessage]) -> AsyncIterator[str]:
+        """
+        Streaming equivalent of achat
+
+        Args:
+            messages: Conversation history, the last message being the user query
+
+        Yields:
+            Pieces of the answer as soon as they are generated
+        """
+        with get_tracer().request(), span("chat", streaming=True):
+            async for piece in self._stream_answer(messages):
+                yield piece
+
+    async def _stream_answer(self, messages: List[ChatMessage]) -> AsyncIterator[str]:
+        user_query = messages[-1].content
+        chat_history = messages[:-1]
+        intent, (cached, context, embedding) = await self._route(user_query)
+
+        if intent == 'policy_help':
+            if cached is not None:
+                yield cached["answer"]
+                return
+            message, header = self._policy_message(user_query, context)
+            # The cited documents are known before the first token
+            yield header
+            pieces = [header]
+            count("api_calls.chat_completion")
+            with span("completion", model=self.model, streaming=True) as completion_span:
+                start = time.perf_counter()
+                async with await self.client.chat.stream_async(
+                    model=self.model,
+                    messages=[message],
+                    max_tokens=1000,
+                    temperature=0.1,
+                ) as stream:
+                    async for event in stream:
+                        content = event.data.choices[0].delta.content
+                        if isinstance(content, str) and content:
+                            if len(pieces) == 1:
+                                completion_span.set(first_token_ms=round(1000 * (time.perf_counter() - start), 3))
+                            pieces.append(content)
+                            yield content
+            self._remember(user_query, embedding, intent, "".join(pieces), context)
+
+        elif intent == 'disease_diagnosis':
+            yield DIAGNOSIS_REQUEST
+
+        else:
+            answer, embedding = await self._cached_expert_answer(intent, user_query, chat_history)
+            if answer is not None:
+                yield answer
+                return
+            pieces = []
+            with span("agent", intent=intent, streaming=True):
+                async for token in self.agents.astream_chat(intent, user_query, chat_history):
+                    pieces.append(token)
+                    yield token
+            self._remember(user_query, embedding, intent, "".join(pieces))
+
+    def chat(self, messages: List[ChatMessage]) -> str:
+        """
+        Blocking equivalent of achat, for scripts without a running event loop.
+        """
+        return asyncio.run(self.achat(messages))
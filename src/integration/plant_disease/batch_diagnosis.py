@@ -0,0 +1,262 @@
+"""
+Plant Disease Prediction - Batch diagnosis CLI
+This module bulk-scores archived field photos from a directory tree, a tar stream or a
+zip archive. Images are read and batched ahead of the model by a prefetch thread,
+results are written as JSONL or Parquet, and a throughput report (images/sec, p50/p95
+latency of a batch and per image of a batch, top-1 accuracy against the parent folder
+names) is printed.
+
+Usage (from src/integration):
+    python -m plant_disease.batch_diagnosis plant_disease/images --output predictions.jsonl
+    tar -cf - photos/ | python -m plant_disease.batch_diagnosis - --output predictions.parquet
+"""
+import os
+import sys
+import json
+import time
+import queue
+import tarfile
+import zipfile
+import argparse
+import threading
+import torch
+import numpy as np
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from plant_disease.disease_prediction import (
+    DEFAULT_MODEL_PATH, DEFAULT_CLASS_NAMES_PATH, DEFAULT_SPEC_PATH, load_transforms, predict_tensors
+)
+from plant_disease.preprocessing import list_images, preprocess_images, DEFAULT_IMAGES_DIR, IMAGE_EXTENSIONS
+
+_END = object()
+
+
+def _label_from_name(name: str) -> Optional[str]:
+    parent = os.path.basename(os.path.dirname(name.rstrip('/')))
+    return parent or None
+
+
+def _read(read) -> Union[bytes, Exception]:
+    try:
+        return read()
+    except Exception as e:
+        return e
+
+
+def iter_images(source: str) -> Iterator[Tuple[str, Union[bytes, Exception], Optional[str]]]:
+    """
+    Stream images from a directory tree, a tar archive/stream ('-' for stdin) or a zip archive
+
+    Args:
+        source: Directory, .tar/.tar.gz/.tgz path, .zip path or '-'
+
+    Yields:
+        Tuples of (name, image bytes or the error raised reading them, label taken from the
+        parent folder name). A damaged archive stops the stream after its last readable image
+    """
+    if os.path.isdir(source):
+        for path in list_images(source):
+            def read_file(path=path):
+                with open(path, 'rb') as f:
+                    return f.read()
+            yield os.path.relpath(path, source), _read(read_file), _label_from_name(path)
+        return
+    try:
+        if source != '-' and zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield info.filename, _read(lambda: archive.read(info)), _label_from_name(info.filename)
+        else:
+            fileobj = sys.stdin.buffer if source == '-' else None
+            with tarfile.open(name=None if fileobj else source, fileobj=fileobj, mode='r|*') as archive:
+                for member in archive:
+                    if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield member.name, _read(lambda: archive.extractfile(member).read()), \
+                            _label_from_name(member.name)
+    except Exception as e:
+        # Truncated or corrupt archive, the following members cannot be located
+        print(f"Stopped reading {source}: {type(e).__name__}: {e}")
+
+
+def _prefetch_batches(items: Iterator, batch_size: int, prefetch: int) -> Iterator[List[Tuple]]:
+    """Group items in batches, read ahead by a background thread"""
+    batches = queue.Queue(maxsize=prefetch)
+
+    def producer():
+        try:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+        except Exception as e:
+            batches.put(e)
+        batches.put(_END)
+
+    threading.Thread(target=producer, name="plant-disease-prefetch", daemon=True).start()
+    while True:
+        batch = batches.get()
+        if batch is _END:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+
+def _preprocess_batch(batch: List[Tuple], transform) -> Tuple[Any, List[int], Dict[int, str]]:
+    """
+    Decode a batch, isolating the images that cannot be read or decoded
+
+    Returns:
+        Tuple of (tensor of the decoded images, their positions in batch, error by position)
+    """
+    errors = {i: f"{type(data).__name__}: {data}" for i, (_, data, _) in enumerate(batch) if isinstance(data, Exception)}
+    valid = [i for i in range(len(batch)) if i not in errors]
+    try:
+        return preprocess_images([batch[i][1] for i in valid], transform, target_size=transform.image_size), valid, errors
+    except Exception:
+        pass
+    # Corrupt images are rare, decode one by one only the batches containing one
+    tensors = []
+    for i in list(valid):
+        try:
+            tensors.append(preprocess_images([batch[i][1]], transform, target_size=transform.image_size))
+        except Exception as e:
+            errors[i] = f"{type(e).__name__}: {e}"
+            valid.remove(i)
+    return torch.cat(tensors) if tensors else None, valid, errors
+
+
+class _ResultWriter:
+    """Write prediction records as JSONL or Parquet depending on the output extension"""
+    def __init__(self, output_path: Optional[str]):
+        self.output_path = output_path
+        self._file = None
+        self._parquet = None
+        if output_path and not output_path.endswith('.parquet'):
+            self._file = open(output_path, 'w', encoding='utf-8')
+
+    def write(self, records: List[Dict[str, Any]]) -> None:
+        if self._file is not None:
+            for record in records:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        elif self.output_path:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([
+                ("image", pa.string()), ("label", pa.string()), ("prediction", pa.string()),
+                ("confidence", pa.float64()), ("top_predictions", pa.string()), ("error", pa.string()),
+            ])
+            table = pa.Table.from_pylist([
+                dict(record, top_predictions=json.dumps(record["top_predictions"]))
+                if "top_predictions" in record else record
+                for record in records
+            ], schema=schema)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.output_path, schema)
+            self._parquet.write_table(table)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+def run_batch_diagnosis(source: str, output_path: Optional[str] = None, batch_size: int = 32, prefetch: int = 4,
+                        model_path: str = DEFAULT_MODEL_PATH, spec_path: str = DEFAULT_SPEC_PATH,
+                        class_names_path: str = DEFAULT_CLASS_NAMES_PATH) -> Dict[str, Any]:
+    """
+    Score every image of a source and report throughput, latency and accuracy
+
+    Args:
+        source: Directory, tar/zip archive or '-' for a tar stream on stdin
+        output_path: JSONL or .parquet file receiving one record per image, None to skip
+        batch_size: Number of images per forward pass
+        prefetch: Number of batches read ahead of the model
+        model_path: Path to the trained or exported model
+        spec_path: Path to the preprocessing JSON spec
+        class_names_path: Path to the class names JSON file
+
+    Returns:
+        Dictionary containing images, failed_images, images_per_sec, p50/p95 latency (ms) of a
+        whole batch and of an image (batch latency divided by its number of images) and
+        top1_accuracy
+    """
+    transform, class_names = load_transforms(spec_path, class_names_path)
+    class_names = set(class_names)
+    writer = _ResultWriter(output_path)
+
+    latencies, image_latencies = [], []
+    correct = labelled = images = failed = 0
+    start = time.perf_counter()
+    try:
+        for batch in _prefetch_batches(iter_images(source), batch_size, prefetch):
+            batch_start = time.perf_counter()
+            tensors, valid, errors = _preprocess_batch(batch, transform)
+            results = dict(zip(valid, predict_tensors(tensors, model_path, spec_path, class_names_path))) if valid else {}
+            latencies.append((time.perf_counter() - batch_start) * 1000)
+            image_latencies.append(latencies[-1] / len(batch))
+
+            records = []
+            for i, (name, _, label) in enumerate(batch):
+                if i in errors:
+                    # Unreadable images get no prediction and are left out of the accuracy
+                    print(f"Skipping {name}: {errors[i]}")
+                    records.append({"image": name, "label": label, "error": errors[i]})
+                    continue
+                if label in class_names:
+                    labelled += 1
+                    correct += results[i]["prediction"] == label
+                records.append({"image": name, "label": label, **results[i]})
+            writer.write(records)
+            images += len(valid)
+            failed += len(errors)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "images": images,
+        "failed_images": failed,
+        "batch_size": batch_size,
+        "images_per_sec": images / elapsed if elapsed > 0 else 0.0,
+        "batch_p50_ms": float(np.percentile(latencies, 50)) if latencies else 0.0,
+        "batch_p95_ms": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        "image_p50_ms": float(np.percentile(image_latencies, 50)) if image_latencies else 0.0,
+        "image_p95_ms": float(np.percentile(image_latencies, 95)) if image_latencies else 0.0,
+        "top1_accuracy": correct / labelled if labelled else None,
+        "labelled_images": labelled,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk plant disease diagnosis and CPU throughput benchmark")
+    parser.add_argument("source", nargs="?", default=DEFAULT_IMAGES_DIR,
+                        help="Directory, tar/zip archive, or '-' to read a tar stream from stdin")
+    parser.add_argument("--output", default=None, help="JSONL or .parquet output file")
+    parser.add_argument("--summary", default=None, help="Write the benchmark report to this JSON file")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--prefetch", type=int, default=4)
+    parser.add_argument("--model-path", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--class-names-path", default=DEFAULT_CLASS_NAMES_PATH)
+    parser.add_argument("--spec-path", default=DEFAULT_SPEC_PATH)
+    args = parser.parse_args()
+
+    report = run_batch_diagnosis(
+        args.source, args.output, batch_size=args.batch_size, prefetch=args.prefetch,
+        model_path=args.model_path, spec_path=args.spec_path, class_names_path=args.class_names_path,
+    )
+    for key, value in report.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
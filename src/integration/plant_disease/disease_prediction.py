@@ -4,16 +4,17 @@ This module provides functions for plant disease prediction from images.
 """
 import os
 import json
-import pickle
+import zipfile
 import torch
 from torch import nn
 from PIL import Image
-from typing import Tuple, List, Dict, Union, Any
+from typing import Tuple, List, Dict, Optional, Union, Any
+
+from plant_disease.preprocessing import ImagePipeline, decode_image, load_spec, preprocess_images
 
 # Default paths for model-related files
 DEFAULT_MODEL_PATH = 'plant_disease/model.pth'
-DEFAULT_ENCODER_PATH = 'plant_disease/label_encoder.pkl'
-DEFAULT_TRANSFORM_PATH = 'plant_disease/inference_transform.pkl'
+DEFAULT_SPEC_PATH = 'plant_disease/preprocessing.json'
 DEFAULT_CLASS_NAMES_PATH = 'plant_disease/class_names.json'
 
 
@@ -78,18 +79,54 @@ class PlantDiseaseModel(nn.Module):
         return x
 
 
-# Cached model, transform and encoder for faster inference
+# Cached model, transform and class names for faster inference
 _model_cache = {}
 _transform_cache = {}
-_label_encoder_cache = {}
 _class_names_cache = {}
 
 
+def load_class_names(class_names_path: str = DEFAULT_CLASS_NAMES_PATH) -> List[str]:
+    """
+    Load the class names, index i being the label of output i of the model
+    
+    Args:
+        class_names_path: Path to the class names JSON file
+        
+    Returns:
+        List of class names
+    """
+    if class_names_path not in _class_names_cache:
+        if not os.path.exists(class_names_path):
+            raise FileNotFoundError(f"Class names file not found: {class_names_path}")
+        with open(class_names_path, 'r') as f:
+            _class_names_cache[class_names_path] = json.load(f)
+    return _class_names_cache[class_names_path]
+
+
+def is_torchscript_archive(model_path: str) -> bool:
+    """
+    Check whether a model file is a TorchScript archive rather than a state dict
+    
+    Args:
+        model_path: Path to the model file
+        
+    Returns:
+        True if the file was saved with torch.jit.save
+    """
+    if not zipfile.is_zipfile(model_path):
+        return False
+    with zipfile.ZipFile(model_path) as archive:
+        return any(name.endswith('constants.pkl') for name in archive.namelist())
+
+
 def load_model(model_path: str = DEFAULT_MODEL_PATH, 
-               class_names_path: str = DEFAULT_CLASS_NAMES_PATH) -> Tuple[PlantDiseaseModel, torch.device]:
+               class_names_path: str = DEFAULT_CLASS_NAMES_PATH) -> Tuple[nn.Module, torch.device]:
     """
     Load the plant disease prediction model
     
+    The model file is either a PlantDiseaseModel state dict or a TorchScript archive
+    produced by plant_disease.export (fused fp32 or int8 quantized, CPU only).
+    
     Args:
         model_path: Path to the model file
         class_names_path: Path to the class names JSON file
@@ -104,22 +141,19 @@ def load_model(model_path: str = DEFAULT_MODEL_PATH,
     # Validate files existence
     if not os.path.exists(model_path):
         raise FileNotFoundError(f"Model file not found: {model_path}")
-    if not os.path.exists(class_names_path):
-        raise FileNotFoundError(f"Class names file not found: {class_names_path}")
-    
-    # Load class names
-    if class_names_path not in _class_names_cache:
-        with open(class_names_path, 'r') as f:
-            _class_names_cache[class_names_path] = json.load(f)
     
-    class_names = _class_names_cache[class_names_path]
-    num_classes = len(class_names)
+    num_classes = len(load_class_names(class_names_path))
     
-    # Initialize model
-    model = PlantDiseaseModel(num_classes=num_classes)
-    model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
+    if is_torchscript_archive(model_path):
+        # Exported models are optimized for CPU inference
+        device = torch.device("cpu")
+        model = torch.jit.load(model_path, map_location=device)
+    else:
+        # Initialize model
+        model = PlantDiseaseModel(num_classes=num_classes)
+        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model.to(device)
     model.eval()
     
     # Cache the model
@@ -128,47 +162,117 @@ def load_model(model_path: str = DEFAULT_MODEL_PATH,
     return model, device
 
 
-def load_transforms(transform_path: str = DEFAULT_TRANSFORM_PATH, 
-                    label_encoder_path: str = DEFAULT_ENCODER_PATH) -> Tuple[Any, Any]:
+def load_transforms(spec_path: str = DEFAULT_SPEC_PATH, 
+                    class_names_path: str = DEFAULT_CLASS_NAMES_PATH) -> Tuple[ImagePipeline, List[str]]:
     """
-    Load transformation and label encoder
+    Load the preprocessing pipeline and the index to label mapping
     
     Args:
-        transform_path: Path to the transform pickle file
-        label_encoder_path: Path to the label encoder pickle file
+        spec_path: Path to the preprocessing JSON spec
+        class_names_path: Path to the class names JSON file
         
     Returns:
-        Tuple containing transform and label encoder
+        Tuple containing the preprocessing pipeline and the class names
     """
-    # Load transform from cache if available
-    if transform_path in _transform_cache:
-        transform = _transform_cache[transform_path]
-    else:
-        if not os.path.exists(transform_path):
-            raise FileNotFoundError(f"Transform file not found: {transform_path}")
-        with open(transform_path, 'rb') as f:
-            transform = pickle.load(f)
-        _transform_cache[transform_path] = transform
-    
-    # Load label encoder from cache if available
-    if label_encoder_path in _label_encoder_cache:
-        label_encoder = _label_encoder_cache[label_encoder_path]
-    else:
-        if not os.path.exists(label_encoder_path):
-            raise FileNotFoundError(f"Label encoder file not found: {label_encoder_path}")
-        with open(label_encoder_path, 'rb') as f:
-            label_encoder = pickle.load(f)
-        _label_encoder_cache[label_encoder_path] = label_encoder
+    if spec_path not in _transform_cache:
+        _transform_cache[spec_path] = ImagePipeline.from_spec(load_spec(spec_path))
+    return _transform_cache[spec_path], load_class_names(class_names_path)
+
+
+def load_image(image_data: Union[str, bytes, Image.Image]) -> Image.Image:
+    """
+    Load an image as RGB from a file path, raw bytes or a PIL Image
     
-    return transform, label_encoder
+    Args:
+        image_data: Either a file path (str), image bytes, or a PIL Image object
+        
+    Returns:
+        RGB PIL Image
+    """
+    return decode_image(image_data)
+
+
+def predict_tensors(
+    batch: torch.Tensor,
+    model_path: str = DEFAULT_MODEL_PATH,
+    spec_path: str = DEFAULT_SPEC_PATH,
+    class_names_path: str = DEFAULT_CLASS_NAMES_PATH
+) -> List[Dict[str, Any]]:
+    """
+    Predict plant diseases for a batch of already preprocessed images
+    
+    Args:
+        batch: Tensor of shape (N, C, H, W) produced by the preprocessing pipeline
+        model_path: Path to the trained model
+        spec_path: Path to the preprocessing JSON spec
+        class_names_path: Path to the class names JSON file
+    
+    Returns:
+        List of dictionaries in the format returned by predict_from_image, in batch order
+    """
+    model, device = load_model(model_path, class_names_path)
+    _, class_names = load_transforms(spec_path, class_names_path)
+    
+    # Get predictions
+    with torch.no_grad():
+        outputs = model(batch.to(device))
+        probabilities = torch.nn.functional.softmax(outputs, dim=1)
+    
+    # Get top-3 predictions with probabilities
+    top3_probs, top3_indices = torch.topk(probabilities, 3, dim=1)
+    top3_probs = top3_probs.cpu().tolist()
+    top3_indices = top3_indices.cpu().tolist()
+    
+    results = []
+    for probs, indices in zip(top3_probs, top3_indices):
+        classes = [class_names[idx] for idx in indices]
+        results.append({
+            "prediction": classes[0],
+            "confidence": float(probs[0]) * 100,
+            "top_predictions": [
+                {"disease": class_name, "confidence": float(prob) * 100}
+                for class_name, prob in zip(classes, probs)
+            ]
+        })
+    return results
+
+
+def predict_batch(
+    images: List[Union[str, bytes, Image.Image]],
+    model_path: str = DEFAULT_MODEL_PATH,
+    spec_path: str = DEFAULT_SPEC_PATH,
+    class_names_path: str = DEFAULT_CLASS_NAMES_PATH
+) -> List[Dict[str, Any]]:
+    """
+    Predict plant diseases for several images with a single batched forward pass
+    
+    Args:
+        images: List of file paths, image bytes or PIL Image objects
+        model_path: Path to the trained model
+        spec_path: Path to the preprocessing JSON spec
+        class_names_path: Path to the class names JSON file
+    
+    Returns:
+        List of dictionaries in the format returned by predict_from_image, in input order
+    """
+    if not images:
+        return []
+
+    # Decode and transform the images in parallel into a single batch
+    transform, _ = load_transforms(spec_path, class_names_path)
+    batch = preprocess_images(images, transform, target_size=transform.image_size)
+    
+    return predict_tensors(batch, model_path, spec_path, class_names_path)
 
 
 def predict_from_image(
     image_data: Union[str, bytes, Image.Image],
+    *,
     model_path: str = DEFAULT_MODEL_PATH,
-    label_encoder_path: str = DEFAULT_ENCODER_PATH,
-    transform_path: str = DEFAULT_TRANSFORM_PATH,
-    class_names_path: str = DEFAULT_CLASS_NAMES_PATH
+    spec_path: str = DEFAULT_SPEC_PATH,
+    class_names_path: str = DEFAULT_CLASS_NAMES_PATH,
+    label_encoder_path: Optional[str] = None,
+    transform_path: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Predict plant disease from an image
@@ -176,9 +280,10 @@ def predict_from_image(
     Args:
         image_data: Either a file path (str), image bytes, or a PIL Image object
         model_path: Path to the trained model
-        label_encoder_path: Path to the saved label encoder
-        transform_path: Path to the saved transform
+        spec_path: Path to the preprocessing JSON spec
         class_names_path: Path to the class names JSON file
+        label_encoder_path: Removed, the labels come from class_names_path
+        transform_path: Removed, the preprocessing comes from spec_path
     
     Returns:
         Dictionary containing:
@@ -186,50 +291,11 @@ def predict_from_image(
             - confidence: Confidence score as percentage
             - top_predictions: List of top 3 predictions with their confidence scores
     """
-    # Load model and required files
-    model, device = load_model(model_path, class_names_path)
-    transform, label_encoder = load_transforms(transform_path, label_encoder_path)
-    
-    # Process the image based on input type
-    if isinstance(image_data, str):
-        # It's a file path
-        if not os.path.exists(image_data):
-            raise FileNotFoundError(f"Image file not found: {image_data}")
-        image = Image.open(image_data).convert('RGB')
-    elif isinstance(image_data, bytes):
-        # It's image bytes
-        import io
-        image = Image.open(io.BytesIO(image_data)).convert('RGB')
-    elif isinstance(image_data, Image.Image):
-        # It's already a PIL Image
-        image = image_data.convert('RGB')
-    else:
-        raise ValueError("Image data must be a file path, image bytes, or PIL Image object")
-    
-    # Preprocess image
-    image_tensor = transform(image).unsqueeze(0).to(device)
-    
-    # Get prediction
-    with torch.no_grad():
-        outputs = model(image_tensor)
-        probabilities = torch.nn.functional.softmax(outputs, dim=1)[0]
-    
-    # Get top prediction
-    top_prob, top_class = torch.max(probabilities, 0)
-    predicted_class = label_encoder.inverse_transform([top_class.item()])[0]
-    confidence = float(top_prob.item()) * 100
-    
-    # Get top-3 predictions with probabilities
-    top3_probs, top3_indices = torch.topk(probabilities, 3)
-    top3_classes = label_encoder.inverse_transform([idx.item() for idx in top3_indices])
-    top3_results = [
-        {"disease": class_name, "confidence": float(prob.item()) * 100} 
-        for class_name, prob in zip(top3_classes, top3_probs)
-    ]
-    
-    # Return structured results
-    return {
-        "prediction": predicted_class,
-        "confidence": confidence,
-        "top_predictions": top3_results
-    }
+    # The pickled transform and label encoder were replaced by the JSON spec and the class names
+    if label_encoder_path is not None or transform_path is not None:
+        raise TypeError(
+            "predict_from_image no longer accepts label_encoder_path or transform_path: pass the "
+            "preprocessing JSON spec (preprocessing.json) as spec_path and the labels "
+            "as class_names_path"
+        )
+    return predict_batch([image_data], model_path, spec_path, class_names_path)[0]
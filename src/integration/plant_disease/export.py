@@ -0,0 +1,213 @@
+"""
+Plant Disease Prediction - CPU export module
+This module fuses Conv+BatchNorm+ReLU blocks, exports TorchScript artifacts (fp32 or
+int8 statically quantized with calibration on part of the bundled images) and checks
+their top-1 agreement and latency against the fp32 eager model. Parity is measured on
+images held out from the calibration. The fused fp32 TorchScript export is not always
+faster than the eager model on CPU, the parity report says when it is slower.
+
+Usage (from src/integration):
+    python -m plant_disease.export --mode int8 --output plant_disease/model_int8.pt
+"""
+import os
+import copy
+import time
+import random
+import argparse
+import torch
+from torch import nn
+from torch.ao.quantization import fuse_modules, QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+from typing import Any, Callable, Dict, List, Tuple
+
+from plant_disease.disease_prediction import (
+    PlantDiseaseModel, DEFAULT_MODEL_PATH, DEFAULT_CLASS_NAMES_PATH, DEFAULT_SPEC_PATH,
+    load_model, load_transforms, load_image
+)
+from plant_disease.preprocessing import list_images, DEFAULT_IMAGES_DIR
+
+DEFAULT_SCRIPTED_MODEL_PATH = 'plant_disease/model_scripted.pt'
+DEFAULT_QUANTIZED_MODEL_PATH = 'plant_disease/model_int8.pt'
+CONV_BLOCKS = ('conv_block1', 'conv_block2', 'conv_block3', 'conv_block4', 'conv_block5')
+
+
+class QuantizablePlantDiseaseModel(nn.Module):
+    """PlantDiseaseModel wrapped with quantization stubs for eager static quantization"""
+    def __init__(self, model: PlantDiseaseModel):
+        super(QuantizablePlantDiseaseModel, self).__init__()
+        self.quant = QuantStub()
+        self.model = model
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.model(self.quant(x)))
+
+
+def fuse_model(model: PlantDiseaseModel) -> PlantDiseaseModel:
+    """
+    Fuse Conv+BatchNorm+ReLU in every convolutional block and Linear+ReLU in the classifier
+
+    Args:
+        model: Model in eval mode
+
+    Returns:
+        Fused copy of the model
+    """
+    fused = copy.deepcopy(model).cpu().eval()
+    # Quantized convolutions need explicit padding; "same" equals k // 2 for the odd 3x3 kernels used here
+    for module in fused.modules():
+        if isinstance(module, nn.Conv2d) and module.padding == 'same':
+            module.padding = tuple(k // 2 for k in module.kernel_size)
+    for block in CONV_BLOCKS:
+        fuse_modules(getattr(fused, block), [['0', '1', '2']], inplace=True)
+    fuse_modules(fused.fc_block, [['1', '2']], inplace=True)
+    return fused
+
+
+def quantize_model(model: PlantDiseaseModel, calibration_images: List[str], transform: Callable,
+                   backend: str = 'x86', batch_size: int = 16) -> nn.Module:
+    """
+    Apply post-training int8 static quantization calibrated on sample images
+
+    Args:
+        model: fp32 model
+        calibration_images: Paths of the images used to calibrate activation ranges
+        transform: Preprocessing transform applied to the calibration images
+        backend: Quantized engine ('x86', 'fbgemm' or 'qnnpack' on ARM)
+        batch_size: Number of calibration images per forward pass
+
+    Returns:
+        Quantized model
+    """
+    torch.backends.quantized.engine = backend
+    quantizable = QuantizablePlantDiseaseModel(fuse_model(model)).eval()
+    quantizable.qconfig = get_default_qconfig(backend)
+    prepared = prepare(quantizable)
+    with torch.no_grad():
+        for start in range(0, len(calibration_images), batch_size):
+            paths = calibration_images[start:start + batch_size]
+            prepared(torch.stack([transform(load_image(path)) for path in paths]))
+    return convert(prepared)
+
+
+def split_images(images: List[str], calibration_fraction: float = 0.5,
+                 seed: int = 0) -> Tuple[List[str], List[str]]:
+    """
+    Split images into disjoint calibration and evaluation sets
+
+    Args:
+        images: Paths of the images
+        calibration_fraction: Fraction of the images used for calibration
+        seed: Seed of the shuffle, so that the split is reproducible
+
+    Returns:
+        Tuple containing the calibration images and the evaluation images
+    """
+    if not 0 < calibration_fraction < 1:
+        raise ValueError(f"calibration_fraction must be between 0 and 1, got {calibration_fraction}")
+    if len(images) < 2:
+        raise ValueError("At least two images are needed to calibrate and evaluate on disjoint sets")
+    shuffled = sorted(images)
+    random.Random(seed).shuffle(shuffled)
+    split = min(max(1, round(len(shuffled) * calibration_fraction)), len(shuffled) - 1)
+    return shuffled[:split], shuffled[split:]
+
+
+def export_torchscript(model: nn.Module, output_path: str, image_size: int = 256) -> torch.jit.ScriptModule:
+    """
+    Trace, freeze and save a model as a TorchScript archive loadable by load_model
+
+    Args:
+        model: Model to export
+        output_path: Destination of the TorchScript archive
+        image_size: Height and width of the example input
+
+    Returns:
+        The exported TorchScript module
+    """
+    model = model.cpu().eval()
+    example = torch.rand(1, 3, image_size, image_size)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model, example))
+    scripted.save(output_path)
+    return scripted
+
+
+def check_parity(reference: nn.Module, candidate: nn.Module, images: List[str], transform: Callable,
+                 warmup: int = 3) -> Dict[str, Any]:
+    """
+    Compare a candidate model with the reference fp32 model on single-image CPU inference
+
+    Args:
+        reference: fp32 eager model
+        candidate: Exported or quantized model
+        images: Paths of the evaluation images
+        transform: Preprocessing transform
+        warmup: Number of untimed forward passes per model
+
+    Returns:
+        Dictionary containing top-1 agreement, mean latencies in milliseconds and the speedup
+        of the candidate (below 1 when it is slower than the reference)
+    """
+    tensors = [transform(load_image(path)).unsqueeze(0) for path in images]
+    timings = {}
+    predictions = {}
+    with torch.no_grad():
+        for name, model in (("reference", reference.cpu().eval()), ("candidate", candidate)):
+            for tensor in tensors[:warmup]:
+                model(tensor)
+            start = time.perf_counter()
+            predictions[name] = [int(model(tensor).argmax(dim=1)) for tensor in tensors]
+            timings[name] = (time.perf_counter() - start) * 1000 / len(tensors)
+
+    agreement = sum(r == c for r, c in zip(predictions["reference"], predictions["candidate"])) / len(tensors)
+    return {
+        "images": len(tensors),
+        "top1_agreement": agreement,
+        "reference_latency_ms": timings["reference"],
+        "candidate_latency_ms": timings["candidate"],
+        "speedup": timings["reference"] / timings["candidate"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export PlantDiseaseModel for CPU inference")
+    parser.add_argument("--mode", choices=["fp32", "int8"], default="int8")
+    parser.add_argument("--model-path", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--class-names-path", default=DEFAULT_CLASS_NAMES_PATH)
+    parser.add_argument("--spec-path", default=DEFAULT_SPEC_PATH)
+    parser.add_argument("--images-dir", default=DEFAULT_IMAGES_DIR)
+    parser.add_argument("--backend", default="x86")
+    parser.add_argument("--calibration-fraction", type=float, default=0.5,
+                        help="Fraction of the images used to calibrate int8, the rest measures parity")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    model, _ = load_model(args.model_path, args.class_names_path)
+    model = model.cpu().eval()
+    transform, _ = load_transforms(args.spec_path, args.class_names_path)
+    images = list_images(args.images_dir)
+
+    if args.mode == "int8":
+        # Agreement measured on the calibration images would overstate the int8 accuracy
+        calibration_images, eval_images = split_images(images, args.calibration_fraction)
+        optimized = quantize_model(model, calibration_images, transform, backend=args.backend)
+        output_path = args.output or DEFAULT_QUANTIZED_MODEL_PATH
+    else:
+        calibration_images, eval_images = [], images
+        optimized = fuse_model(model)
+        output_path = args.output or DEFAULT_SCRIPTED_MODEL_PATH
+
+    scripted = export_torchscript(optimized, output_path)
+    report = check_parity(model, scripted, eval_images, transform)
+    report["calibration_images"] = len(calibration_images)
+    report["artifact_size_mb"] = os.path.getsize(output_path) / 2**20
+    print(f"Exported {args.mode} model to {output_path}")
+    for key, value in report.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+    if report["speedup"] < 1:
+        print(f"The exported {args.mode} model is slower than the eager model on this CPU "
+              f"({report['speedup']:.2f}x), keep serving {args.model_path}")
+
+
+if __name__ == "__main__":
+    main()
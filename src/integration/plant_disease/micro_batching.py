@@ -0,0 +1,112 @@
+"""
+Plant Disease Prediction - Micro-batching dispatcher
+This module groups concurrent prediction requests into batches so that a single
+forward pass serves many uploaded images.
+"""
+import queue
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from PIL import Image
+from typing import Any, Dict, Optional, Union
+
+from plant_disease.disease_prediction import predict_batch
+
+_STOP = object()
+
+
+class MicroBatchPredictor:
+    """
+    Collect concurrent predict requests and run them through predict_batch together.
+
+    A batch is dispatched as soon as max_batch_size requests are waiting, or when
+    max_wait_ms has elapsed since the first request of the batch arrived.
+    """
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 10.0, **predict_kwargs):
+        """
+        Args:
+            max_batch_size: Maximum number of images per forward pass
+            max_wait_ms: Maximum time a request waits for others to join its batch
+            predict_kwargs: Model and transform paths forwarded to predict_batch
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.predict_kwargs = predict_kwargs
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="plant-disease-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, image_data: Union[str, bytes, Image.Image]) -> Future:
+        """
+        Queue an image for prediction.
+
+        Args:
+            image_data: Either a file path (str), image bytes, or a PIL Image object
+
+        Returns:
+            Future resolved with the predict_from_image result for this image
+        """
+        future = Future()
+        self._queue.put((image_data, future))
+        return future
+
+    def predict(self, image_data: Union[str, bytes, Image.Image], timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Blocking equivalent of predict_from_image going through the batcher.
+        """
+        return self.submit(image_data).result(timeout=timeout)
+
+    async def apredict(self, image_data: Union[str, bytes, Image.Image]) -> Dict[str, Any]:
+        """
+        Asyncio equivalent of predict_from_image going through the batcher.
+        """
+        return await asyncio.wrap_future(self.submit(image_data))
+
+    def close(self) -> None:
+        """
+        Stop the dispatcher once the queued requests have been served.
+        """
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._dispatch(batch)
+            if stop:
+                return
+
+    def _dispatch(self, batch) -> None:
+        batch = [(image_data, future) for image_data, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = predict_batch([image_data for image_data, _ in batch], **self.predict_kwargs)
+        except Exception:
+            # Isolate the failing request(s) instead of failing the whole batch
+            for image_data, future in batch:
+                try:
+                    future.set_result(predict_batch([image_data], **self.predict_kwargs)[0])
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
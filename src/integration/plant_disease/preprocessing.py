@@ -0,0 +1,206 @@
+"""
+Plant Disease Prediction - Image preprocessing
+This module decodes uploaded images and turns them into model-ready tensors. Large
+JPEGs are decoded at reduced resolution (PIL draft mode) and batches are decoded and
+transformed in a thread pool, since PIL releases the GIL while decoding.
+
+The preprocessing itself is described by a small JSON spec (preprocessing.json) and run
+by ImagePipeline with PIL and torch only: resize in PIL, then a single normalization
+of the whole uint8 batch.
+"""
+import io
+import os
+import json
+import torch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Input size of PlantDiseaseModel, used to pick the JPEG draft scale
+DEFAULT_IMAGE_SIZE = (256, 256)
+DEFAULT_IMAGES_DIR = 'plant_disease/images'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+INTERPOLATIONS = {
+    'nearest': Image.NEAREST,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+}
+
+_executor = None
+
+
+class ImagePipeline:
+    """
+    Resize and normalize images as described by a preprocessing spec.
+
+    Equivalent to Resize(image_size) + ToTensor() + Normalize(mean, std) on PIL images,
+    without importing torchvision.
+    """
+    def __init__(self, image_size: Sequence[int] = DEFAULT_IMAGE_SIZE, mean: Sequence[float] = (0.0, 0.0, 0.0),
+                 std: Sequence[float] = (1.0, 1.0, 1.0), interpolation: str = 'bilinear'):
+        """
+        Args:
+            image_size: Output (height, width)
+            mean: Per-channel mean, on the [0, 1] scale
+            std: Per-channel standard deviation, on the [0, 1] scale
+            interpolation: Resampling filter ('nearest', 'bilinear' or 'bicubic')
+        """
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f"Unsupported interpolation: {interpolation}")
+        self.image_size = tuple(image_size)
+        self.interpolation = interpolation
+        self._resample = INTERPOLATIONS[interpolation]
+        # (x / 255 - mean) / std folded into a single subtract and multiply on the uint8 values
+        self._offset = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1) * 255
+        self._scale = 1 / (torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1) * 255)
+
+    @classmethod
+    def from_spec(cls, spec: Dict[str, Any]) -> "ImagePipeline":
+        return cls(spec['image_size'], spec['mean'], spec['std'], spec.get('interpolation', 'bilinear'))
+
+    def to_array(self, image: Image.Image) -> np.ndarray:
+        """
+        Resize an RGB image to the model input size
+
+        Args:
+            image: RGB PIL Image
+
+        Returns:
+            uint8 array of shape (H, W, C)
+        """
+        height, width = self.image_size
+        if image.size != (width, height):
+            image = image.resize((width, height), self._resample)
+        return np.asarray(image, dtype=np.uint8)
+
+    def normalize(self, arrays: np.ndarray) -> torch.Tensor:
+        """
+        Normalize a batch of resized images
+
+        Args:
+            arrays: uint8 array of shape (N, H, W, C)
+
+        Returns:
+            float32 tensor of shape (N, C, H, W)
+        """
+        batch = torch.from_numpy(arrays).permute(0, 3, 1, 2).float()
+        return batch.sub_(self._offset).mul_(self._scale).contiguous()
+
+    def __call__(self, image: Image.Image) -> torch.Tensor:
+        return self.normalize(self.to_array(image)[None])[0]
+
+
+def load_spec(spec_path: str) -> Dict[str, Any]:
+    """
+    Read a preprocessing spec
+
+    Args:
+        spec_path: Path to the preprocessing JSON file
+
+    Returns:
+        Dictionary with image_size, interpolation, mean and std
+    """
+    if not os.path.exists(spec_path):
+        raise FileNotFoundError(f"Preprocessing spec not found: {spec_path}")
+    with open(spec_path, 'r') as f:
+        return json.load(f)
+
+
+def decode_image(image_data: Union[str, bytes, Image.Image],
+                 target_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """
+    Decode an image as RGB, at reduced resolution for JPEGs larger than the target size
+
+    Args:
+        image_data: Either a file path (str), image bytes, or a PIL Image object
+        target_size: Size the image will be resized to; JPEGs are decoded at the smallest
+            scale (1/2, 1/4 or 1/8) that stays at least this large. None decodes at full size
+
+    Returns:
+        RGB PIL Image
+    """
+    if isinstance(image_data, str):
+        # It's a file path
+        if not os.path.exists(image_data):
+            raise FileNotFoundError(f"Image file not found: {image_data}")
+        image = Image.open(image_data)
+    elif isinstance(image_data, bytes):
+        # It's image bytes
+        image = Image.open(io.BytesIO(image_data))
+    elif isinstance(image_data, Image.Image):
+        # It's already a PIL Image, draft mode only applies if it has not been loaded yet
+        image = image_data
+    else:
+        raise ValueError("Image data must be a file path, image bytes, or PIL Image object")
+
+    if target_size is not None and image.format == 'JPEG':
+        image.draft('RGB', target_size)
+    return image.convert('RGB')
+
+
+def list_images(images_dir: str = DEFAULT_IMAGES_DIR) -> List[str]:
+    """
+    List the images of a directory tree whose sub-folders are named after the classes
+
+    Args:
+        images_dir: Root directory of the images
+
+    Returns:
+        Sorted list of image paths
+    """
+    paths = []
+    for root, _, files in os.walk(images_dir):
+        paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def get_executor(max_workers: Optional[int] = None) -> ThreadPoolExecutor:
+    """
+    Get the shared thread pool used to decode and transform images
+
+    Args:
+        max_workers: Number of threads, only used when the pool is first created
+
+    Returns:
+        ThreadPoolExecutor shared by the process
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers or min(8, os.cpu_count() or 1),
+                                       thread_name_prefix="plant-disease-preprocess")
+    return _executor
+
+
+def preprocess_images(images: List[Union[str, bytes, Image.Image]], transform: Callable,
+                      target_size: Optional[Tuple[int, int]] = DEFAULT_IMAGE_SIZE,
+                      executor: Optional[ThreadPoolExecutor] = None) -> torch.Tensor:
+    """
+    Decode and transform images into a single batch tensor
+
+    Args:
+        images: List of file paths, image bytes or PIL Image objects
+        transform: ImagePipeline, or any transform turning a PIL Image into a (C, H, W) tensor
+        target_size: Model input size, used for reduced JPEG decoding
+        executor: Thread pool to use, defaults to the shared one
+
+    Returns:
+        Tensor of shape (len(images), C, H, W)
+    """
+    if isinstance(transform, ImagePipeline):
+        # Resize in the pool, then normalize the whole uint8 batch at once
+        def prepare(image_data):
+            return transform.to_array(decode_image(image_data, target_size))
+    else:
+        def prepare(image_data):
+            return transform(decode_image(image_data, target_size))
+
+    if len(images) == 1:
+        prepared = [prepare(images[0])]
+    else:
+        prepared = list((executor or get_executor()).map(prepare, images))
+
+    if isinstance(transform, ImagePipeline):
+        return transform.normalize(np.stack(prepared))
+    return torch.stack(prepared)
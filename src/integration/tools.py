@@ -0,0 +1,57 @@
+"""
+Agent Tools - Weather and web search tools of the expert agents
+This module holds the tools used by the weather and web search ReAct agents. Each tool
+has a blocking and an asyncio version. Weather goes through the shared WeatherProvider
+cache and search results are fetched concurrently through the shared PageFetcher.
+Every tool call is recorded as a span of the current request.
+"""
+import asyncio
+from duckduckgo_search import DDGS
+from llama_index.core.tools import FunctionTool
+from typing import List
+
+from tracing import get_tracer, span
+from weather import get_weather_provider
+from web_fetch import get_page_fetcher
+
+get_tracer().register_stats("weather", lambda: get_weather_provider().stats())
+get_tracer().register_stats("page_fetcher", lambda: get_page_fetcher().stats())
+
+
+def get_weather(location: str) -> str:
+    """Get the current weather and the forecast of the next days for a location."""
+    with span("tool.get_weather"):
+        return get_weather_provider().report(location)
+
+
+async def aget_weather(location: str) -> str:
+    """Get the current weather and the forecast of the next days for a location."""
+    with span("tool.get_weather"):
+        return await get_weather_provider().areport(location)
+
+
+def _search_urls(query: str, max_results: int) -> List[str]:
+    return [response['href'] for response in DDGS().text(query, max_results=max_results)]
+
+
+def web_search(query: str, max_results: int = 3) -> str:
+    """Get the results of a web search."""
+    with span("tool.web_search") as search_span:
+        # Same fetcher as aweb_search, run on its own event loop
+        pages = get_page_fetcher().fetch_many_blocking(_search_urls(query, max_results))
+        search_span.set(pages=sum(1 for page in pages if page))
+    return "".join(f"{page}\n\n" for page in pages if page)
+
+
+async def aweb_search(query: str, max_results: int = 3) -> str:
+    """Get the results of a web search."""
+    with span("tool.web_search") as search_span:
+        urls = await asyncio.to_thread(_search_urls, query, max_results)
+        # Pages are fetched concurrently, cached by URL and kept in search order
+        pages = await get_page_fetcher().fetch_many(urls)
+        search_span.set(pages=sum(1 for page in pages if page))
+    return "".join(f"{page}\n\n" for page in pages if page)
+
+
+weather_tool = FunctionTool.from_defaults(fn=get_weather, async_fn=aget_weather)
+web_search_tool = FunctionTool.from_defaults(fn=web_search, async_fn=aweb_search)
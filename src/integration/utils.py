@@ -1,111 +1,345 @@
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import VectorParams, Distance, Batch
 import os
+import glob
+import json
+import sys
+import hashlib
 
-import pickle
+from typing import Any, Optional
 
-from pathlib import Path
-from rank_bm25 import BM25Okapi
-import nltk
+# Retrieval modules live in src/RAG
+RAG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RAG")
+if RAG_DIR not in sys.path:
+    sys.path.append(RAG_DIR)
 
+from bm25_index import BM25Index, files_fingerprint, load_or_build_bm25_index
+from sparse_bm25 import SparseBM25
+from retriever import HybridRetriever, load_or_build_chunk_bm25
+from embedding_cache import EmbeddingCache
+from embedding_store import STORE_META_FILE, EmbeddingStore, load_embedding_store
+from vector_index import LocalVectorIndex
+from answer_cache import SemanticAnswerCache
+from tracing import Tracer, get_tracer
+from intent_router import (
+    IntentRouter, DEFAULT_TRAIN_FILE, DEFAULT_MODEL_PATH as DEFAULT_INTENT_MODEL_PATH, load_or_train_intent_model,
+    remote_intent_classifier, async_remote_intent_classifier
+)
 
-def initialize_qdrant() -> QdrantClient:
+DEFAULT_EMBEDDINGS_FILE = os.path.join("..", "RAG", "document_embeddings.pkl")
+DEFAULT_EMBEDDINGS_STORE = os.path.join("..", "RAG", "indexes", "document_embeddings")
+DEFAULT_QDRANT_PATH = os.path.join("..", "RAG", "indexes", "qdrant")
+QDRANT_MANIFEST_FILE = "agroflow_manifest.json"
+DEFAULT_BM25_SOURCE_DIR = os.path.join("..", "..", "data", "md", "technical_reports")
+DEFAULT_BM25_INDEX_DIR = os.path.join("..", "RAG", "indexes", "bm25", "technical_reports")
+DEFAULT_CHUNK_BM25_INDEX_DIR = os.path.join("..", "RAG", "indexes", "bm25", "technical_reports_chunks")
+DEFAULT_EMBEDDING_CACHE_PATH = os.path.join("..", "RAG", "indexes", "embedding_cache.sqlite")
+DEFAULT_TRACES_PATH = os.path.join("..", "RAG", "indexes", "traces.jsonl")
+
+
+def initialize_embedding_store(embeddings_file: str = DEFAULT_EMBEDDINGS_FILE,
+                               store_dir: str = DEFAULT_EMBEDDINGS_STORE, dtype: Optional[str] = None) -> EmbeddingStore:
+    """
+    Open the memory-mapped document embeddings, converting the pickle on first use.
+
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings
+        store_dir: Directory of the store converted from the pickle
+        dtype: Storage type of the vectors, float32 or float16, see load_embedding_store
+
+    Returns:
+        EmbeddingStore: Store shared through the page cache by every process opening it
+    """
+    return load_embedding_store(embeddings_file, store_dir, dtype=dtype)
+
+
+def _read_qdrant_manifest(storage_path: str) -> dict:
+    manifest_path = os.path.join(storage_path, QDRANT_MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_qdrant_manifest(storage_path: str, manifest: dict) -> None:
+    manifest_path = os.path.join(storage_path, QDRANT_MANIFEST_FILE)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def initialize_qdrant(embeddings_file: str = DEFAULT_EMBEDDINGS_FILE,
+                      storage_path: Optional[str] = DEFAULT_QDRANT_PATH,
+                      collection_name: str = "technical_reports",
+                      batch_size: int = 256,
+                      store_dir: str = DEFAULT_EMBEDDINGS_STORE) -> QdrantClient:
     """
     Initialize Qdrant vector database client and load document embeddings.
-    
+
+    The collection is stored in a local persistent Qdrant path and is reused as long as
+    the embeddings have not changed. Otherwise it is rebuilt with batched upserts.
+
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings converted
+            once to a store, see initialize_embedding_store
+        storage_path: Local Qdrant storage directory, or None to use an in-memory collection
+        collection_name: Name of the collection holding the embeddings
+        batch_size: Number of points sent per upsert call
+        store_dir: Directory of the store converted from a pickled embeddings file
+
     Returns:
         QdrantClient: Initialized Qdrant client
     """
-    # Create Qdrant client - using :memory: for testing, but in production should use a persistent storage
-    qdrant_client = QdrantClient(":memory:")
-    
-    # Load document embeddings if the pickle file exists
-    embeddings_file = os.path.join("..", "RAG", "document_embeddings.pkl")
-    if os.path.exists(embeddings_file):
-        try:
-            with open(embeddings_file, "rb") as f:
-                document_embeddings = pickle.load(f)
-                
-            # Create collections for different document types if they don't exist
-            collection_name = "technical_reports"
-            # Check if collection exists
-            try:
-                qdrant_client.get_collection(collection_name=collection_name)
-            except Exception:
-                # Create collection if it doesn't exist
-                qdrant_client.create_collection(
-                    collection_name=collection_name,
-                    vectors_config=VectorParams(size=1024, distance=Distance.COSINE)
-                )
-            
-            # Process tabular structured embeddings and create points for Qdrant
-            collection_points = []
-            
-            # Format of embeddings_file: id  vector  payload
-            # Where id column contains UUIDs that should be used as Qdrant IDs
-            for _, row in document_embeddings.iterrows():
-                try:
-                    # Extract UUID from the id column to use as the actual Qdrant ID
-                    point_id = row['id']
-                    vector = row['vector']
-                    payload = row['payload']
-                    
-                    collection_points.append(
-                        PointStruct(
-                            id=point_id,
-                            vector=vector,
-                            payload=payload
-                        )
-                    )
-                except Exception as e:
-                    print(f"Error processing embedding row: {e}")
-                    continue
-                
-                # Only upsert if there are points for this collection
-                if collection_points:
-                    qdrant_client.upsert(
-                        collection_name=collection_name,
-                        points=collection_points
-                    )
-
-            print(f"Loaded {len(collection_points)} document embeddings for {collection_name}")
-            print("Document embeddings loaded successfully")
-            
-        except Exception as e:
-            print(f"Error loading document embeddings: {str(e)}")
+    if storage_path:
+        os.makedirs(storage_path, exist_ok=True)
+        qdrant_client = QdrantClient(path=storage_path)
     else:
+        qdrant_client = QdrantClient(":memory:")
+
+    # Load document embeddings if the embeddings file exists
+    if not os.path.exists(embeddings_file):
         print(f"Document embeddings file not found at {embeddings_file}")
-    
+        return qdrant_client
+
+    try:
+        store = initialize_embedding_store(embeddings_file, store_dir)
+        fingerprint = store.fingerprint
+
+        # Check if the persisted collection was built from the same embeddings file
+        collection_exists = True
+        try:
+            qdrant_client.get_collection(collection_name=collection_name)
+        except Exception:
+            collection_exists = False
+
+        manifest = _read_qdrant_manifest(storage_path) if storage_path else {}
+        if collection_exists and manifest.get(collection_name) == fingerprint:
+            print(f"Reusing persisted collection {collection_name} from {storage_path}")
+            return qdrant_client
+
+        if collection_exists:
+            qdrant_client.delete_collection(collection_name=collection_name)
+
+        # Ids of the store are UUIDs that are used as Qdrant IDs
+        ids, vectors, payloads = store.ids, store.matrix(), store.payloads
+
+        qdrant_client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vectors.shape[1], distance=Distance.COSINE)
+        )
+
+        # Upsert fixed-size slices of the matrix instead of re-sending every point
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            qdrant_client.upsert(
+                collection_name=collection_name,
+                points=Batch(
+                    ids=ids[start:end],
+                    vectors=vectors[start:end].tolist(),
+                    payloads=payloads[start:end]
+                )
+            )
+
+        if storage_path:
+            manifest[collection_name] = fingerprint
+            _write_qdrant_manifest(storage_path, manifest)
+
+        print(f"Loaded {len(ids)} document embeddings for {collection_name}")
+        print("Document embeddings loaded successfully")
+
+    except Exception as e:
+        print(f"Error loading document embeddings: {str(e)}")
+
     return qdrant_client
 
 
-def initialize_bm25() -> BM25Okapi:
-    input_dir = Path("../../data/md/technical_reports")
-    output_dir = Path("../../data/txt/technical_reports")
-    output_dir.mkdir(parents=True, exist_ok=True)
+def initialize_vector_index(embeddings_file: str = DEFAULT_EMBEDDINGS_FILE,
+                            store_dir: str = DEFAULT_EMBEDDINGS_STORE,
+                            collection_name: str = "technical_reports", mode: str = "auto") -> LocalVectorIndex:
+    """
+    Initialize the in-process vector index, an alternative to initialize_qdrant.
+
+    The index answers the same query_points, query_batch_points and retrieve calls as the
+    Qdrant client, directly over the memory-mapped embedding store.
+
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings
+        store_dir: Directory of the store converted from a pickled embeddings file
+        collection_name: Name under which the embeddings are queried
+        mode: "exact", "ivf", or "auto" to pick IVF for large collections
+
+    Returns:
+        LocalVectorIndex: Index usable wherever the Qdrant client is
+    """
+    store = initialize_embedding_store(embeddings_file, store_dir)
+    index = LocalVectorIndex.from_store(store, collection_name=collection_name, mode=mode)
+    print(f"Indexed {len(store)} document embeddings for {collection_name} ({index.collections[collection_name].mode} search)")
+    return index
+
+
+def initialize_bm25_index(input_dir: str = DEFAULT_BM25_SOURCE_DIR,
+                          index_dir: str = DEFAULT_BM25_INDEX_DIR) -> BM25Index:
+    """
+    Load the persisted BM25 index of the technical reports, rebuilding it if the reports changed.
+
+    Args:
+        input_dir: Directory containing the markdown reports
+        index_dir: Directory where the pre-tokenized index is stored
+
+    Returns:
+        BM25Index: Index whose names are the markdown file names, in scoring order
+    """
+    return load_or_build_bm25_index(input_dir, index_dir)
+
+
+def initialize_bm25(input_dir: str = DEFAULT_BM25_SOURCE_DIR,
+                    index_dir: str = DEFAULT_BM25_INDEX_DIR) -> SparseBM25:
+    """
+    Initialize an inverted-index BM25 scorer over the technical reports from the persisted index.
+
+    Args:
+        input_dir: Directory containing the markdown reports
+        index_dir: Directory where the pre-tokenized index is stored
+
+    Returns:
+        SparseBM25: BM25Okapi-compatible scorer whose documents follow its names attribute
+    """
+    return SparseBM25(initialize_bm25_index(input_dir, index_dir))
+
+
+def initialize_retriever(client: Any, qdrant_client: QdrantClient,
+                         embeddings_file: str = DEFAULT_EMBEDDINGS_FILE,
+                         index_dir: str = DEFAULT_CHUNK_BM25_INDEX_DIR,
+                         collection_name: str = "technical_reports",
+                         embedding_cache: Optional[EmbeddingCache] = None,
+                         store_dir: str = DEFAULT_EMBEDDINGS_STORE) -> HybridRetriever:
+    """
+    Initialize the chunk-level hybrid retriever used to answer policy questions.
+
+    Args:
+        client: Mistral client used to embed queries
+        qdrant_client: Qdrant client returned by initialize_qdrant, or initialize_vector_index
+        embeddings_file: Embedding store directory, or pickled document embeddings
+        index_dir: Directory where the chunk BM25 index is stored
+        collection_name: Qdrant collection to search
+        embedding_cache: Cache used to embed queries, see initialize_embedding_cache
+        store_dir: Directory of the store converted from a pickled embeddings file
+
+    Returns:
+        HybridRetriever: Retriever over the chunks of the collection
+    """
+    bm25 = load_or_build_chunk_bm25(embeddings_file, index_dir, store_dir=store_dir)
+    return HybridRetriever(client, qdrant_client, bm25, collection_name=collection_name,
+                           embedding_cache=embedding_cache)
+
+
+def initialize_embedding_cache(client: Any, db_path: Optional[str] = DEFAULT_EMBEDDING_CACHE_PATH,
+                               max_entries: int = 4096, ttl: Optional[float] = None) -> EmbeddingCache:
+    """
+    Initialize the query embedding cache, persisted in SQLite so it survives restarts.
+
+    Args:
+        client: Mistral client used on cache misses
+        db_path: Path of the SQLite store, or None for an in-memory only cache
+        max_entries: Maximum number of embeddings kept in memory
+        ttl: Time to live of an entry in seconds, None to never expire
+
+    Returns:
+        EmbeddingCache: The embedding cache
+    """
+    if db_path:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    cache = EmbeddingCache(client, max_entries=max_entries, ttl=ttl, db_path=db_path)
+    get_tracer().register_stats("embedding_cache", cache.stats)
+    return cache
+
+
+def initialize_intent_router(client: Any = None, train_file: str = DEFAULT_TRAIN_FILE,
+                             threshold: float = 0.9, model_path: str = DEFAULT_INTENT_MODEL_PATH) -> IntentRouter:
+    """
+    Load the local intent model, trained only when the training data changed, and put it in
+    front of the fine-tuned remote classifier.
+
+    Args:
+        client: Mistral client used for ambiguous queries, None to route locally only
+        train_file: JSONL file the local model is trained on
+        threshold: Minimum local probability to skip the remote classifier
+        model_path: File the trained local model is saved to
+
+    Returns:
+        IntentRouter: The intent router
+    """
+    local_model = load_or_train_intent_model(train_file, model_path)
+    if client is None:
+        return IntentRouter(local_model, threshold=threshold)
+    return IntentRouter(local_model, remote_intent_classifier(client), threshold=threshold,
+                        async_remote_classifier=async_remote_intent_classifier(client))
+
+
+def corpus_version(embeddings_file: str = DEFAULT_EMBEDDINGS_FILE,
+                   reports_dir: str = DEFAULT_BM25_SOURCE_DIR) -> str:
+    """
+    Fingerprint the policy corpus, i.e. the embeddings file and the technical reports.
+
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings
+        reports_dir: Directory of the markdown technical reports
 
-    for md_file in input_dir.glob("*.md"):
-        with open(md_file, "r", encoding="utf-8") as f_in:
-            content = f_in.read()
-        txt_file = output_dir / (md_file.stem + ".txt")
-        with open(txt_file, "w", encoding="utf-8") as f_out:
-            f_out.write(content)
+    Returns:
+        str: Hex digest that changes whenever the embeddings or a report change
+    """
+    if os.path.isdir(embeddings_file):
+        # A store records the fingerprint of its content, and is replaced as a whole when saved
+        meta_path = os.path.join(embeddings_file, STORE_META_FILE)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                embeddings_version = json.load(f).get("fingerprint") or files_fingerprint([meta_path])
+        except (OSError, ValueError):
+            embeddings_version = "missing"
+    elif os.path.exists(embeddings_file):
+        embeddings_version = files_fingerprint([embeddings_file])
+    else:
+        # No embeddings yet, the version changes once they are written
+        embeddings_version = "missing"
+    reports_version = files_fingerprint(glob.glob(os.path.join(reports_dir, "*.md")))
+    return hashlib.sha256(f"{embeddings_version}:{reports_version}".encode("utf-8")).hexdigest()
 
 
-    nltk.download("punkt")
+def initialize_answer_cache(embeddings_file: str = DEFAULT_EMBEDDINGS_FILE,
+                            reports_dir: str = DEFAULT_BM25_SOURCE_DIR,
+                            threshold: float = 0.93, max_entries: int = 1024) -> SemanticAnswerCache:
+    """
+    Initialize the semantic answer cache, cleared whenever the policy corpus changes.
 
-    input_dir = "../../data/txt/technical_reports"
+    Args:
+        embeddings_file: Embedding store directory, or pickled document embeddings
+        reports_dir: Directory of the markdown technical reports
+        threshold: Minimum cosine similarity between two questions to reuse an answer,
+            see answer_cache.threshold_from_similarities
+        max_entries: Maximum number of cached answers
+
+    Returns:
+        SemanticAnswerCache: The answer cache
+    """
+    return SemanticAnswerCache(threshold=threshold, max_entries=max_entries,
+                               version_fn=lambda: corpus_version(embeddings_file, reports_dir))
 
-    documents = []
-    filenames = []
 
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".txt"):
-            with open(os.path.join(input_dir, filename), "r", encoding="utf-8") as f:
-                text = f.read()
-                documents.append(text)
-                filenames.append(filename)
+def initialize_tracing(enabled: bool = True, jsonl_path: Optional[str] = DEFAULT_TRACES_PATH) -> Tracer:
+    """
+    Enable the per-stage latency spans and counters of the chat pipeline.
 
-    tokenized_docs = [nltk.word_tokenize(doc.lower()) for doc in documents]
+    Args:
+        enabled: Record spans, False to turn tracing off
+        jsonl_path: File every finished span is appended to, None to keep them in memory only
 
-    return BM25Okapi(tokenized_docs)
\ No newline at end of file
+    Returns:
+        Tracer: The shared tracer
+    """
+    tracer = get_tracer()
+    if not enabled:
+        tracer.disable()
+        return tracer
+    if jsonl_path:
+        os.makedirs(os.path.dirname(jsonl_path), exist_ok=True)
+    tracer.enable(jsonl_path)
+    return tracer
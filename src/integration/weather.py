@@ -0,0 +1,372 @@
+"""
+Weather Provider - Cached current conditions and forecasts for the weather expert
+This module puts a per-location TTL cache in front of a pluggable weather backend
+(wttr.in by default). Concurrent lookups of the same location share one request, a
+background thread refreshes the locations asked about recently before they expire, and
+reports include the multi-day forecast the weather expert reasons about.
+
+A backend is any object with fetch(location) -> dict and async afetch(location) -> dict
+returning data in the wttr.in j1 format, so a local fake can replace wttr.in.
+"""
+import time
+import asyncio
+import threading
+import httpx
+import requests
+from collections import OrderedDict
+from urllib.parse import quote
+from typing import Any, Dict, List, Optional
+
+WTTR_URL = "https://wttr.in/{location}?format=j1"
+
+_provider = None
+
+
+class WttrBackend:
+    """
+    wttr.in JSON backend.
+    """
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+        self._session = requests.Session()
+        # One pooled client per event loop, connections cannot move between loops
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            # Clients of loops that are gone cannot be reused nor closed anymore
+            for closed in [l for l in self._clients if l.is_closed()]:
+                del self._clients[closed]
+            client = self._clients[loop] = httpx.AsyncClient(timeout=self.timeout)
+        return client
+
+    def _url(self, location: str) -> str:
+        return WTTR_URL.format(location=quote(location))
+
+    def fetch(self, location: str) -> Dict[str, Any]:
+        response = self._session.get(self._url(location), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def afetch(self, location: str) -> Dict[str, Any]:
+        response = await self.client.get(self._url(location))
+        response.raise_for_status()
+        return response.json()
+
+    async def aclose(self) -> None:
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+def _hourly_max(hours: List[Dict[str, Any]], key: str) -> float:
+    return max((float(hour.get(key, 0) or 0) for hour in hours), default=0.0)
+
+
+def parse_weather(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Extract current conditions and a daily forecast from wttr.in j1 data
+
+    Args:
+        data: wttr.in j1 response
+
+    Returns:
+        Dictionary with the current conditions and one entry per forecast day
+    """
+    current = data["current_condition"][0]
+    forecast = []
+    for day in data.get("weather", []):
+        hours = day.get("hourly", [])
+        descriptions = [hour["weatherDesc"][0]["value"].strip() for hour in hours if hour.get("weatherDesc")]
+        forecast.append({
+            "date": day.get("date"),
+            "description": max(set(descriptions), key=descriptions.count) if descriptions else "",
+            "min_temp_c": float(day.get("mintempC", 0)),
+            "max_temp_c": float(day.get("maxtempC", 0)),
+            "precipitation_mm": sum(float(hour.get("precipMM", 0) or 0) for hour in hours),
+            "chance_of_rain": _hourly_max(hours, "chanceofrain"),
+            "chance_of_frost": _hourly_max(hours, "chanceoffrost"),
+            "max_wind_kmph": _hourly_max(hours, "windspeedKmph"),
+            "max_gust_kmph": _hourly_max(hours, "WindGustKmph"),
+        })
+    return {
+        "current": {
+            "description": current["weatherDesc"][0]["value"],
+            "temp_c": float(current["temp_C"]),
+            "humidity": float(current.get("humidity", 0)),
+            "precipitation_mm": float(current.get("precipMM", 0)),
+            "wind_kmph": float(current.get("windspeedKmph", 0)),
+        },
+        "forecast": forecast,
+    }
+
+
+def format_weather(location: str, weather: Dict[str, Any]) -> str:
+    """
+    Describe the current weather and the forecast of a location for the weather expert
+
+    Args:
+        location: Location asked about
+        weather: Output of parse_weather
+
+    Returns:
+        Plain text report
+    """
+    current = weather["current"]
+    lines = [f"The weather in {location} is {current['description']} with a temperature of {current['temp_c']:g}°C."]
+    if weather["forecast"]:
+        lines.append("Forecast:")
+    for day in weather["forecast"]:
+        lines.append(
+            f"- {day['date']}: {day['description']}, {day['min_temp_c']:g} to {day['max_temp_c']:g}°C, "
+            f"{day['precipitation_mm']:.1f} mm of rain (chance up to {day['chance_of_rain']:g}%), "
+            f"wind up to {day['max_wind_kmph']:g} km/h with gusts to {day['max_gust_kmph']:g} km/h, "
+            f"chance of frost {day['chance_of_frost']:g}%"
+        )
+    return "\n".join(lines)
+
+
+class WeatherProvider:
+    """
+    Per-location TTL cache with request coalescing and background refresh.
+    """
+    def __init__(self, backend: Any = None, ttl: float = 600, max_entries: int = 256,
+                 prefetch_interval: float = 120, recent_window: float = 3600, max_prefetch: int = 32):
+        """
+        Args:
+            backend: Weather backend, defaults to WttrBackend
+            ttl: Time to live of a cached location in seconds
+            max_entries: Maximum number of cached locations
+            prefetch_interval: Seconds between two prefetch rounds
+            recent_window: Locations asked about within this many seconds are kept fresh
+            max_prefetch: Maximum number of locations refreshed per round
+        """
+        self.backend = backend or WttrBackend()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefetch_interval = prefetch_interval
+        self.recent_window = recent_window
+        self.max_prefetch = max_prefetch
+        self.hits = 0
+        self.misses = 0
+        self.backend_calls = 0
+        self._entries = OrderedDict()
+        self._last_seen: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # Bounded like the cache, see _location_lock
+        self._location_locks: "OrderedDict[str, threading.Lock]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._stop = threading.Event()
+        self._prefetcher: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _key(location: str) -> str:
+        return " ".join((location or "").split()).lower()
+
+    def _cached(self, key: str, allow_stale: bool = False) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            weather, created = entry
+            if not allow_stale and time.time() - created > self.ttl:
+                return None
+            self._entries.move_to_end(key)
+            return weather
+
+    def _store(self, key: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        weather = parse_weather(data)
+        with self._lock:
+            self._entries[key] = (weather, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return weather
+
+    def _fetch(self, location: str) -> Dict[str, Any]:
+        with self._lock:
+            self.backend_calls += 1
+        return self.backend.fetch(location)
+
+    async def _afetch(self, location: str) -> Dict[str, Any]:
+        with self._lock:
+            self.backend_calls += 1
+        return await self.backend.afetch(location)
+
+    def _lookup(self, location: str) -> Optional[Dict[str, Any]]:
+        key = self._key(location)
+        with self._lock:
+            self._last_seen[key] = time.time()
+        weather = self._cached(key)
+        with self._lock:
+            if weather is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return weather
+
+    def _location_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            location_lock = self._location_locks.get(key)
+            if location_lock is not None:
+                self._location_locks.move_to_end(key)
+                return location_lock
+            location_lock = self._location_locks[key] = threading.Lock()
+            # Least recently used locks are dropped, except the ones held by a lookup
+            excess = len(self._location_locks) - self.max_entries
+            if excess > 0:
+                for old_key in [old_key for old_key, old_lock in self._location_locks.items()
+                                if not old_lock.locked() and old_key != key][:excess]:
+                    del self._location_locks[old_key]
+            return location_lock
+
+    def _fallback(self, location: str, error: Exception) -> Dict[str, Any]:
+        # An outdated report is better than none when the backend is down
+        stale = self._cached(self._key(location), allow_stale=True)
+        if stale is None:
+            raise error
+        print(f"Weather backend failed for {location}, using the cached report: {error}")
+        return stale
+
+    def get(self, location: str) -> Dict[str, Any]:
+        """
+        Get the weather of a location, as returned by parse_weather
+
+        Args:
+            location: Location name, empty for the location of the server
+
+        Returns:
+            Current conditions and forecast
+        """
+        weather = self._lookup(location)
+        if weather is not None:
+            return weather
+        key = self._key(location)
+        location_lock = self._location_lock(key)
+        # Threads asking for the same location wait for the first request
+        with location_lock:
+            weather = self._cached(key)
+            if weather is not None:
+                return weather
+            try:
+                return self._store(key, self._fetch(location))
+            except Exception as e:
+                return self._fallback(location, e)
+
+    async def aget(self, location: str) -> Dict[str, Any]:
+        """
+        Asyncio equivalent of get.
+        """
+        weather = self._lookup(location)
+        if weather is not None:
+            return weather
+        key = self._key(location)
+        pending = self._pending.get(key)
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = asyncio.ensure_future(self._afetch(location))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None) if self._pending.get(key) is pending else None)
+        try:
+            data = await asyncio.shield(pending)
+        except Exception as e:
+            return self._fallback(location, e)
+        cached = self._cached(key)
+        return cached if cached is not None else self._store(key, data)
+
+    def report(self, location: str) -> str:
+        """
+        Describe the weather of a location, see format_weather
+        """
+        try:
+            return format_weather(location, self.get(location))
+        except Exception as e:
+            print(f"Weather lookup failed for {location}: {e}")
+            return f"Could not retrieve weather for {location}."
+
+    async def areport(self, location: str) -> str:
+        """
+        Asyncio equivalent of report.
+        """
+        try:
+            return format_weather(location, await self.aget(location))
+        except Exception as e:
+            print(f"Weather lookup failed for {location}: {e}")
+            return f"Could not retrieve weather for {location}."
+
+    def _due_locations(self) -> List[str]:
+        now = time.time()
+        with self._lock:
+            recent = [key for key, seen in self._last_seen.items() if now - seen <= self.recent_window]
+            for key in [key for key in self._last_seen if key not in recent]:
+                del self._last_seen[key]
+            # Refresh the entries that would expire before the next round
+            due = [key for key in recent
+                   if key not in self._entries or now - self._entries[key][1] > self.ttl - self.prefetch_interval]
+        return due[:self.max_prefetch]
+
+    def prefetch(self) -> int:
+        """
+        Refresh the recently asked locations whose cached report is about to expire
+
+        Returns:
+            Number of locations refreshed
+        """
+        refreshed = 0
+        for key in self._due_locations():
+            try:
+                self._store(key, self._fetch(key))
+                refreshed += 1
+            except Exception as e:
+                print(f"Weather prefetch failed for {key}: {e}")
+        return refreshed
+
+    def _run_prefetcher(self) -> None:
+        while not self._stop.wait(self.prefetch_interval):
+            self.prefetch()
+
+    def start_prefetcher(self) -> None:
+        """
+        Start refreshing recent locations in a background thread.
+        """
+        if self._prefetcher is None or not self._prefetcher.is_alive():
+            self._stop.clear()
+            self._prefetcher = threading.Thread(target=self._run_prefetcher, name="weather-prefetch", daemon=True)
+            self._prefetcher.start()
+
+    def stop_prefetcher(self) -> None:
+        self._stop.set()
+        if self._prefetcher is not None:
+            self._prefetcher.join()
+            self._prefetcher = None
+
+    async def aclose(self) -> None:
+        """
+        Close the HTTP client of the backend.
+        """
+        if hasattr(self.backend, "aclose"):
+            await self.backend.aclose()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dictionary with hit, miss and backend call counters and the number of cached locations
+        """
+        return {"hits": self.hits, "misses": self.misses, "backend_calls": self.backend_calls,
+                "size": len(self._entries)}
+
+
+def get_weather_provider() -> WeatherProvider:
+    """
+    Get the weather provider shared by the weather tool, with its prefetcher running
+
+    Returns:
+        WeatherProvider shared by the process
+    """
+    global _provider
+    if _provider is None:
+        _provider = WeatherProvider()
+        _provider.start_prefetcher()
+    return _provider
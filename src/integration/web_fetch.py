@@ -0,0 +1,237 @@
+"""
+Web Fetch - Concurrent, cached page fetching for the web search tool
+This module downloads search results with a pooled async HTTP client. Pages are fetched
+concurrently under a per-request deadline, bodies are capped while streaming, and the
+extracted markdown is cached by URL with a TTL. Scripts, styles and other non-content
+markup are stripped before markdownify so that it only converts the text worth keeping.
+"""
+import re
+import time
+import asyncio
+import threading
+import httpx
+from collections import OrderedDict
+from markdownify import markdownify
+from typing import Dict, List, Optional, Sequence, Tuple
+
+USER_AGENT = "Mozilla/5.0 (compatible; AgroFlow/1.0)"
+
+_NON_CONTENT = re.compile(
+    r"<(script|style|noscript|svg|head|template|iframe)\b[^>]*>.*?</\1\s*>|<!--.*?-->",
+    re.IGNORECASE | re.DOTALL,
+)
+_BLANK_LINES = re.compile(r"\n\s*\n\s*\n+")
+
+_fetcher = None
+
+
+def truncate_content(content: str, max_length: int = 2000) -> str:
+    if len(content) <= max_length:
+        return content
+    else:
+        return (
+            content[: max_length // 2]
+            + f"\n..._This content has been truncated to stay below {max_length} characters_...\n"
+            + content[-max_length // 2 :]
+        )
+
+
+def extract_markdown(html: str, max_length: int = 2000) -> str:
+    """
+    Convert a page to truncated markdown
+
+    Args:
+        html: Page HTML
+        max_length: Maximum number of characters kept, see truncate_content
+
+    Returns:
+        Markdown content of the page
+    """
+    markdown = markdownify(_NON_CONTENT.sub("", html)).strip()
+    return truncate_content(_BLANK_LINES.sub("\n\n", markdown), max_length)
+
+
+class PageFetcher:
+    """
+    Fetch pages concurrently and cache their extracted markdown by URL.
+    """
+    def __init__(self, timeout: float = 8.0, max_bytes: int = 1 << 20, ttl: Optional[float] = 3600,
+                 max_entries: int = 512, max_connections: int = 32, max_length: int = 2000):
+        """
+        Args:
+            timeout: Deadline of a single page download, connection included, in seconds
+            max_bytes: Maximum number of bytes read from a response body
+            ttl: Time to live of a cached page in seconds, None to never expire
+            max_entries: Maximum number of cached pages
+            max_connections: Size of the connection pool
+            max_length: Maximum number of characters kept per page
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_connections = max_connections
+        self.max_length = max_length
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # Shared by the background loop thread and the caller's loop
+        self._entries = OrderedDict()
+        self._entries_lock = threading.Lock()
+        self._pending: Dict[str, asyncio.Future] = {}
+        # One pooled client per event loop, connections cannot move between loops
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        # Event loop of the blocking calls, run by a background thread
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Pooled connections belong to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            # Clients of loops that are gone cannot be reused nor closed anymore
+            for closed in [l for l in self._clients if l.is_closed()]:
+                del self._clients[closed]
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                follow_redirects=True,
+                headers={"User-Agent": USER_AGENT},
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+            )
+            self._clients[loop] = client
+        return client
+
+    def _get(self, url: str) -> Optional[str]:
+        with self._entries_lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            content, created = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._entries[url]
+                return None
+            self._entries.move_to_end(url)
+            return content
+
+    def _remember(self, url: str, content: str) -> None:
+        with self._entries_lock:
+            self._entries[url] = (content, time.time())
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def _download(self, url: str) -> Tuple[bytes, str]:
+        body = bytearray()
+        async with self.client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                body.extend(chunk)
+                if len(body) >= self.max_bytes:
+                    # The rest of the page is dropped without being downloaded
+                    del body[self.max_bytes:]
+                    break
+            encoding = response.encoding or "utf-8"
+        return bytes(body), encoding
+
+    async def _fetch(self, url: str) -> str:
+        try:
+            body, encoding = await asyncio.wait_for(self._download(url), self.timeout)
+        except (httpx.HTTPError, httpx.InvalidURL, asyncio.TimeoutError) as e:
+            print(f"Could not fetch {url}: {e!r}")
+            return ""
+        html = body.decode(encoding, errors="replace")
+        content = await asyncio.to_thread(extract_markdown, html, self.max_length)
+        self._remember(url, content)
+        return content
+
+    async def fetch(self, url: str) -> str:
+        """
+        Fetch a page as truncated markdown, from the cache when possible
+
+        Args:
+            url: Page URL
+
+        Returns:
+            Markdown content of the page, empty if it could not be fetched
+        """
+        content = self._get(url)
+        if content is not None:
+            self.hits += 1
+            return content
+
+        # Concurrent requests for the same URL share a single download
+        pending = self._pending.get(url)
+        if pending is not None and pending.get_loop() is asyncio.get_running_loop():
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+        self.misses += 1
+        task = asyncio.ensure_future(self._fetch(url))
+        self._pending[url] = task
+        task.add_done_callback(lambda _: self._pending.pop(url, None) if self._pending.get(url) is task else None)
+        return await asyncio.shield(task)
+
+    async def fetch_many(self, urls: Sequence[str]) -> List[str]:
+        """
+        Fetch several pages concurrently
+
+        Args:
+            urls: Page URLs
+
+        Returns:
+            Markdown content of each page, in the order of the URLs
+        """
+        return list(await asyncio.gather(*(self.fetch(url) for url in urls)))
+
+    def _background_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="page-fetcher", daemon=True).start()
+            return self._loop
+
+    def fetch_many_blocking(self, urls: Sequence[str]) -> List[str]:
+        """
+        Blocking equivalent of fetch_many. The pages are fetched on an event loop of the
+        fetcher, so blocking calls share its connection pool, deadlines and cache, even from
+        a thread that runs an event loop.
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch_many(urls), self._background_loop()).result()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns:
+            Dictionary with hit, coalesced and miss counters and the number of cached pages
+        """
+        with self._entries_lock:
+            size = len(self._entries)
+        return {"hits": self.hits, "coalesced": self.coalesced, "misses": self.misses, "size": size}
+
+    async def aclose(self) -> None:
+        """
+        Close the clients of the running loop and of the background loop
+        """
+        loop = asyncio.get_running_loop()
+        for client_loop, client in list(self._clients.items()):
+            if client_loop is loop:
+                await client.aclose()
+            elif client_loop is self._loop and not client_loop.is_closed():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), client_loop))
+            else:
+                continue
+            del self._clients[client_loop]
+
+
+def get_page_fetcher() -> PageFetcher:
+    """
+    Get the page fetcher shared by the web search tool
+
+    Returns:
+        PageFetcher shared by the process
+    """
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = PageFetcher()
+    return _fetcher